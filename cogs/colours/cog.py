@@ -223,14 +223,17 @@ def cooldown_remaining(last_use_tstamp, **cooldown_timedelta_kwargs):
 
 
 class Colours(DatabaseCogMixin, commands.Cog):
+    db_statements = {
+        'select_user': """SELECT * FROM colours WHERE userid = %s""",
+    }
+
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
 
 
     async def update_cache(self, userid):
-        sql_select = """SELECT * FROM colours WHERE userid = %s"""
-        rows = await self.db_query(sql_select, [userid])
+        rows = await self.db_query_prepared('select_user', [userid])
         if not rows:
             return None
 
@@ -257,12 +260,9 @@ class Colours(DatabaseCogMixin, commands.Cog):
                              (userid, mutateorreroll, tstamp)
                          VALUES (%s, %s, %s)"""
 
-        # Warning: these execute in autocommit so they're not atomic, but
-        # if one fails the other should fail too (barring syntax errors)
-        await self.db_execute(
-            sql_delete, [userid, mutate_or_reroll])
-        await self.db_execute(
-            sql_insert, [userid, mutate_or_reroll, newtime])
+        async with self.db_transaction() as tx:
+            await tx.execute(sql_delete, [userid, mutate_or_reroll])
+            await tx.execute(sql_insert, [userid, mutate_or_reroll, newtime])
 
         await self.update_cache(userid)
 
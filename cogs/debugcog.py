@@ -5,6 +5,9 @@ import discord
 from discord.ext import commands
 
 import appconfig
+import database
+from cogs.tracking.scheduler import SCHEDULER
+from utils.httpclient import HTTP
 
 DEBUGGING = appconfig.DEBUGGING
 
@@ -81,6 +84,30 @@ class DebugCog(commands.Cog):
         await ctx.send(f'```{m.content}```')
 
 
+    @commands.command(hidden=True)
+    async def dbstats(self, ctx):
+        """Shows database connection pool usage and query latencies"""
+        if not (DEBUGGING or await self.bot.is_owner(ctx.author)):
+            return
+        await ctx.send(f'```\n{database.report()}```')
+
+
+    @commands.command(hidden=True)
+    async def pollstats(self, ctx):
+        """Shows the polling schedule of each tracker"""
+        if not (DEBUGGING or await self.bot.is_owner(ctx.author)):
+            return
+        await ctx.send(f'```\n{SCHEDULER.report()}```')
+
+
+    @commands.command(hidden=True)
+    async def httpstats(self, ctx):
+        """Shows outbound HTTP requests and latencies per host"""
+        if not (DEBUGGING or await self.bot.is_owner(ctx.author)):
+            return
+        await ctx.send(f'```\n{HTTP.report()}```')
+
+
     @commands.command(hidden=True)
     async def die(self, ctx):
         if not (DEBUGGING or await self.bot.is_owner(ctx.author)):
@@ -0,0 +1,201 @@
+"""delivery.py
+
+DeliveryEngine fans messages for a topic out to its subscribed channels.
+
+Every channel gets its own sender, which sends that channel's messages one at
+a time, so they arrive in order. Discord rate-limits message sends per
+channel, so one sender per channel also means at most one request in flight
+per bucket. Senders for different channels run concurrently, capped by a
+shared semaphore to stay under the global rate limit.
+
+Sends that fail with 429 or 5xx are retried with jittered backoff; other
+errors fail the message straight away. Delivery counts and latencies are
+kept per topic.
+
+Embeds are rendered to dicts once with prerender() before fan-out, instead of
+once per channel by channel.send().
+"""
+
+import asyncio
+from collections import defaultdict
+import logging
+from random import uniform
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from discord import DiscordException, Forbidden, HTTPException, NotFound
+
+from utils.histogram import LatencyHistogram
+
+
+log = logging.getLogger(__name__)
+
+
+# Max channel.send() calls in flight across all channels
+DELIVERY_MAX_CONCURRENT_SENDS = 10
+# Retries per message after a 429 or 5xx response
+DELIVERY_MAX_RETRIES = 3
+# Backoff (in secs) before the first retry on 5xx; doubles on each retry
+DELIVERY_RETRY_BASE_SECS = 1
+# Up to this fraction of the backoff is added at random, so channels that
+# failed together don't all retry together
+DELIVERY_RETRY_JITTER = 0.5
+
+
+class PrerenderedEmbed:
+    """Stands in for a discord.Embed whose dict form is already built
+
+    channel.send() only calls embed.to_dict(), so the same dict can be shared
+    by every send of a message.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data: dict):
+        self.data = data
+
+
+    def to_dict(self) -> dict:
+        return self.data
+
+
+def prerender(kwargs: dict) -> dict:
+    """Returns channel.send() kwargs with the embed rendered to a dict once"""
+    embed = kwargs.get('embed')
+    if embed is None or isinstance(embed, PrerenderedEmbed):
+        return kwargs
+    return dict(kwargs, embed=PrerenderedEmbed(embed.to_dict()))
+
+
+class TopicDeliveryStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency = LatencyHistogram()
+
+
+    def summary(self) -> str:
+        return (f'sent={self.sent} failed={self.failed} '
+                f'retries={self.retries} latency: {self.latency.summary()}')
+
+
+class DeliveryEngine:
+    def __init__(self,
+                 max_concurrent_sends: int = DELIVERY_MAX_CONCURRENT_SENDS,
+                 max_retries: int = DELIVERY_MAX_RETRIES):
+        self.semaphore = asyncio.Semaphore(max_concurrent_sends)
+        self.max_retries = max_retries
+        self.stats = defaultdict(TopicDeliveryStats)
+
+
+    async def deliver(
+            self,
+            topic: str,
+            channels: Sequence[Tuple[int, str, object]],
+            sendkwargs: Sequence[dict]
+    ) -> Dict[int, List[Optional[DiscordException]]]:
+        """Sends every message in sendkwargs to every channel.
+
+        Arguments:
+        channels - (channelId, channelName, channel) tuples
+        sendkwargs - kwargs for each channel.send() call, in send order
+
+        Returns Mapping[channelId, List[error]], with one entry per message
+        that is None if the message was delivered.
+        """
+        messages = [(topic, prerender(kwargs)) for kwargs in sendkwargs]
+        batches = [(cid, cname, channel, messages)
+                   for cid, cname, channel in channels]
+        results = await self.deliver_batches(batches)
+        return {cid: errors
+                for (cid, _, _, _), errors in zip(batches, results)}
+
+
+    async def deliver_batches(
+            self,
+            batches: Sequence[Tuple[int, str, object, Sequence[tuple]]]
+    ) -> List[List[Optional[DiscordException]]]:
+        """Sends a different list of messages to each channel.
+
+        Each batch is (channelId, channelName, channel, messages), where
+        messages are (topic, sendkwargs) tuples in send order; the topic is
+        only used for stats.
+
+        Returns the errors for each batch, in the same order as batches.
+        """
+        return await asyncio.gather(*[
+            self.deliver_to_channel(cid, cname, channel, messages)
+            for cid, cname, channel, messages in batches
+        ])
+
+
+    async def deliver_to_channel(self, cid, cname, channel, messages):
+        errors = []
+
+        for i, (topic, kwargs) in enumerate(messages):
+            stats = self.stats[topic]
+            start = time.perf_counter()
+            try:
+                await self.send_with_retry(topic, channel, kwargs)
+
+            except DiscordException as e:
+                stats.failed += 1
+                errors.append(e)
+                log.error('failed send to channel: %s id: %s (%s: %s)',
+                          cname, cid, e.__class__.__name__, e)
+
+                if isinstance(e, (Forbidden, NotFound)):
+                    # Every later message would fail the same way
+                    for later_topic, _ in messages[i + 1:]:
+                        self.stats[later_topic].failed += 1
+                        errors.append(e)
+                    break
+                continue
+
+            stats.sent += 1
+            stats.latency.observe((time.perf_counter() - start) * 1000)
+            errors.append(None)
+
+        return errors
+
+
+    async def send_with_retry(self, topic, channel, kwargs):
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    return await channel.send(**kwargs)
+
+            except HTTPException as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+
+                attempt += 1
+                self.stats[topic].retries += 1
+                backoff = self.backoff_secs(e, attempt)
+                log.info('send to channel id: %s got HTTP %s, retry %s/%s in '
+                         '%.1fs', channel.id, e.status, attempt,
+                         self.max_retries, backoff)
+                await asyncio.sleep(backoff)
+
+
+    @staticmethod
+    def is_retryable(exc: HTTPException) -> bool:
+        return exc.status == 429 or exc.status >= 500
+
+
+    @staticmethod
+    def backoff_secs(exc: HTTPException, attempt: int) -> float:
+        if exc.status == 429:
+            retry_after = exc.response.headers.get('Retry-After')
+            base = float(retry_after) if retry_after else 1.0
+        else:
+            base = DELIVERY_RETRY_BASE_SECS * 2 ** (attempt - 1)
+        return base + uniform(0, base * DELIVERY_RETRY_JITTER)
+
+
+    def report(self) -> str:
+        if not self.stats:
+            return 'No deliveries yet.'
+        return '\n'.join(f'{topic}: {stats.summary()}'
+                         for topic, stats in sorted(self.stats.items()))
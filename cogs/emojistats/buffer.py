@@ -0,0 +1,153 @@
+"""buffer.py
+
+WriteBehindBuffer collects rows in memory and hands them off in batches to a
+flush coroutine function, either when enough rows have queued up or when the
+oldest queued row has waited long enough.
+
+Example:
+    async def insert_rows(rows):
+        await db.execute_many_rows(rows)
+
+    buf = WriteBehindBuffer(insert_rows, max_rows=100, max_delay_ms=1000)
+    buf.add(('row', 1))
+    buf.add(('row', 2))
+    # ... insert_rows() is called with both rows within a second
+
+    await buf.flush()  # or flush immediately
+
+If a flush fails, its rows are put back in front of newer ones and retried
+after max_delay_ms. Past max_pending rows, the oldest are dropped.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List
+
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Groups rows in memory and flushes them in batches
+
+    Flushes are serialized, so at most one batch is in flight at a time. Rows
+    added while a flush is running are picked up by the next flush.
+    """
+    def __init__(self,
+                 flush_func: Callable[[List[Any]], Awaitable[Any]],
+                 max_rows: int,
+                 max_delay_ms: int,
+                 loop: asyncio.AbstractEventLoop = None,
+                 max_pending: int = None):
+        self.flush_func = flush_func
+        self.max_rows = max_rows
+        self.max_delay_secs = max_delay_ms / 1000
+        self.max_pending = max_pending or max_rows * 10
+        self.loop = loop or asyncio.get_event_loop()
+
+        self._rows = []
+        # Set after a failed flush, until a flush succeeds
+        self.retrying = False
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+        # Metrics
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.rows_dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+
+    @property
+    def depth(self) -> int:
+        """Number of rows waiting to be flushed"""
+        return len(self._rows)
+
+
+    def add(self, row):
+        """Queues a row, scheduling a flush if one is due"""
+        self._rows.append(row)
+
+        # While retrying, wait for the timer instead of flushing on every add
+        if len(self._rows) >= self.max_rows and not self.retrying:
+            self._cancel_timer()
+            self.loop.create_task(self.flush())
+        elif not self._timer:
+            self._timer = self.loop.call_later(self.max_delay_secs,
+                                               self._on_timer)
+
+
+    def _on_timer(self):
+        self._timer = None
+        self.loop.create_task(self.flush())
+
+
+    def _requeue(self, rows):
+        """Puts back rows from a failed flush, to be retried on the timer"""
+        self._rows[:0] = rows
+        self.retrying = True
+
+        excess = len(self._rows) - self.max_pending
+        if excess > 0:
+            del self._rows[:excess]
+            self.rows_dropped += excess
+            log.error('Dropped %s rows over the limit of %s pending rows',
+                      excess, self.max_pending)
+
+        if not self._timer:
+            self._timer = self.loop.call_later(self.max_delay_secs,
+                                               self._on_timer)
+
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+
+    async def flush(self) -> int:
+        """Flushes all queued rows, returning the number of rows flushed"""
+        async with self._lock:
+            self._cancel_timer()
+
+            rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                await self.flush_func(rows)
+            except Exception as e:
+                log.error('Failed to flush %s rows, retrying in %ss (%s: %s)',
+                          len(rows), self.max_delay_secs,
+                          e.__class__.__name__, e)
+                self._requeue(rows)
+                return 0
+            finally:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self.total_flush_ms += elapsed_ms
+                self.flushes += 1
+
+            self.retrying = False
+            self.rows_flushed += len(rows)
+            return len(rows)
+
+
+    def stats(self) -> dict:
+        flushes = self.flushes
+        return {
+            'queue_depth': self.depth,
+            'retrying': self.retrying,
+            'flushes': flushes,
+            'rows_flushed': self.rows_flushed,
+            'rows_dropped': self.rows_dropped,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / flushes, 2)
+                            if flushes else 0.0,
+        }
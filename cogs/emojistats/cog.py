@@ -1,15 +1,29 @@
-from collections import Counter
-from datetime import datetime
-from itertools import chain
+import csv
+from datetime import datetime, timedelta
+import json
 import logging
-import re
+from tempfile import TemporaryFile
 
-from discord import Embed
+from discord import Embed, File, Member
 from discord.ext import commands
+import psycopg2
 from psycopg2.extras import Json
 
 from appconfig import DEBUGGING
 from cogs.mixins import DatabaseCogMixin
+from database import register_flusher, unregister_flusher
+from .buffer import WriteBehindBuffer
+from .config import (
+    LEADERBOARD_DEFAULT_DAYS,
+    LEADERBOARD_SIZE,
+    ROLLUP_HOURLY_MAX_WINDOW_DAYS,
+    ROLLUP_HOURLY_RETENTION_DAYS,
+    TRIM_CHUNK_ROWS,
+    USAGE_FLUSH_INTERVAL_MS,
+    USAGE_FLUSH_MAX_ROWS,
+)
+from .helpers import EMOJI_STRING_PATTERN, find_emoji
+from .scraper import GuildScraper
 
 
 log = logging.getLogger(__name__)
@@ -18,13 +32,26 @@ log = logging.getLogger(__name__)
 ROW_COUNT_HARD_CAP = 5000
 ROW_COUNT_SOFT_CAP = 1000
 
-EMOJI_STRING_PATTERN = re.compile(r'\<\:(?P<name>.*?)\:(?P<uid>\d+)\>')
-
-
-def find_emoji(str_content):
-    for name, uid in set(EMOJI_STRING_PATTERN.findall(str_content)):
-        raw = f'<:{name}:{uid}>'
-        yield raw, name, uid
+def _rollup_cte(name, table, precision):
+    return f"""{name} AS (
+                INSERT INTO {table} (guildid, bucket, userid, emojistr, uses)
+                    SELECT coalesce(guildid, 0),
+                           date_trunc('{precision}', tstamp),
+                           userid, emojistr, sum(uses)
+                    FROM changed
+                    GROUP BY 1, 2, 3, 4
+                ON CONFLICT (guildid, bucket, userid, emojistr) DO UPDATE
+                    SET uses = {table}.uses + EXCLUDED.uses
+                RETURNING 1
+            )"""
+
+# Follows a `changed` CTE that returns emojistats rows along with a `uses`
+# column of 1 for inserted rows or -1 for deleted rows. Bumps the hourly and
+# daily rollups by the net change in each bucket.
+ROLLUP_CTES = ', '.join([
+    _rollup_cte('hourly', 'emojistats_hourly', 'hour'),
+    _rollup_cte('daily', 'emojistats_daily', 'day'),
+])
 
 
 def embed_from_emoji_tups(emoji_tup_list):
@@ -59,16 +86,68 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
     """
     Stats for emoji nerds
     """
+    db_statements = {
+        'row_count': """
+            SELECT row_count FROM emojistats_rowcount;""",
+
+        # Takes the whole batch as one json array of row objects, so the
+        # statement has the same shape (and plan) for any number of rows
+        'insert_usage': f"""
+            WITH changed AS (
+                INSERT INTO emojistats(
+                    tstamp, userid, emojistr, recipientid, guildid)
+                SELECT * FROM json_to_recordset(%s) AS r(
+                    tstamp timestamp, userid bigint, emojistr text,
+                    recipientid bigint, guildid bigint)
+                ON CONFLICT DO NOTHING
+                RETURNING tstamp, userid, emojistr, guildid, 1 AS uses
+            ), {ROLLUP_CTES}
+            SELECT tstamp FROM changed;""",
+
+        'delete_usage': f"""
+            WITH changed AS (
+                DELETE FROM emojistats
+                    WHERE emojistr = %s
+                    AND userid = %s
+                    AND tstamp = %s
+                RETURNING tstamp, userid, emojistr, guildid, -1 AS uses
+            ), {ROLLUP_CTES}
+            SELECT tstamp FROM changed;""",
+    }
+
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
         self.rows_count = 0
         self.after_setup_pool(self.get_row_count)
 
+        # Usage rows are grouped in memory and inserted in batches
+        self.usage_buffer = WriteBehindBuffer(self.flush_usage,
+                                              USAGE_FLUSH_MAX_ROWS,
+                                              USAGE_FLUSH_INTERVAL_MS,
+                                              loop=bot.loop)
+        # Flushed by close_pool(), before the pool goes away
+        register_flusher(self.usage_buffer.flush)
+
+
+    def cog_unload(self):
+        super().cog_unload()
+        unregister_flusher(self.usage_buffer.flush)
+
 
     async def get_row_count(self):
-        rows = await self.db_query("SELECT * FROM emojistats;")
-        self.rows_count = len(rows)
+        """Reads the exact row count from the trigger-maintained counter"""
+        try:
+            rows = await self.db_query_prepared('row_count')
+        except psycopg2.ProgrammingError:
+            # Counter table not created yet, fall back to a full count
+            log.warning('emojistats_rowcount not found, please apply '
+                        'schema_emojistats.sql (it keeps existing rows); '
+                        'counting rows instead')
+            rows = await self.db_query(
+                "SELECT count(*) AS row_count FROM emojistats;")
+
+        self.rows_count = rows[0]['row_count'] if rows else 0
 
 
     def is_me(self, user):
@@ -95,9 +174,11 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
 
         tstamp = reaction.message.created_at  # in UTC
         recipientid = reaction.message.author.id
+        guild = reaction.message.guild
 
         await self.bump_emoji_usage(emoji_str, userid, tstamp, recipientid,
-                                    removing)
+                                    removing,
+                                    guildid=guild.id if guild else None)
 
 
     @commands.Cog.listener()
@@ -110,12 +191,14 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
 
         userid = message.author.id
         tstamp = message.created_at
+        guildid = message.guild.id if message.guild else None
 
         for raw, _, _ in find_emoji(message.content):
             await self.bump_emoji_usage(raw,
                                         userid,
                                         tstamp,
-                                        remove=False)
+                                        remove=False,
+                                        guildid=guildid)
 
 
     async def bump_emoji_usage(self,
@@ -123,36 +206,67 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
                                userid: int,
                                tstamp: datetime,
                                recipientid: int = None,
-                               remove: bool = False):
+                               remove: bool = False,
+                               guildid: int = None):
         if DEBUGGING:
             log.info('Skip %scrementing for %s',
                      'de' if remove else 'in',
                      emojistr)
             return
 
-        query = """
-            INSERT INTO emojistats(emojistr, userid, tstamp, recipientid)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT DO NOTHING;"""
-        data = [emojistr, userid, tstamp, recipientid]
+        if not remove:
+            # Buffered, gets inserted on the next flush
+            self.usage_buffer.add(
+                (tstamp, userid, emojistr, recipientid, guildid))
+            return
 
-        if remove:
-            query = """
-                DELETE FROM emojistats
-                    WHERE emojistr = %s
-                    AND userid = %s
-                    AND tstamp = %s;"""
-            data = [emojistr, userid, tstamp]
+        # Flush pending rows first so the row to delete has been inserted
+        await self.usage_buffer.flush()
 
-        await self.db_execute(query, data)
-        self.rows_count += (-1 if remove else 1)
+        data = [emojistr, userid, tstamp]
 
-        if remove:
-            return
+        deleted = await self.db_execute_prepared('delete_usage', data)
+        self.rows_count -= len(deleted)
+
+
+    async def flush_usage(self, rows):
+        """Flush function for the usage buffer"""
+        await self.insert_usage_rows(rows)
         await self.trim_rows()
 
 
+    async def insert_usage_rows(self, rows) -> int:
+        """Inserts a batch of usage rows with a single statement.
+
+        Each row is a 5-ple of (tstamp, userid, emojistr, recipientid,
+        guildid). The hourly and daily rollups are bumped in the same
+        statement, for inserted rows only.
+
+        Returns the number of rows actually inserted, which excludes rows
+        skipped by ON CONFLICT DO NOTHING.
+        """
+        if not rows:
+            return 0
+
+        keys = ('tstamp', 'userid', 'emojistr', 'recipientid', 'guildid')
+        data = [dict(zip(keys, row)) for row in rows]
+        for row in data:
+            row['tstamp'] = row['tstamp'].isoformat()
+
+        # Only inserted rows are returned, conflicting rows are not
+        inserted = await self.db_execute_prepared('insert_usage', [Json(data)])
+        self.rows_count += len(inserted)
+        return len(inserted)
+
+
     async def trim_rows(self, force=False):
+        """Archives all but the newest ROW_COUNT_SOFT_CAP rows.
+
+        The cutoff is the tstamp of the newest row past the soft cap; rows at
+        or older than it are deleted in chunks of TRIM_CHUNK_ROWS, and each
+        chunk is tallied per emoji into one emojistats_archive row within the
+        same statement. Nothing is sent back except the chunk total.
+        """
         if (not force) and (self.rows_count < ROW_COUNT_HARD_CAP):
             return
 
@@ -160,47 +274,171 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
             log.info('No rows to trim')
             return
 
-        # Ordered by newest to oldest rows, offsetting SOFT_CAP newest rows
-        query = f"""
-            DELETE FROM emojistats
-                WHERE EXISTS (
-                    SELECT * FROM emojistats
-                    ORDER BY tstamp DESC
-                    LIMIT NULL OFFSET {0 if force else ROW_COUNT_SOFT_CAP}
-                    -- LIMIT NULL OFFSET 1000
-                )
-            RETURNING *;"""
-
-        # Timestamp to use on the archive row
-        tstamp = None
-
-        # For counting emoji among rows targeted for archiving
-        emoji_ctr = Counter()
-
-        # Push archived rows into counter object
-        trimmed_rows = await self.db_query(query)
-        for row in trimmed_rows:
-            ts = row['tstamp']
-            # Use latest tstamp in batch as the tstamp for archive row
-            if (not tstamp) or (ts > tstamp):
-                tstamp = ts
-            emoji_ctr[row['emojistr']] += 1
-
-        # Update our tally of rows
-        self.rows_count -= len(trimmed_rows)
-
-        # Get total count
-        total_count = sum(emoji_ctr.values())
+        # Uses the index on tstamp, so only the first (offset + 1) index
+        # entries are walked
+        query = """
+            SELECT tstamp FROM emojistats
+                ORDER BY tstamp DESC
+                OFFSET %s LIMIT 1;"""
+        offset = 0 if force else ROW_COUNT_SOFT_CAP
+        rows = await self.db_execute(query, [offset])
+        if not rows:
+            log.info('No rows to trim')
+            return
+        cutoff = rows[0][0]
 
+        # Archive rows are keyed by the latest tstamp in their chunk; if
+        # chunks share that tstamp (ties at chunk boundaries, or a previous
+        # trim), the emoji counts are summed into the existing row instead
         query = """
-            INSERT INTO emojistats_archive (tstamp, emoji_json, total_count)
-            VALUES (%s, %s, %s);"""
+            WITH doomed AS (
+                SELECT tstamp, userid, emojistr FROM emojistats
+                    WHERE tstamp <= %(cutoff)s
+                    ORDER BY tstamp
+                    LIMIT %(chunk)s
+            ), deleted AS (
+                DELETE FROM emojistats e
+                    USING doomed d
+                    WHERE e.tstamp = d.tstamp
+                    AND e.userid = d.userid
+                    AND e.emojistr = d.emojistr
+                RETURNING e.tstamp, e.emojistr
+            ), counts AS (
+                SELECT emojistr, count(*) AS n
+                    FROM deleted
+                    GROUP BY emojistr
+            ), archived AS (
+                INSERT INTO emojistats_archive (tstamp, emoji_json, total_count)
+                    SELECT (SELECT max(tstamp) FROM deleted),
+                           json_object_agg(emojistr, n),
+                           sum(n)
+                        FROM counts
+                        HAVING count(*) > 0
+                ON CONFLICT (tstamp) DO UPDATE SET
+                    emoji_json = (
+                        SELECT json_object_agg(key, total)
+                        FROM (
+                            SELECT key, sum(value::text::int) AS total
+                            FROM (
+                                SELECT * FROM json_each(
+                                    emojistats_archive.emoji_json)
+                                UNION ALL
+                                SELECT * FROM json_each(EXCLUDED.emoji_json)
+                            ) AS merged
+                            GROUP BY key
+                        ) AS summed
+                    ),
+                    total_count = (emojistats_archive.total_count
+                                   + EXCLUDED.total_count)
+                RETURNING tstamp
+            )
+            SELECT count(*) FROM deleted;"""
+        params = {'cutoff': cutoff, 'chunk': TRIM_CHUNK_ROWS}
+
+        chunks = 0
+        trimmed = 0
+        while True:
+            # Each chunk runs as its own autocommit statement, so locks are
+            # only held for up to TRIM_CHUNK_ROWS rows at a time
+            rows = await self.db_execute(query, params)
+            deleted_count = rows[0][0] if rows else 0
+            if not deleted_count:
+                break
+            chunks += 1
+            trimmed += deleted_count
+            if deleted_count < TRIM_CHUNK_ROWS:
+                break
+
+        # Resync our tally with the counter table
+        await self.get_row_count()
+
+        # Rollups outlive the raw rows, but hourly buckets are only needed
+        # for short leaderboard windows
+        query = """
+            DELETE FROM emojistats_hourly WHERE bucket < %s;"""
+        horizon = datetime.utcnow() - timedelta(
+            days=ROLLUP_HOURLY_RETENTION_DAYS)
+        await self.db_execute(query, [horizon])
 
-        # Push archive row
-        await self.db_execute(query,
-                              [tstamp, Json(emoji_ctr), total_count])
-        log.info('Trimmed emojistats into archive, tstamp=%s',
-                 tstamp.timestamp())
+        log.info('Trimmed %s emojistats rows into archive in %s chunks, '
+                 'cutoff tstamp=%s', trimmed, chunks, cutoff.timestamp())
+
+
+    async def top_emoji(self,
+                        guildid: int,
+                        days: float,
+                        userid: int = None,
+                        limit: int = LEADERBOARD_SIZE):
+        """Reads the most-used emoji from the rollups.
+
+        Windows of up to ROLLUP_HOURLY_MAX_WINDOW_DAYS are read from the
+        hourly rollup, longer ones from the daily rollup, so the cost scales
+        with the number of buckets in the window rather than raw usage rows.
+
+        Returns list of (emojistr, uses) tuples, most used first.
+        """
+        if days <= ROLLUP_HOURLY_MAX_WINDOW_DAYS:
+            table, precision = 'emojistats_hourly', 'hour'
+        else:
+            table, precision = 'emojistats_daily', 'day'
+
+        user_clause = 'AND userid = %(userid)s' if userid else ''
+        query = f"""
+            SELECT emojistr, sum(uses) AS total
+                FROM {table}
+                WHERE guildid = %(guildid)s
+                AND bucket >= date_trunc('{precision}', %(since)s::timestamp)
+                {user_clause}
+                GROUP BY emojistr
+                HAVING sum(uses) > 0
+                ORDER BY total DESC
+                LIMIT %(limit)s;"""
+        params = {
+            'guildid': guildid or 0,
+            'since': datetime.utcnow() - timedelta(days=days),
+            'userid': userid,
+            'limit': limit,
+        }
+        rows = await self.db_query(query, params)
+        return [(row['emojistr'], row['total']) for row in rows]
+
+
+    async def send_leaderboard(self, ctx, title, days, userid=None):
+        if days <= 0:
+            await ctx.send('The number of days has to be more than 0!')
+            return
+
+        top = await self.top_emoji(ctx.guild.id if ctx.guild else None,
+                                   days,
+                                   userid=userid)
+        if not top:
+            await ctx.send(f'No emoji used in the last {days} days.')
+            return
+
+        lines = [f'`{rank:>2}.` {emojistr} · {total}'
+                 for rank, (emojistr, total) in enumerate(top, start=1)]
+        embed = Embed(title=title, description='\n'.join(lines))
+        embed.set_footer(text=f'Last {days} days')
+        await ctx.send(embed=embed)
+
+
+    @commands.group(invoke_without_command=True)
+    async def emojistats(self, ctx, days: int = LEADERBOARD_DEFAULT_DAYS):
+        """Shows the most-used emoji on this server (!emojistats 7)"""
+        await self.send_leaderboard(ctx, 'Top emoji', days)
+
+
+    @emojistats.command(name='user')
+    async def emojistats_user(self,
+                              ctx,
+                              member: Member = None,
+                              days: int = LEADERBOARD_DEFAULT_DAYS):
+        """Shows someone's most-used emoji (!emojistats user @someone 7)"""
+        member = member or ctx.author
+        await self.send_leaderboard(ctx,
+                                    f'Top emoji for {member.display_name}',
+                                    days,
+                                    userid=member.id)
 
 
     @commands.command()
@@ -258,13 +496,51 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
         await self.trim_rows(force=True)
 
 
+    @commands.command(hidden=True)
+    async def emojiexport(self, ctx):
+        """Uploads emojistats_archive as a CSV file"""
+        if not await self.bot.is_owner(ctx.author):
+            return
+
+        query = """
+            SELECT tstamp, total_count, emoji_json
+                FROM emojistats_archive
+                ORDER BY tstamp;"""
+
+        # Streamed from a server-side cursor into a temp file, so the archive
+        # is never held in memory all at once
+        exported = 0
+        with TemporaryFile('w+', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['tstamp', 'total_count', 'emoji_json'])
+            async for row in self.db_query_generating(query):
+                writer.writerow([row['tstamp'].isoformat(),
+                                 row['total_count'],
+                                 json.dumps(row['emoji_json'])])
+                exported += 1
+
+            f.seek(0)
+            await ctx.send(f'Exported {exported} archive rows.',
+                           file=File(f.buffer, 'emojistats_archive.csv'))
+
+
+    @commands.command(hidden=True)
+    async def emojiqueue(self, ctx):
+        """Shows metrics for the emoji usage write-behind buffer"""
+        if not await self.bot.is_owner(ctx.author):
+            return
+        stats = self.usage_buffer.stats()
+        width = max(len(k) for k in stats)
+        lines = [f'{k.ljust(width)}  {v}' for k, v in stats.items()]
+        await ctx.send('```\n' + '\n'.join(lines) + '```')
+
+
     @commands.command(hidden=True)
     async def scrape(self, ctx, guild_id=None, channel_id=None):
         """Scrapes all emoji usage from the target guild or channel.
 
-        WARNING: Currently the db doesn't index the origin guild, so this
-        command will conflate emoji usage stats from the target guild with the
-        guild that this command was issued from.
+        Progress is checkpointed per channel, so running this again after an
+        interruption resumes where it left off. Use !scrapereset to start over.
         """
         if not await self.bot.is_owner(ctx.author):
             return
@@ -282,7 +558,7 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
 
         if channel_id:
             # guild.get_channel() returns List[discord.abc.GuildChannel] or None
-            channel = guild.get_channel(channel_id)
+            channel = guild.get_channel(int(channel_id))
             channels = [channel]
 
         else:
@@ -295,66 +571,33 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
                      channel_id)
             return
 
-        channels_scraped = 0
-        emojis_scraped = 0
-        parser = self.parse_msg_emoji
-
         # filter() out any Nones return by guild.get_channel()
-        for channel in filter(None, channels):
-            # Voice channels have no history
-            if not hasattr(channel, 'history'):
-                continue
-
-            try:
-                async for uids_reacts in channel.history().map(parser):
-                    emojis_scraped += await self.ingest_emoji(uids_reacts)
-
-                channels_scraped += 1
-
-            except AssertionError:
-                break
-
-            except BaseException as e:
-                if DEBUGGING:
-                    raise
-                log.info('scrape: failed to scrape channel id: %s (%s: %s)',
-                         channel.id, e.__class__.__name__, e)
+        scraper = GuildScraper(self, guild)
+        await scraper.run(filter(None, channels))
 
         log.info('scrape: scraped %s unique reacts from %s channels',
-                 emojis_scraped, channels_scraped)
+                 scraper.emojis_scraped, scraper.channels_scraped)
         await self.trim_rows()
 
 
-    async def parse_msg_emoji(self, message):
-        """Parses a message for emoji in the content and the reacts.
-
-        This function parses emoji as having same timestamp as the message it
-        reacts to (as opposed to when the react was added). This is to
-        consistently count instances of emoji use as unique to each message
-        (using the timestamp as a unique identifier).
-        """
-        author_id = message.author.id
-        tstamp = message.created_at
-
-        content_emoji = set((author_id, raw, None)
-                            for raw, _, _ in find_emoji(message.content))
-
-        content_emoji_add = content_emoji.add
-
-        for react in message.reactions:
-            react_raw = str(react)
-            async for user in react.users():
-                content_emoji_add((user.id, react_raw, author_id))
+    @commands.command(hidden=True)
+    async def scrapereset(self, ctx, guild_id=None):
+        """Clears !scrape checkpoints so the next scrape starts over"""
+        if not await self.bot.is_owner(ctx.author):
+            return
 
-        return [(tstamp, *tup) for tup in content_emoji]
+        guildid = int(guild_id) if guild_id else ctx.guild.id
+        await GuildScraper.reset_checkpoints(self, guildid)
+        log.info('scrape: cleared checkpoints for guild id: %s', guildid)
 
 
     async def ingest_emoji(self, uids_reacts):
         """Inserts emoji usage instances to database.
 
         uids_reacts should be an iterable yielding 'usage instances', each
-        'instance' being a 4-ple of (tstamp, userid, emojistr, recipientid)
-        corresponding to a row in the emojistats table in the database.
+        'instance' being a 5-ple of (tstamp, userid, emojistr, recipientid,
+        guildid) corresponding to a row in the emojistats table in the
+        database.
         """
         unique_reacts = len(uids_reacts)
         if not unique_reacts:
@@ -366,16 +609,4 @@ class EmojiTools(DatabaseCogMixin, commands.Cog):
                      current_rows_count, unique_reacts)
             raise AssertionError
 
-        # psycopg2 placeholders that are substituted for actual data
-        # during execute
-        placeholders = ','.join(['(%s, %s, %s, %s)'] * unique_reacts)
-        query = (f'INSERT INTO emojistats(tstamp, userid, emojistr, recipientid) '
-                 f'VALUES {placeholders} ON CONFLICT DO NOTHING;')
-
-        # Flatten the data
-        # [(uid, raw)...] -> [time, uid1, raw1, time, uid2, raw2...]
-        data = list(chain.from_iterable(uids_reacts))
-
-        await self.db_execute(query, data)
-        self.rows_count += unique_reacts
-        return unique_reacts
+        return await self.insert_usage_rows(uids_reacts)
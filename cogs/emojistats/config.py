@@ -0,0 +1,27 @@
+# Max usage rows held in the write-behind buffer before a flush is forced
+USAGE_FLUSH_MAX_ROWS = 200
+# Max time (in millisecs) a buffered usage row waits before it is flushed
+USAGE_FLUSH_INTERVAL_MS = 2000
+# Max rows deleted and archived per statement when trimming emojistats
+TRIM_CHUNK_ROWS = 500
+
+# Leaderboard windows up to this many days are read from the hourly rollup,
+# longer windows from the daily rollup
+ROLLUP_HOURLY_MAX_WINDOW_DAYS = 2
+# Hourly rollup buckets older than this are pruned whenever emojistats is
+# trimmed
+ROLLUP_HOURLY_RETENTION_DAYS = 7
+# Default window and length of !emojistats leaderboards
+LEADERBOARD_DEFAULT_DAYS = 30
+LEADERBOARD_SIZE = 10
+
+# Max channels scraped at once by !scrape
+SCRAPE_MAX_CONCURRENT_CHANNELS = 4
+# Max reaction user lists fetched at once within each channel. Reaction
+# lookups in a channel share a Discord rate-limit bucket, so keep this small.
+SCRAPE_MAX_CONCURRENT_REACTS = 2
+# Usage rows collected from a channel before they are inserted and the
+# channel's checkpoint is saved
+SCRAPE_INSERT_BATCH_ROWS = 500
+# Attempts per reaction lookup when rate-limited
+SCRAPE_MAX_RETRIES = 3
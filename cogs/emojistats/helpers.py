@@ -0,0 +1,10 @@
+import re
+
+
+EMOJI_STRING_PATTERN = re.compile(r'\<\:(?P<name>.*?)\:(?P<uid>\d+)\>')
+
+
+def find_emoji(str_content):
+    for name, uid in set(EMOJI_STRING_PATTERN.findall(str_content)):
+        raw = f'<:{name}:{uid}>'
+        yield raw, name, uid
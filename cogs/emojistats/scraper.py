@@ -0,0 +1,197 @@
+"""scraper.py
+
+GuildScraper walks the message history of a guild's channels and ingests the
+emoji usage it finds with EmojiTools.ingest_emoji().
+
+Several channels are scraped at once, bounded by a semaphore. Within each
+channel, reaction user lists are fetched a few at a time, since they share a
+Discord rate-limit bucket, and usage rows from many messages are inserted
+together. After each insert the channel's progress is saved to
+emojistats_scrape_progress, so an interrupted scrape resumes from the last
+ingested message instead of the start of the channel.
+"""
+
+import asyncio
+from datetime import datetime
+import logging
+
+from discord import HTTPException, Object
+
+from appconfig import DEBUGGING
+from .config import (
+    SCRAPE_INSERT_BATCH_ROWS,
+    SCRAPE_MAX_CONCURRENT_CHANNELS,
+    SCRAPE_MAX_CONCURRENT_REACTS,
+    SCRAPE_MAX_RETRIES,
+)
+from .helpers import find_emoji
+
+
+log = logging.getLogger(__name__)
+
+
+class GuildScraper:
+    def __init__(self, cog, guild):
+        """
+        Arguments:
+        cog - the EmojiTools cog, used for database access and ingestion
+        guild - the discord.Guild whose channels are scraped
+        """
+        self.cog = cog
+        self.guild = guild
+
+        self.channel_sem = asyncio.Semaphore(SCRAPE_MAX_CONCURRENT_CHANNELS)
+
+        # Set once ingestion hits the emojistats hard cap
+        self.capped = False
+
+        self.channels_scraped = 0
+        self.emojis_scraped = 0
+
+
+    async def run(self, channels):
+        checkpoints = await self.load_checkpoints()
+
+        coros = []
+        for channel in channels:
+            # Voice channels have no history
+            if not hasattr(channel, 'history'):
+                continue
+
+            checkpoint = checkpoints.get(channel.id)
+            if checkpoint and checkpoint['isdone']:
+                log.info('scrape: skipping finished channel id: %s',
+                         channel.id)
+                continue
+
+            after_id = checkpoint['lastmessageid'] if checkpoint else None
+            coros.append(self.scrape_channel(channel, after_id))
+
+        await asyncio.gather(*coros)
+
+
+    async def scrape_channel(self, channel, after_id=None):
+        async with self.channel_sem:
+            if self.capped:
+                return
+
+            react_sem = asyncio.Semaphore(SCRAPE_MAX_CONCURRENT_REACTS)
+            after = Object(id=after_id) if after_id else None
+            last_id = after_id
+            batch = []
+
+            try:
+                # Oldest first, so the checkpoint only ever moves forward
+                history = channel.history(limit=None,
+                                          after=after,
+                                          oldest_first=True)
+                async for message in history:
+                    if self.capped:
+                        return
+
+                    batch.extend(await self.parse_message(message, react_sem))
+                    last_id = message.id
+
+                    if len(batch) >= SCRAPE_INSERT_BATCH_ROWS:
+                        await self.ingest(channel, batch, last_id)
+                        batch = []
+
+                await self.ingest(channel, batch, last_id, isdone=True)
+                self.channels_scraped += 1
+
+            except AssertionError:
+                # Raised by ingest_emoji() when the hard cap is reached
+                self.capped = True
+
+            except Exception as e:
+                if DEBUGGING:
+                    raise
+                log.info('scrape: failed to scrape channel id: %s (%s: %s)',
+                         channel.id, e.__class__.__name__, e)
+
+
+    async def ingest(self, channel, rows, last_id, isdone=False):
+        if rows:
+            self.emojis_scraped += await self.cog.ingest_emoji(rows)
+        await self.save_checkpoint(channel, last_id, isdone)
+
+
+    async def parse_message(self, message, react_sem):
+        """Parses a message for emoji in the content and the reacts.
+
+        This function parses emoji as having same timestamp as the message it
+        reacts to (as opposed to when the react was added). This is to
+        consistently count instances of emoji use as unique to each message
+        (using the timestamp as a unique identifier).
+        """
+        author_id = message.author.id
+        tstamp = message.created_at
+        guildid = self.guild.id
+
+        usages = set((author_id, raw, None)
+                     for raw, _, _ in find_emoji(message.content))
+
+        reactions = message.reactions
+        users_per_react = await asyncio.gather(*[
+            self.fetch_react_users(react, react_sem)
+            for react in reactions
+        ])
+
+        for react, users in zip(reactions, users_per_react):
+            react_raw = str(react)
+            usages.update((user.id, react_raw, author_id) for user in users)
+
+        return [(tstamp, *usage, guildid) for usage in usages]
+
+
+    async def fetch_react_users(self, react, react_sem):
+        """Fetches the users of a reaction, backing off when rate-limited
+
+        discord.py already waits out rate limits it knows about, this covers
+        the 429s that still slip through while several channels are running.
+        """
+        attempt = 1
+        while True:
+            try:
+                async with react_sem:
+                    return await react.users().flatten()
+
+            except HTTPException as e:
+                if e.status != 429 or attempt >= SCRAPE_MAX_RETRIES:
+                    raise
+
+                retry_secs = float(e.response.headers.get('Retry-After') or 1)
+                log.info('scrape: rate-limited on reacts (bucket: %s), '
+                         'retrying in %ss',
+                         e.response.headers.get('X-RateLimit-Bucket'),
+                         retry_secs)
+                await asyncio.sleep(retry_secs)
+                attempt += 1
+
+
+    async def load_checkpoints(self):
+        query = """SELECT channelid, lastmessageid, isdone
+                   FROM emojistats_scrape_progress
+                   WHERE guildid = %s;"""
+        rows = await self.cog.db_query(query, [self.guild.id])
+        return {row['channelid']: row for row in rows}
+
+
+    async def save_checkpoint(self, channel, last_id, isdone=False):
+        query = """INSERT INTO emojistats_scrape_progress
+                       (channelid, guildid, lastmessageid, isdone, tstamp)
+                   VALUES (%s, %s, %s, %s, %s)
+                   ON CONFLICT (channelid) DO UPDATE SET
+                       lastmessageid = EXCLUDED.lastmessageid,
+                       isdone = EXCLUDED.isdone,
+                       tstamp = EXCLUDED.tstamp;"""
+        await self.cog.db_execute(
+            query,
+            [channel.id, self.guild.id, last_id, isdone, datetime.utcnow()])
+
+
+    @staticmethod
+    async def reset_checkpoints(cog, guildid):
+        query = """DELETE FROM emojistats_scrape_progress
+                   WHERE guildid = %s;"""
+        await cog.db_execute(query, [guildid])
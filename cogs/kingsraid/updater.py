@@ -2,6 +2,7 @@ import asyncio
 from base64 import b64decode
 from collections import defaultdict
 import json
+import logging
 from os.path import abspath, dirname, getmtime, join
 
 import aiohttp
@@ -9,9 +10,12 @@ import requests
 
 import appconfig
 from utils import anypartial
+from utils.httpclient import HTTP
 from utils.scraping import pull_pages
 
 
+log = logging.getLogger(__name__)
+
 basedir = abspath(dirname(__file__))
 
 JSON_DATA = join(basedir, "krdata.json")
@@ -42,11 +46,12 @@ def make_auth(user=GITHUB_USER, pw=GITHUB_AUTH, aio=False):
         return requests.auth.HTTPBasicAuth(user, password=pw)
 
 
-def fetch_mog_json(path):
+async def fetch_mog_json(path):
     try:
-        res = requests.get(MOG_GITAPI_STUB + path, auth=make_auth())
-        assert res.ok
-        return res.json()
+        async with HTTP.session.get(MOG_GITAPI_STUB + path,
+                                    auth=make_auth(aio=True)) as res:
+            assert res.status == 200
+            return await res.json()
     except Exception as e:
         raise RuntimeError(f'failed to collect {MOG_GITAPI_STUB + path}')
 
@@ -55,11 +60,11 @@ async def pull_mog_eng_json(loop):
     out = defaultdict(dict)
 
     # Fetch root dir for english translation
-    root = fetch_mog_json(ENG_PATH)
+    root = await fetch_mog_json(ENG_PATH)
 
     # Walk dir, extract folder/file names, filepath stubs for json resources
     for folder in [x for x in root if x['type'] == 'dir']:
-        subdir = fetch_mog_json(folder['path'])
+        subdir = await fetch_mog_json(folder['path'])
         filepaths = {
             f['name'].split('.')[0]: f['path']
             for f in subdir
@@ -80,7 +85,15 @@ async def pull_mog_eng_json(loop):
 
     # Unflatten results to match the original 2-deep nested structure
     for url, res in results:
-        j = await res.json()
+        if isinstance(res, Exception):
+            log.warning('Failed to pull %s (%s: %s)',
+                        url, res.__class__.__name__, res)
+            continue
+        status, body = res
+        if status != 200:
+            log.warning('Failed to pull %s (HTTP %s)', url, status)
+            continue
+        j = json.loads(body)
         foldern, filen = url_to_folder_file[url]
         out[foldern][filen] = json.loads(b64decode(j['content']))
 
@@ -95,11 +108,12 @@ async def update_eng(loop):
 
 
 async def update_data(loop):
-    req = requests.get(DATAURL)
-    if not req.ok:
-        return
+    async with HTTP.session.get(DATAURL) as req:
+        if req.status != 200:
+            return
+        text = await req.text()
     with open(JSON_DATA, 'w', encoding='utf-8') as f:
-        f.write(req.text)
+        f.write(text)
     return
 
 
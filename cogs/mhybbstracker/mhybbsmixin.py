@@ -1,8 +1,10 @@
 """
-TODO: add machine translations for the post titles
+Chinese post titles are machine translated into the embed description, in
+one batch per tick.
 """
 
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+import json
 import logging
 from types import SimpleNamespace
 from typing import Sequence
@@ -10,7 +12,9 @@ from typing import Sequence
 from discord import Embed
 
 from cogs.tracking.config import TRACKER_UPDATE_INTERVAL_SECS
-from translation import translate
+from cogs.tracking.post import TrackerPost
+from translation import Glossary, TranslationService
+from translation.store import DatabaseStore
 
 from .glossary import TRANSLATION_GLOSSARY
 
@@ -21,7 +25,18 @@ Lang = SimpleNamespace(EN='en', ZH='zh')
 
 # TRACKER_UPDATE_INTERVAL_SECS = 12 * 60 * 60
 
-class MhyBbsPost:
+GLOSSARY = Glossary(TRANSLATION_GLOSSARY)
+TRANSLATOR = TranslationService(store=DatabaseStore())
+
+FORUM_LANGUAGES = {
+    '官方': Lang.ZH,
+    'Official': Lang.EN,
+}
+
+
+class MhyBbsPost(TrackerPost):
+    __slots__ = ('language', 'description')
+
     ARTICLE_STUB = {
         Lang.ZH: 'https://bbs.mihoyo.com/ys/article/',
         Lang.EN: 'https://forums.mihoyo.com/genshin/article/',
@@ -31,82 +46,39 @@ class MhyBbsPost:
         Lang.EN: 'https://forums.mihoyo.com/genshin/accountCenter/postList?id=',
     }
 
-    def __init__(self, post_json):
-        self.json = post_json
-        self._cache = {}
-
-
-    @property
-    def language(self):
-        default = Lang.EN
-        forum = self.json['forum']['name']
-        return {
-            '官方': Lang.ZH,
-            'Official': Lang.EN,
-        }.get(forum, default)
-
-
-    @property
-    def articleid(self):
-        return str(self.json['post']['post_id'])  # is a string-encoded int
-
-
-    @property
-    def title(self):
-        return self.json['post']['subject']
-
-
-    @property
-    def url(self):
-        stub = self.ARTICLE_STUB.get(self.language)
-        return (stub + self.articleid) if stub else None
-
-
-    @property
-    def image_url(self):
-        if not self.json['image_list']:
-            return None
-        return self.json['image_list'][0]['url']
-
-
-    @property
-    def author(self):
-        user = self.json['user']
-        url = self.USER_STUB.get(self.language)
-        return {
-            'name': user['nickname'],
-            'url': (url + user['uid']) if url else None,
-            'icon_url': user['avatar_url'],
-        }
-
-
-    @property
-    def timestamp(self) -> datetime:
-        timestamp = int(self.json['post']['created_at'])
-        return datetime.fromtimestamp(timestamp).astimezone(timezone.utc)
-
-
-    @property
-    def time_since_posted(self) -> timedelta:
-        timenow = datetime.now().astimezone(timezone.utc)
-        return timenow - self.timestamp
-
-
-    @property
-    def description(self):
-        if 'description' in self._cache:
-            return self._cache['description']
-
-        if self.language == Lang.ZH:
-            title_trans = translate(self.title,
-                                    src='zh-cn', dest='en',
-                                    replacements=TRANSLATION_GLOSSARY)
-            self._cache['description'] = title_trans
-
-        else:
-            self._cache['description'] = None
-
-        return self._cache['description']
+    def __init__(self, language, **kwargs):
+        super().__init__(**kwargs)
+        self.language = language
+        # Translated title, filled in by MhyBbsMixin.translate_titles()
+        self.description = None
+
+
+    @classmethod
+    def from_json(cls, post_json):
+        """Builds a post from one item of the userPost API's data.list"""
+        language = FORUM_LANGUAGES.get(post_json['forum']['name'], Lang.EN)
+        post = post_json['post']
+        user = post_json['user']
+
+        articleid = str(post['post_id'])  # is a string-encoded int
+        article_stub = cls.ARTICLE_STUB.get(language)
+        user_stub = cls.USER_STUB.get(language)
+        images = post_json['image_list']
+
+        created_at = datetime.fromtimestamp(int(post['created_at']))
+        return cls(
+            language=language,
+            articleid=articleid,
+            title=post['subject'],
+            url=(article_stub + articleid) if article_stub else None,
+            timestamp=created_at.astimezone(timezone.utc),
+            author={
+                'name': user['nickname'],
+                'url': (user_stub + user['uid']) if user_stub else None,
+                'icon_url': user['avatar_url'],
+            },
+            image_url=images[0]['url'] if images else None,
+        )
 
 
     def to_embed(self, topic):
@@ -135,10 +107,6 @@ class MhyBbsPost:
             raise e
 
 
-    def __repr__(self):
-        return f'<MhyBbsPost {self.articleid}: {self.title}>'
-
-
 class MhyBbsMixin:
     """Mixin to be used with discord.ext.command.Cog"""
     @property
@@ -168,6 +136,7 @@ class MhyBbsMixin:
         if not channelids:
             log.info('New updates received on topic "%s", but no '
                      'subscribers to be notified.', self.topic)
+            await self.mark_seen(new_posts)
             return
 
 
@@ -177,51 +146,57 @@ class MhyBbsMixin:
 
         log.info('%s new posts for topic "%s"', len(posts), topic)
 
-        sendargs = [
-            dict(content=None, embed=post.to_embed(self.topic))
+        await self.translate_titles(posts)
+
+        messages = [
+            (post.articleid, dict(content=None, embed=post.to_embed(topic)))
             for post in posts
         ]
-        await pscog.push_to_topic(self.topic, sendargs)
+        await pscog.enqueue_to_topic(topic, messages)
+        await self.mark_seen(posts)
+
 
 
+    async def translate_titles(self, posts: Sequence[MhyBbsPost]) -> None:
+        """Sets the description of Chinese posts to their translated title
+
+        Titles that can't be translated in time are used as they are.
+        """
+        posts = [post for post in posts if post.language == Lang.ZH]
+        if not posts:
+            return
+
+        titles = await TRANSLATOR.translate_many(
+            [post.title for post in posts],
+            src='zh-cn', dest='en', glossary=GLOSSARY)
+        for post, title in zip(posts, titles):
+            post.description = title
+
 
     async def do_work(self) -> Sequence[MhyBbsPost]:
         #log.info(f'Checking "{self.topic}" for updates...')
-        json_responses = await self.pull()
+        pages = await self.pull()
 
         posts = []
 
-        for json in json_responses:
-            post_list = json['data']['list']
+        for page in pages:
+            post_list = json.loads(page.text)['data']['list']
 
             for data in post_list:
-                post = MhyBbsPost(data)
+                post = MhyBbsPost.from_json(data)
                 posts.append(post)
 
         if posts:
-            new_posts = self.filtered(posts)
+            new_posts = await self.unseen(posts)
             await self.handle_new_posts(new_posts)
 
+        self.commit_pages(pages)
         return True
 
 
-    def filtered(self,
-                 posts: Sequence[MhyBbsPost],
-                 cutoff_secs: int = TRACKER_UPDATE_INTERVAL_SECS):
-        new_posts = []
-        for post in posts:
-            time_delta = post.time_since_posted
-            time_delta_secs = time_delta.total_seconds()
-            if time_delta_secs < cutoff_secs:
-                new_posts.append(post)
-        return new_posts
-
-
     async def pull(self):
         urls = list(self.user_name_urls.values())
 
-        resps = []
-        for response in await self.batch_get_urls(self.bot.loop, *urls):
-            if response.status == 200:
-                resps.append(await response.json())
-        return resps
+        # Unchanged pages are left out, since they have no new posts
+        pages = await self.batch_get_changed(*urls)
+        return [page for page in pages if page is not None]
@@ -1,17 +1,137 @@
 from functools import partial
 from inspect import iscoroutinefunction
+from itertools import count
 import logging
+import re
+import time
+from typing import Mapping
+from weakref import WeakKeyDictionary
 
 from discord.ext import commands
 import psycopg2
 from psycopg2.extras import DictCursor
 
-from database import setup_pool, get_pool, close_pool
+from database import setup_pool, close_pool, acquire, METRICS
 
 
 log = logging.getLogger(__name__)
 
 
+# Connection -> set of statement names prepared in that connection's session.
+# Recycled connections drop out on their own, along with their statements.
+PREPARED_ON_CONN = WeakKeyDictionary()
+
+PLACEHOLDER_PATTERN = re.compile(r'%s')
+
+# Rows fetched per round trip by db_query_generating()
+STREAM_FETCH_SIZE = 500
+# Cursor names only need to be unique within a transaction, but a process-wide
+# counter keeps them unique in logs too
+STREAM_CURSOR_IDS = count(1)
+
+
+def to_server_placeholders(sql: str) -> str:
+    """Rewrites psycopg2 %s placeholders to $1, $2... for PREPARE"""
+    if '%(' in sql:
+        raise ValueError('prepared statements only support positional %s '
+                         'placeholders, not named ones')
+    counter = iter(range(1, sql.count('%s') + 1))
+    return PLACEHOLDER_PATTERN.sub(lambda _: f'${next(counter)}', sql)
+
+
+async def timed_execute(cur, *args, **kwargs):
+    """cur.execute(), recording the query latency in database.METRICS"""
+    start = time.perf_counter()
+    failed = True
+    try:
+        await cur.execute(*args, **kwargs)
+        failed = False
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        METRICS.observe_query(elapsed_ms, failed)
+
+
+async def fetch_all(cur):
+    """Reads all rows from an executed cursor, or [] if it has no results"""
+    rows = []
+    try:
+        async for row in cur:
+            rows.append(row)
+    except psycopg2.ProgrammingError:
+        # No results
+        pass
+    return rows
+
+
+def mogrify_many(conn, sql, seq_of_params) -> str:
+    """Binds each set of params into sql, joined into one query string
+
+    Binding happens client-side on a plain psycopg2 cursor, which needs no
+    round trip, so the whole batch can be sent with a single execute().
+    """
+    raw_cur = conn.raw.cursor()
+    try:
+        statements = [raw_cur.mogrify(sql, params).decode(conn.raw.encoding)
+                      for params in seq_of_params]
+    finally:
+        raw_cur.close()
+    return '\n'.join(stmt.rstrip().rstrip(';') + ';' for stmt in statements)
+
+
+class Transaction:
+    """Async context manager running statements in a single transaction
+
+    All statements go through one connection. The transaction commits when
+    the block exits normally and rolls back if it raises.
+
+    Example:
+        async with self.db_transaction() as tx:
+            await tx.execute('DELETE FROM t WHERE id = %s', [1])
+            await tx.execute('INSERT INTO t (id) VALUES (%s)', [1])
+    """
+    def __init__(self, cursor_factory=None):
+        self.cursor_factory = cursor_factory
+        self._acquire = None
+        self.conn = None
+        self.cur = None
+
+
+    async def __aenter__(self):
+        self._acquire = acquire()
+        self.conn = await self._acquire.__aenter__()
+        try:
+            self.cur = await self.conn.cursor(
+                cursor_factory=self.cursor_factory)
+            await self.cur.execute('BEGIN;')
+        except BaseException as e:
+            await self._acquire.__aexit__(type(e), e, e.__traceback__)
+            raise
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.cur.execute('ROLLBACK;' if exc_type else 'COMMIT;')
+        finally:
+            self.cur.close()
+            await self._acquire.__aexit__(exc_type, exc, tb)
+
+
+    async def execute(self, *args, **kwargs):
+        """Executes a statement in the transaction, returning any rows"""
+        await timed_execute(self.cur, *args, **kwargs)
+        return await fetch_all(self.cur)
+
+
+    async def executemany(self, sql, seq_of_params):
+        """Executes sql once per set of params, in one round trip"""
+        seq_of_params = list(seq_of_params)
+        if not seq_of_params:
+            return
+        batch = mogrify_many(self.conn, sql, seq_of_params)
+        await timed_execute(self.cur, batch)
+
+
 class DatabaseCogMixin:
     """Singleton-like Cog mixin for acquiring connections to the app database.
 
@@ -19,10 +139,26 @@ class DatabaseCogMixin:
     only. Its basic purpose is to provide bindings to modules that interface
     the app database, as well as to automatically setup and teardown the
     connection pool when the cog is loaded/unloaded.
+
+    Hot statements can be declared once in db_statements, which maps names to
+    SQL using positional %s placeholders. They are run with
+    db_execute_prepared() and db_query_prepared(), which PREPARE each
+    statement once per connection and EXECUTE it thereafter, so the server
+    skips parsing and planning on repeat calls.
     """
+    db_statements: Mapping[str, str] = {}
+
     def __init__(self):
         self._after_setup_pool = []
 
+        # Statement names are shared by all cogs on a connection, so they are
+        # namespaced by cog class
+        prefix = type(self).__name__.lower()
+        self._prepared_sql = {
+            name: (f'{prefix}_{name}', to_server_placeholders(sql))
+            for name, sql in self.db_statements.items()
+        }
+
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -50,10 +186,9 @@ class DatabaseCogMixin:
     async def db_execute(self, *args, **kwargs):
         """Shorthand to plainly execute a statement to the database"""
         rows = []
-        pool = await get_pool()
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(*args, **kwargs)
+                await timed_execute(cur, *args, **kwargs)
                 try:
                     async for row in cur:
                         rows.append(row)
@@ -66,10 +201,9 @@ class DatabaseCogMixin:
     async def db_query(self, *args, **kwargs):
         """Similar to db_execute(), but uses a DictCursor for reading"""
         rows = []
-        pool = await get_pool()
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             async with conn.cursor(cursor_factory=DictCursor) as cur:
-                await cur.execute(*args, **kwargs)
+                await timed_execute(cur, *args, **kwargs)
                 try:
                     async for row in cur:
                         rows.append(row)
@@ -79,18 +213,106 @@ class DatabaseCogMixin:
         return rows
 
 
-    async def db_query_generating(self, *args, **kwargs):
-        """Similar to db_query(), but yields rows instead of returning list"""
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            async with conn.cursor(cursor_factory=DictCursor) as cur:
-                await cur.execute(*args, **kwargs)
+    def db_transaction(self, dict_rows=False):
+        """Async context manager for running statements in one transaction
+
+        See cogs.mixins.Transaction. Rows returned by tx.execute() are
+        DictRows if dict_rows is True.
+        """
+        return Transaction(DictCursor if dict_rows else None)
+
+
+    async def db_executemany(self, sql, seq_of_params):
+        """Executes sql once for each set of params, atomically.
+
+        All the statements are bound client-side and sent as one query
+        string, which Postgres runs as a single implicit transaction, so this
+        takes one round trip no matter how many sets of params there are.
+        """
+        seq_of_params = list(seq_of_params)
+        if not seq_of_params:
+            return
+
+        async with acquire() as conn:
+            async with conn.cursor() as cur:
+                batch = mogrify_many(conn, sql, seq_of_params)
+                await timed_execute(cur, batch)
+
+
+    async def _run_prepared(self, name, params=(), cursor_factory=None):
+        try:
+            server_name, sql = self._prepared_sql[name]
+        except KeyError:
+            raise ValueError(f'no statement named "{name}" in '
+                             f'{type(self).__name__}.db_statements')
+
+        placeholders = ', '.join(['%s'] * len(params))
+        execute = f'EXECUTE {server_name}'
+        if params:
+            execute += f' ({placeholders})'
+
+        rows = []
+        async with acquire() as conn:
+            prepared = PREPARED_ON_CONN.setdefault(conn, set())
+            async with conn.cursor(cursor_factory=cursor_factory) as cur:
+                if server_name not in prepared:
+                    await cur.execute(f'PREPARE {server_name} AS {sql}')
+                    prepared.add(server_name)
+
+                start = time.perf_counter()
+                await timed_execute(cur, execute, list(params))
+                METRICS.observe_statement(
+                    server_name, (time.perf_counter() - start) * 1000)
+
                 try:
                     async for row in cur:
-                        yield row
+                        rows.append(row)
                 except psycopg2.ProgrammingError:
                     # No results
                     pass
+        return rows
+
+
+    async def db_execute_prepared(self, name, params=()):
+        """Like db_execute(), but runs a statement from db_statements"""
+        return await self._run_prepared(name, params)
+
+
+    async def db_query_prepared(self, name, params=()):
+        """Like db_query(), but runs a statement from db_statements"""
+        return await self._run_prepared(name, params, DictCursor)
+
+
+    async def db_query_generating(self,
+                                  query,
+                                  params=None,
+                                  fetch_size=STREAM_FETCH_SIZE):
+        """Similar to db_query(), but streams rows instead of returning list
+
+        The query runs behind a server-side cursor, and rows are fetched
+        fetch_size at a time as they are consumed, so memory use is bounded
+        by fetch_size and the first rows arrive before the whole result set
+        has been produced. query must be a single SELECT (or VALUES) query.
+
+        The cursor lives in a transaction that holds its connection until the
+        generator is exhausted. If you stop iterating early, call aclose() on
+        the generator to hand the connection back promptly.
+        """
+        name = f'stream_{next(STREAM_CURSOR_IDS)}'
+        query = query.strip().rstrip(';')
+
+        async with self.db_transaction(dict_rows=True) as tx:
+            await timed_execute(tx.cur,
+                                f'DECLARE {name} NO SCROLL CURSOR FOR {query}',
+                                params)
+            fetch = f'FETCH FORWARD {int(fetch_size)} FROM {name}'
+            while True:
+                rows = await tx.execute(fetch)
+                for row in rows:
+                    yield row
+                if len(rows) < fetch_size:
+                    break
+            await tx.execute(f'CLOSE {name}')
 
 # class SomeCog(DatabaseCogMixin, commands.Cog):
 #     @commands.Cog.listener()
@@ -0,0 +1,353 @@
+"""outbound.py
+
+OutboundQueue is a durable queue of tracker announcements, kept in the
+outbound_messages table (see database/schema_outbound.sql).
+
+Trackers enqueue one row per message per subscribed channel, keyed by
+(topic, articleid, channelid). A worker claims due rows in batches and sends
+them with the DeliveryEngine. Delivered rows move their key to outbound_sent,
+so the same article is never enqueued twice for a channel. Failed rows are
+retried with exponential backoff, and moved to outbound_deadletter once they
+run out of attempts.
+
+Claiming a row pushes its next_attempt forward by a lease, so rows held by a
+worker that dies mid-send become due again once the lease runs out. Delivery
+is therefore at-least-once: a crash between sending and marking a row as sent
+can repeat that one message after restart.
+"""
+
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import logging
+from typing import Sequence, Tuple
+
+from appconfig import DEBUGGING
+from .delivery import PrerenderedEmbed
+
+
+log = logging.getLogger(__name__)
+
+
+# Max rows claimed and sent per pass
+OUTBOUND_BATCH_SIZE = 50
+# Secs between passes when nothing new is enqueued
+OUTBOUND_POLL_SECS = 30
+# Secs a claimed row is held before another pass may claim it again
+OUTBOUND_LEASE_SECS = 300
+# Attempts before a message is moved to the dead-letter table
+OUTBOUND_MAX_ATTEMPTS = 5
+# Backoff (in secs) after the first failed attempt; doubles on each attempt
+OUTBOUND_RETRY_BASE_SECS = 60
+# Days to remember delivered keys for
+OUTBOUND_SENT_RETENTION_DAYS = 30
+# Secs between prunes of delivered keys
+OUTBOUND_PRUNE_INTERVAL_SECS = 60 * 60
+
+
+def serialize_sendkwargs(kwargs: dict) -> dict:
+    """Converts channel.send() kwargs to a JSON-serializable dict
+
+    The embed may be a discord.Embed or a PrerenderedEmbed.
+    """
+    embed = kwargs.get('embed')
+    return {
+        'content': kwargs.get('content'),
+        'embed': embed.to_dict() if embed else None,
+    }
+
+
+def deserialize_sendkwargs(payload: dict) -> dict:
+    """Inverse of serialize_sendkwargs(), with the embed left as a dict"""
+    embed = payload.get('embed')
+    return dict(content=payload.get('content'),
+                embed=PrerenderedEmbed(embed) if embed else None)
+
+
+class OutboundQueue:
+    def __init__(self, pscog):
+        """
+        Arguments:
+        pscog - the PublishSubscribe cog, used for database access, channel
+                lookup and delivery
+        """
+        self.pscog = pscog
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._last_prune = None
+
+
+    def start(self):
+        if not self._task:
+            self._task = self.pscog.bot.loop.create_task(self.run())
+
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+    async def enqueue(self,
+                      topic: str,
+                      channelids: Sequence[Tuple[int, str]],
+                      messages: Sequence[Tuple[str, dict]]) -> int:
+        """Enqueues every message for every channel, returning rows added
+
+        Arguments:
+        channelids - (channelId, channelName) tuples
+        messages - (articleid, sendkwargs) tuples, in send order
+
+        Messages already queued, or already delivered, for a channel are
+        skipped.
+        """
+        cids = [cid for cid, _ in channelids]
+        if not cids or not messages:
+            return 0
+
+        # Each message is serialized once, then crossed with the channels in
+        # the database; ids follow message order so each channel gets the
+        # messages in order
+        now = datetime.utcnow()
+        payloads = [
+            {
+                'articleid': str(articleid),
+                'payload': serialize_sendkwargs(kwargs),
+            }
+            for articleid, kwargs in messages
+        ]
+
+        query = """
+            INSERT INTO outbound_messages
+                (topic, articleid, channelid, payload, next_attempt, tstamp)
+            SELECT %s, m.articleid, c.channelid, m.payload, %s, %s
+            FROM ROWS FROM (
+                    json_to_recordset(%s) AS (articleid text, payload json)
+                ) WITH ORDINALITY AS m(articleid, payload, ord)
+                CROSS JOIN unnest(%s::bigint[]) AS c(channelid)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM outbound_sent s
+                WHERE s.topic = %s
+                    AND s.articleid = m.articleid
+                    AND s.channelid = c.channelid
+            )
+            ORDER BY m.ord, c.channelid
+            ON CONFLICT (topic, articleid, channelid) DO NOTHING
+            RETURNING id;"""
+        added = await self.pscog.db_execute(
+            query, [topic, now, now, json.dumps(payloads), cids, topic])
+
+        if added:
+            self._wakeup.set()
+        return len(added)
+
+
+    async def run(self):
+        """Drains the queue until cancelled"""
+        while True:
+            try:
+                drained = await self.drain_once()
+                await self.prune_if_due()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                if DEBUGGING:
+                    raise
+                log.error('outbound: pass failed (%s: %s)',
+                          e.__class__.__name__, e)
+                drained = 0
+
+            if drained >= OUTBOUND_BATCH_SIZE:
+                # There may be more rows due
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       OUTBOUND_POLL_SECS)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def drain_once(self) -> int:
+        """Claims due rows and sends them, returning the number claimed"""
+        now = datetime.utcnow()
+        query = """
+            UPDATE outbound_messages SET next_attempt = %s
+            WHERE id IN (
+                SELECT id FROM outbound_messages
+                WHERE next_attempt <= %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, topic, articleid, channelid, payload, attempts;"""
+        lease = now + timedelta(seconds=OUTBOUND_LEASE_SECS)
+        rows = await self.pscog.db_query(
+            query, [lease, now, OUTBOUND_BATCH_SIZE])
+        if not rows:
+            return 0
+
+        # Each channel gets its messages in the order they were enqueued
+        by_channel = defaultdict(list)
+        for row in sorted(rows, key=lambda r: r['id']):
+            by_channel[row['channelid']].append(row)
+
+        batches, batch_rows = [], []
+        failed = []
+        # A message queued for many channels is rendered once per pass
+        rendered = {}
+        for cid, crows in by_channel.items():
+            channel = self.pscog.bot.get_channel(cid)
+            if not channel:
+                failed.extend((row, 'channel not found') for row in crows)
+                continue
+            messages = [(row['topic'], self.render(row, rendered))
+                        for row in crows]
+            batches.append((cid, str(channel), channel, messages))
+            batch_rows.append(crows)
+
+        results = await self.pscog.delivery.deliver_batches(batches)
+
+        sent_ids = []
+        for crows, errors in zip(batch_rows, results):
+            for row, error in zip(crows, errors):
+                if error is None:
+                    sent_ids.append(row['id'])
+                else:
+                    failed.append((row, f'{error.__class__.__name__}: '
+                                        f'{error}'))
+
+        await self.mark_sent(sent_ids)
+        await self.mark_failed(failed)
+        return len(rows)
+
+
+    @staticmethod
+    def render(row, rendered: dict) -> dict:
+        key = (row['topic'], row['articleid'])
+        if key not in rendered:
+            rendered[key] = deserialize_sendkwargs(row['payload'])
+        return rendered[key]
+
+
+    async def mark_sent(self, ids):
+        if not ids:
+            return
+        query = """
+            WITH done AS (
+                DELETE FROM outbound_messages
+                WHERE id = ANY(%s)
+                RETURNING topic, articleid, channelid
+            )
+            INSERT INTO outbound_sent (topic, articleid, channelid, tstamp)
+            SELECT topic, articleid, channelid, %s FROM done
+            ON CONFLICT (topic, articleid, channelid) DO NOTHING;"""
+        await self.pscog.db_execute(query, [ids, datetime.utcnow()])
+
+
+    async def mark_failed(self, failed):
+        if not failed:
+            return
+
+        now = datetime.utcnow()
+        retries, dead = [], []
+        for row, error in failed:
+            attempts = row['attempts'] + 1
+            if attempts >= OUTBOUND_MAX_ATTEMPTS:
+                dead.append({'id': row['id'], 'error': error})
+                log.warning('outbound: dead-lettered %s/%s for channel id: %s '
+                            'after %s attempts (%s)', row['topic'],
+                            row['articleid'], row['channelid'], attempts,
+                            error)
+                continue
+            backoff = OUTBOUND_RETRY_BASE_SECS * 2 ** (attempts - 1)
+            retries.append({
+                'id': row['id'],
+                'error': error,
+                'next_attempt': (now + timedelta(seconds=backoff)).isoformat(),
+            })
+
+        async with self.pscog.db_transaction() as tx:
+            if retries:
+                await tx.execute(
+                    """UPDATE outbound_messages o SET
+                           attempts = o.attempts + 1,
+                           lasterror = f.error,
+                           next_attempt = f.next_attempt
+                       FROM json_to_recordset(%s)
+                           AS f(id bigint, error text,
+                                next_attempt timestamp)
+                       WHERE o.id = f.id;""",
+                    [json.dumps(retries)])
+            if dead:
+                await tx.execute(
+                    """WITH dead AS (
+                           DELETE FROM outbound_messages o
+                           USING json_to_recordset(%s)
+                               AS f(id bigint, error text)
+                           WHERE o.id = f.id
+                           RETURNING o.topic, o.articleid, o.channelid,
+                                     o.payload, o.attempts + 1 AS attempts,
+                                     f.error
+                       )
+                       INSERT INTO outbound_deadletter
+                           (topic, articleid, channelid, payload, attempts,
+                            lasterror, tstamp)
+                       SELECT topic, articleid, channelid, payload, attempts,
+                              error, %s
+                       FROM dead
+                       ON CONFLICT (topic, articleid, channelid) DO UPDATE SET
+                           payload = EXCLUDED.payload,
+                           attempts = EXCLUDED.attempts,
+                           lasterror = EXCLUDED.lasterror,
+                           tstamp = EXCLUDED.tstamp;""",
+                    [json.dumps(dead), now])
+
+
+    async def prune_if_due(self):
+        now = datetime.utcnow()
+        if (self._last_prune
+                and (now - self._last_prune).total_seconds()
+                    < OUTBOUND_PRUNE_INTERVAL_SECS):
+            return
+        self._last_prune = now
+
+        cutoff = now - timedelta(days=OUTBOUND_SENT_RETENTION_DAYS)
+        await self.pscog.db_execute(
+            'DELETE FROM outbound_sent WHERE tstamp < %s;', [cutoff])
+
+
+    async def requeue_dead(self) -> int:
+        """Moves all dead-lettered messages back into the queue"""
+        query = """
+            WITH revived AS (
+                DELETE FROM outbound_deadletter
+                RETURNING topic, articleid, channelid, payload
+            )
+            INSERT INTO outbound_messages
+                (topic, articleid, channelid, payload, next_attempt, tstamp)
+            SELECT topic, articleid, channelid, payload, %s, %s FROM revived
+            ON CONFLICT (topic, articleid, channelid) DO NOTHING
+            RETURNING id;"""
+        now = datetime.utcnow()
+        rows = await self.pscog.db_execute(query, [now, now])
+        if rows:
+            self._wakeup.set()
+        return len(rows)
+
+
+    async def report(self) -> str:
+        query = """
+            SELECT
+                (SELECT count(*) FROM outbound_messages) AS pending,
+                (SELECT count(*) FROM outbound_messages
+                 WHERE attempts > 0) AS retrying,
+                (SELECT count(*) FROM outbound_deadletter) AS dead;"""
+        rows = await self.pscog.db_query(query)
+        row = rows[0]
+        return (f'pending: {row["pending"]} (retrying {row["retrying"]})\n'
+                f'dead-lettered: {row["dead"]}')
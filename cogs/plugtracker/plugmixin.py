@@ -1,94 +1,80 @@
-import datetime
 import re
 import logging
-from typing import Mapping, Sequence
+from typing import Mapping, Optional, Sequence
 
-from bs4 import BeautifulSoup
 from discord import Embed
 from discord.ext import commands
-import parsedatetime
 
-from cogs.tracking.config import TRACKER_UPDATE_INTERVAL_SECS
+from cogs.tracking.parsing import Field, ItemRules, parse_items, register_rules
+from cogs.tracking.post import TrackerPost, require_fields
+
+from .plugtime import parse_time
 
 
 Url = str
 
 
-calendar = parsedatetime.Calendar()
 log = logging.getLogger(__name__)
 
 
-
-class PlugPost(object):
-    PLUG_STUB = 'https://www.plug.game'
-
-    def __init__(self, post_div_soup, forum_name, forum_url):
-        self.soup = post_div_soup
-        self.forum_name = forum_name
-        self.forum_url = forum_url
-
-
-    @property
-    def articleid(self):
-        return self.soup['data-articleid']
-
-
-    @property
-    def title(self):
-        return self.soup.find(class_='tit_feed').text.strip()
-
-
-    @property
-    def url(self):
-        return self.soup.find(class_='link_rel').attrs['data-url']
+PLUG_RULES = register_rules('plug', ItemRules(
+    items='.frame_plug',
+    fields={
+        'articleid': Field(attr='data-articleid'),
+        'title': Field('.tit_feed'),
+        'url': Field('.link_rel', attr='data-url'),
+        'image_style': Field('.img', attr='style'),
+        'author_name': Field('.name', collapse=True),
+        'author_href': Field('.name', attr='href'),
+        'author_icon': Field('.thumb', attr='src'),
+        'time': Field('.time', index=1),
+    },
+    page_fields={
+        'forum_name': Field('h2.tit_board'),
+    },
+))
 
 
-    @property
-    def image_url(self):
-        img = self.soup.find(class_='img')
-        if not img:
-            return None
+def parse_image_url(style) -> Optional[Url]:
+    if not style:
+        return None
 
-        found = re.search(r'url\((.+)\)$', img['style'])
-        return found.groups()[0] if found else None
+    found = re.search(r'url\((.+)\)$', style)
+    return found.groups()[0] if found else None
 
 
-    @property
-    def author(self):
-        return {
-            'name': ' '.join(self.soup.find(class_='name').text.split()),
-            'url': self.PLUG_STUB + self.soup.find(class_='name')['href'],
-            'icon_url': self.soup.find(class_='thumb')['src'],
-        }
+class PlugPost(TrackerPost):
+    """A post on a plug.game forum page"""
+    __slots__ = ('forum_name', 'forum_url')
 
+    PLUG_STUB = 'https://www.plug.game'
 
-    @property
-    def timestamp(self) -> datetime.datetime:
-        def parse_time(time_str):
-            for short, full in [
-                ('mins', 'min'),
-                ('hr', 'hour'),
-                ('wk', 'week'),
-                ('yr', 'year'),
-            ]:
-                time_str = time_str.replace(f' {short}s ', f' {full}s ')
-                time_str = time_str.replace(f' {short} ', f' {full} ')
-            # From https://stackoverflow.com/questions/2720319/
-            # Find local tz
-            now = datetime.datetime.now(datetime.timezone.utc)
-            localtz = now.astimezone().tzinfo
-            # Parse with parsedatetime NLP
-            dt, _ = calendar.parseDT(datetimeString=time_str, tzinfo=localtz)
-            # Convert to UTC time, then ISO8601 format
-            utc = dt.astimezone(datetime.timezone.utc)
-            return utc
-        return parse_time(self.soup.find_all(class_='time')[1].text)
+    def __init__(self, forum_name, forum_url, **kwargs):
+        super().__init__(**kwargs)
+        self.forum_name = forum_name
+        self.forum_url = forum_url
 
 
-    @property
-    def time_since_posted(self) -> datetime.timedelta:
-        timenow = datetime.datetime.now().astimezone(datetime.timezone.utc)
-        return timenow - self.timestamp
+    @classmethod
+    def from_fields(cls, fields, forum_name, forum_url):
+        """Builds a post from the fields extracted with PLUG_RULES"""
+        require_fields(fields, 'articleid', 'title', 'url', 'time')
+        # Embed.set_author() takes missing values as the string 'None'
+        author = {'name': fields['author_name']}
+        if fields['author_href']:
+            author['url'] = cls.PLUG_STUB + fields['author_href']
+        if fields['author_icon']:
+            author['icon_url'] = fields['author_icon']
+        return cls(
+            forum_name=forum_name,
+            forum_url=forum_url,
+            articleid=fields['articleid'],
+            title=fields['title'],
+            url=fields['url'],
+            timestamp=parse_time(fields['time']),
+            author=author,
+            image_url=parse_image_url(fields['image_style']),
+        )
 
 
     def to_embed(self, topic):
@@ -115,10 +101,6 @@ class PlugPost(object):
             raise e
 
 
-    def __repr__(self):
-        return f'<PlugPost {self.articleid}: {self.title}>'
-
-
 class PlugMixin:
     """Mixin to be used with discord.ext.command.Cog"""
     @property
@@ -140,6 +122,7 @@ class PlugMixin:
         if not channelids:
             log.info(f'New updates received on topic "{self.topic}", but no '
                      f'subscribers to be notified.')
+            await self.mark_seen(new_posts)
             return
 
 
@@ -150,11 +133,12 @@ class PlugMixin:
         s = 's' if len(posts) != 1 else ''
         log.info(f'{len(posts)} new posts for topic "{topic}"')
 
-        sendargs = [
-            dict(content=None, embed=post.to_embed(self.topic))
+        messages = [
+            (post.articleid, dict(content=None, embed=post.to_embed(topic)))
             for post in posts
         ]
-        await pscog.push_to_topic(self.topic, sendargs)
+        await pscog.enqueue_to_topic(topic, messages)
+        await self.mark_seen(posts)
 
 
 
@@ -165,43 +149,33 @@ class PlugMixin:
         posts = []
 
         for page in pages:
-            soup = BeautifulSoup(page, 'html.parser')
+            page_fields, post_fields = parse_items(page.text, PLUG_RULES)
 
-            forum_name = soup.find('h2', class_='tit_board').text.strip()
+            forum_name = page_fields['forum_name']
             forum_url = self.plug_forum_name_urls.get(forum_name)
 
-            post_divs = soup.find_all(class_='frame_plug')
-
-            # log.info(f'Forum: {forum_name} - {len(post_divs)} posts')
+            # log.info(f'Forum: {forum_name} - {len(post_fields)} posts')
 
-            for div in post_divs:
-                post = PlugPost(div, forum_name, forum_url)
+            for fields in post_fields:
+                try:
+                    post = PlugPost.from_fields(fields, forum_name, forum_url)
+                except ValueError as e:
+                    log.warning('Skipped post %s in %s (%s)',
+                                fields['articleid'], forum_url, e)
+                    continue
                 posts.append(post)
 
         if posts:
-            new_posts = self.filtered(posts)
+            new_posts = await self.unseen(posts)
             await self.handle_new_posts(new_posts)
 
+        self.commit_pages(pages)
         return True
 
 
-    def filtered(self,
-                 posts: Sequence[PlugPost],
-                 cutoff_secs: int = TRACKER_UPDATE_INTERVAL_SECS):
-        new_posts = []
-        for post in posts:
-            time_delta = post.time_since_posted
-            time_delta_secs = time_delta.total_seconds()
-            if time_delta_secs < cutoff_secs:
-                new_posts.append(post)
-        return new_posts
-
-
     async def pull_forum_pages(self):
         urls = list(self.plug_forum_name_urls.values())
 
-        resps = []
-        for response in await self.batch_get_urls(self.bot.loop, *urls):
-            resps.append(await response.text())
-
-        return resps
+        # Unchanged pages are left out, since they have no new posts
+        pages = await self.batch_get_changed(*urls)
+        return [page for page in pages if page is not None]
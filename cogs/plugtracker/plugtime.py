@@ -0,0 +1,128 @@
+"""plugtime.py
+
+Parses the post times shown on plug.game, like '5 mins ago' or '2020.05.03'.
+
+plug.game only shows a few formats, so those are matched with precompiled
+regexes. Anything else falls back to parsedatetime, which understands far more
+but is much slower, since it runs its whole grammar on every string.
+
+To compare the two on typical inputs:
+
+    python -m cogs.plugtracker.plugtime
+"""
+
+import datetime
+import re
+import timeit
+from typing import Optional
+
+import parsedatetime
+
+
+calendar = parsedatetime.Calendar()
+
+UTC = datetime.timezone.utc
+
+# Secs per unit, in the order of the unit groups in RELATIVE_PATTERN
+UNIT_SECS = (
+    1,                  # sec
+    60,                 # min
+    60 * 60,            # hr
+    24 * 60 * 60,       # day
+    7 * 24 * 60 * 60,   # wk
+)
+
+# '5 mins ago', 'an hour ago', '1 wk ago'
+RELATIVE_PATTERN = re.compile(
+    r'^\s*(\d+|an?|one)\s+'
+    r'(?:(sec)(?:ond)?|(min)(?:ute)?|(hr|hour)|(day)|(wk|week))s?'
+    r'\s+ago\s*$',
+    re.I)
+
+# 'just now', 'a moment ago'
+NOW_PATTERN = re.compile(r'^\s*(?:just now|now|a moment ago)\s*$', re.I)
+
+# '2020.05.03', '2020-05-03', '2020/05/03'
+DATE_PATTERN = re.compile(r'^\s*(\d{4})[./-](\d{1,2})[./-](\d{1,2})\.?\s*$')
+
+
+def parse_fast(time_str: str,
+               now: datetime.datetime = None) -> Optional[datetime.datetime]:
+    """Parses the formats plug.game shows to UTC, or returns None"""
+    now = now or datetime.datetime.now(UTC)
+
+    match = RELATIVE_PATTERN.match(time_str)
+    if match:
+        count, *units = match.groups()
+        count = int(count) if count.isdigit() else 1
+        unit = next(i for i, u in enumerate(units) if u)
+        return now - datetime.timedelta(seconds=count * UNIT_SECS[unit])
+
+    if NOW_PATTERN.match(time_str):
+        return now
+
+    match = DATE_PATTERN.match(time_str)
+    if match:
+        try:
+            date = datetime.datetime(*map(int, match.groups()))
+        except ValueError:
+            return None
+        # Dates are midnight in local time, like parsedatetime reads them
+        return date.astimezone(UTC)
+
+    return None
+
+
+def parse_slow(time_str: str) -> datetime.datetime:
+    """Parses any time parsedatetime understands to UTC"""
+    # Pad so abbreviations at either end still match below
+    time_str = f' {time_str} '
+    for short, full in [
+        ('mins', 'min'),
+        ('hr', 'hour'),
+        ('wk', 'week'),
+        ('yr', 'year'),
+    ]:
+        time_str = time_str.replace(f' {short}s ', f' {full}s ')
+        time_str = time_str.replace(f' {short} ', f' {full} ')
+    # From https://stackoverflow.com/questions/2720319/
+    # Find local tz
+    now = datetime.datetime.now(UTC)
+    localtz = now.astimezone().tzinfo
+    # Parse with parsedatetime NLP
+    dt, _ = calendar.parseDT(datetimeString=time_str, tzinfo=localtz)
+    return dt.astimezone(UTC)
+
+
+def parse_time(time_str: str) -> datetime.datetime:
+    """Parses the relative times on plug.game, like '5 mins ago', to UTC"""
+    return parse_fast(time_str) or parse_slow(time_str)
+
+
+SAMPLES = (
+    'just now',
+    '1 min ago',
+    '45 mins ago',
+    'an hour ago',
+    '3 hrs ago',
+    '1 day ago',
+    '6 days ago',
+    '2 wks ago',
+    '2020.05.03',
+)
+
+
+def main():
+    number = 2000
+    print(f'{"input":<14} {"fast":>8} {"slow":>8}  (us per call)')
+    for sample in SAMPLES:
+        fast = timeit.timeit(lambda: parse_fast(sample), number=number)
+        slow = timeit.timeit(lambda: parse_slow(sample), number=number)
+        drift = abs((parse_fast(sample) - parse_slow(sample)).total_seconds())
+        note = f'  (differs by {drift:.0f}s)' if drift > 60 else ''
+        print(f'{sample:<14} {fast / number * 1e6:8.1f} '
+              f'{slow / number * 1e6:8.1f}{note}')
+
+
+if __name__ == '__main__':
+    main()
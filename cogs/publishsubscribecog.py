@@ -1,11 +1,15 @@
+import asyncio
 from collections import defaultdict
 import logging
-from typing import List, Sequence, Set, Union
+from typing import Dict, List, Sequence, Set, Tuple, Union
 
-from discord import TextChannel, DMChannel, GroupChannel, DiscordException
+from discord import TextChannel, DMChannel, GroupChannel
 from discord.ext import commands
 import psycopg2
 
+from database import acquire
+from .delivery import DeliveryEngine
+from .outbound import OutboundQueue
 from .mixins import DatabaseCogMixin
 
 
@@ -18,18 +22,106 @@ ChannelIdentifier = Union[Channel, ChannelId]
 log = logging.getLogger(__name__)
 
 
+# Set True when several bot processes share the database, so subscription
+# changes made by one process are pushed to the others over LISTEN/NOTIFY.
+# This holds one pooled connection for the listener.
+SYNC_SUBSCRIPTIONS_ACROSS_PROCESSES = False
+NOTIFY_CHANNEL = 'topics_channels_changed'
+# Secs to wait before reconnecting the listener after it fails
+LISTEN_RETRY_SECS = 30
+
+
 class NotChannelError(ValueError):
     pass
 
 
 class PublishSubscribe(DatabaseCogMixin, commands.Cog):
     """The interface between channel subscribes and updates from TrackerCogs"""
+    db_statements = {
+        'channels_by_topic': """
+            SELECT channelid, channelname
+            FROM topics_channels
+            WHERE topic = %s AND isactive = %s;""",
+    }
 
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
         self.topics = defaultdict(list)
 
+        # In-memory copy of active topics_channels rows, so publishing does
+        # not need to hit the database:
+        #   Mapping[topic, Mapping[channelId, channelName]]
+        self.subscriptions = defaultdict(dict)
+        self._subscriptions_loaded = False
+        self._listen_task = None
+        self.after_setup_pool(self.load_subscriptions)
+
+        self.delivery = DeliveryEngine()
+        self.outbound = OutboundQueue(self)
+        self.after_setup_pool(self.start_outbound)
+
+
+    def cog_unload(self):
+        if self._listen_task:
+            self._listen_task.cancel()
+        self.outbound.stop()
+        super().cog_unload()
+
+
+    async def load_subscriptions(self):
+        """Loads all active subscriptions into the in-memory index"""
+        query = """SELECT topic, channelid, channelname
+                   FROM topics_channels
+                   WHERE isactive = %s;"""
+        rows = await self.db_query(query, [True])
+
+        subscriptions = defaultdict(dict)
+        for row in rows:
+            subscriptions[row['topic']][row['channelid']] = row['channelname']
+        self.subscriptions = subscriptions
+        self._subscriptions_loaded = True
+        log.info('Loaded %s subscriptions across %s topics',
+                 len(rows), len(subscriptions))
+
+        if SYNC_SUBSCRIPTIONS_ACROSS_PROCESSES and not self._listen_task:
+            self._listen_task = self.bot.loop.create_task(
+                self.listen_for_changes())
+
+
+    async def start_outbound(self):
+        """Starts draining the outbound queue, resuming any unsent rows"""
+        self.outbound.start()
+
+
+    async def reload_topic(self, topic: str):
+        rows = await self.db_query_prepared('channels_by_topic',
+                                            [topic, True])
+        self.subscriptions[topic] = {
+            row['channelid']: row['channelname'] for row in rows
+        }
+
+
+    async def listen_for_changes(self):
+        """Reloads topics named in notifications from other processes"""
+        while True:
+            try:
+                async with acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(f'LISTEN {NOTIFY_CHANNEL};')
+                    log.info('Listening for subscription changes')
+                    while True:
+                        msg = await conn.notifies.get()
+                        await self.reload_topic(msg.payload)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                log.error('Subscription listener failed (%s: %s), retrying '
+                          'in %ss', e.__class__.__name__, e, LISTEN_RETRY_SECS)
+                await asyncio.sleep(LISTEN_RETRY_SECS)
+
 
     @property
     def _avail_keys_msg(self):
@@ -80,17 +172,10 @@ class PublishSubscribe(DatabaseCogMixin, commands.Cog):
             log.exception(exc)
             raise exc
 
-        query = """SELECT channelid, isactive
-                   FROM topics_channels
-                   WHERE topic = %s AND isactive = %s;"""
-
-        rows = await self.db_query(query, [topic, True])
+        if not self._subscriptions_loaded:
+            await self.load_subscriptions()
 
-        out = {
-            (row.get('channelid'), row.get('channelname'))
-            for row in rows
-        }
-        return out
+        return set(self.subscriptions[topic].items())
 
 
     async def get_topics_by_channel(
@@ -98,36 +183,49 @@ class PublishSubscribe(DatabaseCogMixin, commands.Cog):
 
         cid = self._to_channelid(channel)
 
-        query = """SELECT topic
-                   FROM topics_channels
-                   WHERE channelid = %s AND isactive = %s;"""
-
-        rows = await self.db_query(query, [cid, True])
-        if not rows:
-            return []
+        if not self._subscriptions_loaded:
+            await self.load_subscriptions()
 
-        return {row.get('topic') for row in rows}
+        return {topic
+                for topic, channels in self.subscriptions.items()
+                if cid in channels}
 
 
     async def push_to_topic(self,
                             topic: str,
-                            sendkwargs) -> Sequence[dict]:
+                            sendkwargs) -> Dict[ChannelId, list]:
+        """Sends each message in sendkwargs to every channel on the topic
 
+        Channels are sent to concurrently, each channel receiving the
+        messages in order. Returns Mapping[channelId, List[error]], with one
+        entry per message that is None if the message was delivered.
+        """
         cids = await self.get_channelids_by_topic(topic)
 
+        channels = []
         for cid, cname in cids:
             channel = self.bot.get_channel(cid)
             if not channel:
                 log.warning(f'invalid channel: {cname} id: {cid}')
                 continue
+            channels.append((cid, cname, channel))
+
+        return await self.delivery.deliver(topic, channels, sendkwargs)
 
-            for kwargs in sendkwargs:
-                try:
-                    await channel.send(**kwargs)
-                except DiscordException as e:
-                    args = ', '.join([f'{k}={v}' for k, v in kwargs.items()])
-                    msg = f'failed send({args}) to channel: {cname} id: {cid}'
-                    log.error(msg)
+
+    async def enqueue_to_topic(self,
+                               topic: str,
+                               messages: Sequence[Tuple[str, dict]]) -> int:
+        """Queues messages for every channel on the topic
+
+        Unlike push_to_topic(), messages are stored in the database before
+        they are sent, so they survive restarts and failed sends are retried.
+        Each message is an (articleid, sendkwargs) tuple; an article is only
+        ever delivered once to each channel. Returns the number of rows
+        queued.
+        """
+        cids = await self.get_channelids_by_topic(topic)
+        return await self.outbound.enqueue(topic, cids, messages)
 
 
     async def subscribe(self,
@@ -165,13 +263,28 @@ class PublishSubscribe(DatabaseCogMixin, commands.Cog):
                            )
                        VALUES (%s, %s, %s, %s, %s, %s);"""
 
-            for topic in topics:
-                await self.db_execute(
-                    query, [
+            # All topics are updated atomically, in one round trip
+            await self.db_executemany(
+                query, [
+                    [
                         cid, topic,
                         topic, cid, cname, guildid, guildname, isactive
                     ]
-                )
+                    for topic in topics
+                ]
+            )
+
+            # Keep the in-memory index in step with the table
+            for topic in topics:
+                if isactive:
+                    self.subscriptions[topic][cid] = cname
+                else:
+                    self.subscriptions[topic].pop(cid, None)
+
+            if SYNC_SUBSCRIPTIONS_ACROSS_PROCESSES:
+                await self.db_execute(
+                    'SELECT pg_notify(%s, t) FROM unnest(%s::text[]) AS t;',
+                    [NOTIFY_CHANNEL, list(topics)])
 
         except (NotChannelError, psycopg2.OperationalError) as e:
             log.exception('failed to subscribe/unsubscribe due to error')
@@ -223,6 +336,27 @@ class PublishSubscribe(DatabaseCogMixin, commands.Cog):
         await self.update_sub(ctx, False, *topics)
 
 
+    @commands.command(hidden=True)
+    async def deliverystats(self, ctx):
+        """Shows delivery counts and latencies per topic"""
+        if not await self.bot.is_owner(ctx.author):
+            return
+        await ctx.send(f'```\n{self.delivery.report()}```')
+
+
+    @commands.command(hidden=True)
+    async def outbox(self, ctx, action: str = None):
+        """Shows the outbound queue (to retry dead letters: !outbox requeue)
+        """
+        if not await self.bot.is_owner(ctx.author):
+            return
+        if action == 'requeue':
+            requeued = await self.outbound.requeue_dead()
+            await ctx.send(f'Requeued {requeued} dead-lettered messages.')
+            return
+        await ctx.send(f'```\n{await self.outbound.report()}```')
+
+
     @commands.command()
     async def tracking(self, ctx):
         """Shows the topics that this channel receives updates for"""
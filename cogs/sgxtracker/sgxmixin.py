@@ -1,65 +1,132 @@
 import datetime
 import json
 import logging
-from typing import Sequence
+from typing import Iterable, Iterator, List, Sequence, Tuple
 
-from bs4 import BeautifulSoup
 from discord import Embed
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import appconfig
+from cogs.tracking.config import TRACKER_MAX_POST_AGE_SECS
+from cogs.tracking.parsing import ScriptJson, register_rules
+from cogs.tracking.post import TrackerPost
+
 # from cogs.tracking.config import TRACKER_UPDATE_INTERVAL_SECS
 
 TRACKER_UPDATE_INTERVAL_SECS = 30 * 60  # every 30 min
 
+# When debugging, the page data is written here on every check
+DUMP_PATH = 'lastdump.json' if appconfig.DEBUGGING else None
+
 log = logging.getLogger(__name__)
 
+# author, accordion months
+Section = Tuple[str, List[dict]]
 
 
-class SgxResearchPost:
-    page_name = 'Analyst Research'
-    page_url = 'https://www.sgx.com/research-education/analyst-research'
-    page_thumbnail = 'https://mylogin.sgx.com/mylogin/XUI/images/sgx-logo.png'
+# SGX stores page data in a json payload stashed in a <script> tag
+SGX_PAGE_DATA = register_rules('sgx', ScriptJson(
+    markers=('.pdf', 'download'),
+    prefix='window._sgxComApp_pageData = ',
+))
 
-    def __init__(self, json_data):
-        # json_data is a dict with these keys:
-        #   label author mediaType name date url filemime
-        self.data = json_data
 
-    @property
-    def articleid(self):
-        unix_secs = int(self.timestamp.timestamp())
-        return f'{self.title}-{unix_secs}'
+# ijson prefixes of the parts of the page data that are read
+WIDGETS_PREFIX = 'data.route.data.data.widgets'
+SECTION_PREFIX = WIDGETS_PREFIX + '.item'
+AUTHOR_PREFIX = SECTION_PREFIX + '.data.title'
+MONTH_PREFIX = SECTION_PREFIX + '.data.accordionItems.item'
+MONTH_TITLE_PREFIX = MONTH_PREFIX + '.data.itemTitle'
 
-    @property
-    def title(self):
-        return self.data['label']
 
-    @property
-    def url(self):
-        return self.data['url']
+def month_is_stale(label: str, cutoff: datetime.datetime) -> bool:
+    """Whether an accordion month, like 'May 2020', ended before cutoff
 
-    @property
-    def image_url(self):
-        return self.page_thumbnail
+    Labels that can't be read are never stale.
+    """
+    for fmt in ('%B %Y', '%b %Y'):
+        try:
+            start = datetime.datetime.strptime(label.strip(), fmt)
+            break
+        except (AttributeError, ValueError):
+            continue
+    else:
+        return False
+
+    years, month = divmod(start.month, 12)
+    end = start.replace(year=start.year + years, month=month + 1)
+    return end < cutoff
+
+
+def stream_sections(js: str, cutoff: datetime.datetime) -> Iterator[Section]:
+    """Yields each section of the page data as it is parsed
+
+    Months are only built into objects if they aren't stale, and parsing
+    stops at the end of the widgets, so the rest of the payload is never read.
+    """
+    author, months = None, []
+    builder, skipping = None, False
+
+    # ijson reads bytes; str input is deprecated and slower
+    for prefix, event, value in ijson.parse(js.encode('utf-8'),
+                                            use_float=True):
+        if skipping or builder:
+            if prefix == MONTH_PREFIX and event == 'end_map':
+                if builder:
+                    builder.event(event, value)
+                    months.append(builder.value)
+                builder, skipping = None, False
+            elif (prefix == MONTH_TITLE_PREFIX
+                    and month_is_stale(value, cutoff)):
+                builder, skipping = None, True
+            elif builder:
+                builder.event(event, value)
+
+        elif prefix == MONTH_PREFIX and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+
+        elif prefix == AUTHOR_PREFIX and event == 'string':
+            author = value
+
+        elif prefix == SECTION_PREFIX and event == 'end_map':
+            yield author, months
+            author, months = None, []
+
+        elif prefix == WIDGETS_PREFIX and event == 'end_array':
+            return
 
-    @property
-    def author(self):
-        return {
-            'name': self.data['author'],
-        }
 
-    @property
-    def timestamp(self) -> datetime.datetime:
-        dt = datetime.datetime.fromtimestamp(self.data['date'])
-        return dt
+def dump_page_data(js: str):
+    with open(DUMP_PATH, 'w', encoding='utf8') as f:
+        f.write(js)
 
-    @property
-    def time_since_posted(self) -> datetime.timedelta:
-        utc = datetime.timezone.utc
-        timenow = datetime.datetime.now().astimezone(utc)
-        timestamp = self.timestamp.astimezone(utc)
-        diff = timenow - timestamp
-        # print(self.articleid, diff)
-        return diff
+
+class SgxResearchPost(TrackerPost):
+    __slots__ = ()
+
+    page_name = 'Analyst Research'
+    page_url = 'https://www.sgx.com/research-education/analyst-research'
+    page_thumbnail = 'https://mylogin.sgx.com/mylogin/XUI/images/sgx-logo.png'
+
+    @classmethod
+    def from_json(cls, json_data):
+        # json_data is a dict with these keys:
+        #   label author mediaType name date url filemime
+        timestamp = datetime.datetime.fromtimestamp(json_data['date'])
+        unix_secs = int(timestamp.timestamp())
+        return cls(
+            articleid=f'{json_data["label"]}-{unix_secs}',
+            title=json_data['label'],
+            url=json_data['url'],
+            timestamp=timestamp,
+            author={'name': json_data['author']},
+            image_url=cls.page_thumbnail,
+        )
 
     def to_embed(self, topic):
         try:
@@ -82,10 +149,6 @@ class SgxResearchPost:
             raise e
 
 
-    def __repr__(self):
-        return f'<SgxResearchPost {self.articleid}: {self.title}>'
-
-
 class SgxMixin:
     """Mixin to be used with discord.ext.command.Cog"""
 
@@ -111,6 +174,7 @@ class SgxMixin:
         if not channelids:
             log.info('New updates received on topic "%s", but no '
                      'subscribers to be notified.', self.topic)
+            await self.mark_seen(new_posts)
             return
 
 
@@ -121,45 +185,21 @@ class SgxMixin:
         s = 's' if len(posts) != 1 else ''
         log.info('%s new post%s for topic "%s"', len(posts), s, topic)
 
-        sendargs = [
-            dict(content=None, embed=post.to_embed(self.topic))
+        messages = [
+            (post.articleid, dict(content=None, embed=post.to_embed(topic)))
             for post in posts
         ]
-        await pscog.push_to_topic(self.topic, sendargs)
+        await pscog.enqueue_to_topic(topic, messages)
+        await self.mark_seen(posts)
 
 
     @classmethod
-    def get_json_data(cls, soup):
-        """SGX stores page data in a json payload stashed in a <script> tag
-
-        Their site app reads this data and renders to the page.
-        """
-        scripts = []
-        for script in map(str, soup.find_all('script')):
-            left = script.find('>') + 1
-            script = script[left:-9].strip()  # 9 == len('</script>')
-
-            if '.pdf' in script and 'download' in script:
-                scripts.append(script)
-
-        if not scripts:
-            return None
-        script = scripts[0]
+    def iter_sections(cls,
+                      page_data,
+                      cutoff: datetime.datetime = None) -> Iterator[Section]:
+        """Yields the author and months of each section of the page data
 
-        js = script[len('window._sgxComApp_pageData = '):-1]  # -1 is trailing ;
-        with open('lastdump.json', 'w', encoding='utf8') as f:
-            f.write(js)
-
-        obj = json.loads(js)
-        return obj
-
-
-    @classmethod
-    def read_page_data(cls, page_data):
-        """Parses the data from json into data for each post
-
-        Each month is extracted from the accordion and parsed into posts with
-        parse_accordion_month().
+        Months that ended before cutoff are left out.
 
         Structure (simplified):
             - section
@@ -171,16 +211,29 @@ class SgxMixin:
         content = page_data['data']['route']['data']['data']
         # page_title = content['title']
 
-        posts = []
         for section in content['widgets']:
             # 1 section => 1 author => 1 accordion => multiple months
             author = section['data']['title']  # Maybank Kim Eng Securities, etc
-            accordion = section['data'].get('accordionItems')
+            accordion = section['data'].get('accordionItems') or []
+            yield author, [
+                month for month in accordion
+                if not (cutoff and month_is_stale(
+                    month['data']['itemTitle'], cutoff))
+            ]
 
-            if not accordion:
+
+    @classmethod
+    def read_sections(cls, sections: Iterable[Section]) -> List[dict]:
+        """Parses each month of each section into posts
+
+        Each month is parsed with parse_accordion_month().
+        """
+        posts = []
+        for author, months in sections:
+            if not author:
                 continue
 
-            for month in accordion:
+            for month in months:
                 # Extend output posts with dlinfos for each month
                 dlinfos = cls.parse_accordion_month(author, month)
                 if not dlinfos:
@@ -237,43 +290,50 @@ class SgxMixin:
         posts = []
 
         for page in pages:
-            soup = BeautifulSoup(page, 'html.parser')
-
-            page_data = self.get_json_data(soup)
-            posts_data = self.read_page_data(page_data)
+            posts_data = await self.extract_posts_data(page.text)
 
             # posts_data is a List[dict] each with these keys:
             #   label author mediaType name date url filemime
 
             for dldata in posts_data:
-                post = SgxResearchPost(dldata)
+                post = SgxResearchPost.from_json(dldata)
                 posts.append(post)
 
         if posts:
-            new_posts = self.filtered(posts)
+            new_posts = await self.unseen(posts)
             await self.handle_new_posts(new_posts)
 
+        self.commit_pages(pages)
         return True
 
 
-    @classmethod
-    def filtered(cls,
-                 posts: Sequence[SgxResearchPost],
-                 cutoff_secs: int = TRACKER_UPDATE_INTERVAL_SECS):
-        new_posts = []
-        for post in posts:
-            time_delta = post.time_since_posted
-            time_delta_secs = time_delta.total_seconds()
-            if time_delta_secs < cutoff_secs:
-                new_posts.append(post)
-        return new_posts
+    async def extract_posts_data(self, page) -> List[dict]:
+        """Reads the posts in a page, skipping months too old to announce
+
+        The page data is stream-parsed if ijson is installed, otherwise it is
+        loaded whole.
+        """
+        js = SGX_PAGE_DATA.extract_text(page)
+        if js is None:
+            log.warning('No page data found on "%s" page', self.topic)
+            return []
+
+        if DUMP_PATH:
+            await self.bot.loop.run_in_executor(None, dump_page_data, js)
+
+        age = datetime.timedelta(seconds=TRACKER_MAX_POST_AGE_SECS)
+        cutoff = datetime.datetime.now() - age
+
+        if ijson:
+            sections = stream_sections(js, cutoff)
+        else:
+            sections = self.iter_sections(json.loads(js), cutoff)
+        return self.read_sections(sections)
 
 
     async def pull_pages(self):
         urls = list(self.sgx_page_name_urls.values())
 
-        resps = []
-        for response in await self.batch_get_urls(self.bot.loop, *urls):
-            resps.append(await response.text())
-
-        return resps
+        # Unchanged pages are left out, since they have no new posts
+        pages = await self.batch_get_changed(*urls)
+        return [page for page in pages if page is not None]
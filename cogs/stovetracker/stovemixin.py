@@ -2,129 +2,99 @@ import datetime
 import logging
 from typing import Mapping, Sequence
 
-from bs4 import BeautifulSoup
 from discord import Embed
 
-from cogs.tracking.config import TRACKER_UPDATE_INTERVAL_SECS
+from cogs.tracking.parsing import Field, ItemRules, parse_items, register_rules
+from cogs.tracking.post import TrackerPost, require_fields
 
 Url = str
 
 log = logging.getLogger(__name__)
 
 
-# Driver takes 30+ secs to get one page, so make the interval at least 60 secs
-# This should change when bulk fetch is implementated on SeleniumTrackerCog
-TRACKER_UPDATE_INTERVAL_SECS = max(60, TRACKER_UPDATE_INTERVAL_SECS)
-
-
-class StovePost(object):
-    def __init__(self, soup, forum_name, forum_url):
-        self.soup = soup
-        self.forum_name = forum_name
-        self.forum_url = forum_url
-
-        self._title = None
-        self._url = None
-        self._image_url = None
-        self._timestamp = None
-
-
-    @property
-    def articleid(self):
-        x = self.url.rsplit('/', 1) or [None]
-        return x[-1]
-
-
-    @property
-    def title(self):
-        if self._title:
-            return self._title
-        div = self.soup.find('div', class_='subject-txt')
-        self._title = div.text.strip()
-        return self._title
-
-
-    @property
-    def url(self):
-        if self._url:
-            return self._url
-        self._url = 'https:' + self.soup.find('a').attrs['href']
-        return self._url
-
-
-    @property
-    def image_url(self):
-        """Guess image using title so we avoid looking inside post html"""
-        if self._image_url:
-            return self._image_url
-
-        self._image_url = 'https://i.imgur.com/69UGmyY.png'  # 'Notice'
-
-        imgdict = {
-            '[Banned]':
-                'https://i.imgur.com/LPqrc7d.png',
-            '[Event]':
-                'https://i.imgur.com/6NU246G.png',
-            'Temporary Maintenance':
-                'https://i.imgur.com/5n67kHG.png',
-            'Update Content':
-                'https://i.imgur.com/MEnXL4G.png',
-            # 'Developer Note' is assigned in StoveMixin
-        }
-
-        for keyword, imgurl in imgdict.items():
-            if keyword in self.title:
-                self._image_url = imgurl
-
-        return self._image_url
-
-
-    @property
-    def author(self):
-        user = self.soup.find('div', class_='module-profile')
-
-        # url = user.attrs.get('href')
-        # # Monkey patch to fix weird Stove url
-        # if url.startswith('//www'):
-        #     url = 'https:' + url
-
-        return {
-            'name': user.find('span', class_='profile-name').text.strip(),
-            # 'url': url,
-            'icon_url': 'https:' + user.find('img').attrs.get('src'),
-        }
-
+STOVE_RULES = register_rules('stove', ItemRules(
+    items='ul.module-list li.list-item',
+    fields={
+        'title': Field('div.subject-txt'),
+        'href': Field('a', attr='href'),
+        'author_name': Field('div.module-profile span.profile-name'),
+        'author_icon': Field('div.module-profile img', attr='src'),
+        'time': Field('span.write-time-tooltip'),
+    },
+    page_fields={
+        'forum_name': Field('h3.header-tit', own_text=True),
+    },
+))
+
+
+# Guess the image using the title, so we avoid looking inside post html
+DEFAULT_IMAGE_URL = 'https://i.imgur.com/69UGmyY.png'  # 'Notice'
+TITLE_IMAGE_URLS = {
+    '[Banned]':
+        'https://i.imgur.com/LPqrc7d.png',
+    '[Event]':
+        'https://i.imgur.com/6NU246G.png',
+    'Temporary Maintenance':
+        'https://i.imgur.com/5n67kHG.png',
+    'Update Content':
+        'https://i.imgur.com/MEnXL4G.png',
+    # 'Developer Note' is assigned in StovePost.to_embed()
+}
+
+
+def guess_image_url(title) -> Url:
+    image_url = DEFAULT_IMAGE_URL
+    for keyword, imgurl in TITLE_IMAGE_URLS.items():
+        if keyword in title:
+            image_url = imgurl
+    return image_url
+
+
+def parse_time(datestr) -> datetime.datetime:
+    time, offset = datestr.split(' (UTC')
+    dt = datetime.datetime.strptime(time, '%Y.%m.%d %H:%M')
+
+    # Guess the offset as best as we can
+    while True:
+        try:
+            offset = float(offset)
+            break
+        except ValueError:
+            offset = offset[:-1] or 0  # trim trailing chars or stop at 0
 
-    @property
-    def timestamp(self) -> datetime.datetime:
-        if self._timestamp:
-            return self._timestamp
+    # Add in the offset, hopefully without anything horrible happening
+    dt -= datetime.timedelta(hours=offset)
+    return dt.replace(tzinfo=datetime.timezone.utc)
 
-        dateelem = self.soup.find('span', class_='write-time-tooltip')
-        datestr = dateelem.text.strip()
 
-        time, offset = datestr.split(' (UTC')
-        dt = datetime.datetime.strptime(time, '%Y.%m.%d %H:%M')
+class StovePost(TrackerPost):
+    __slots__ = ('forum_name', 'forum_url')
 
-        # Guess the offset as best as we can
-        while True:
-            try:
-                offset = float(offset)
-                break
-            except ValueError:
-                offset = offset[:-1] or 0  # trim trailing chars or stop at 0
-
-        # Add in the offset, hopefully without anything horrible happening
-        dt -= datetime.timedelta(hours=offset)
-        dt = dt.replace(tzinfo=datetime.timezone.utc)
-        self._timestamp = dt
-        return self._timestamp
+    def __init__(self, forum_name, forum_url, **kwargs):
+        super().__init__(**kwargs)
+        self.forum_name = forum_name
+        self.forum_url = forum_url
 
 
-    @property
-    def time_since_posted(self) -> datetime.timedelta:
-        timenow = datetime.datetime.now().astimezone(datetime.timezone.utc)
-        return timenow - self.timestamp
+    @classmethod
+    def from_fields(cls, fields, forum_name, forum_url):
+        """Builds a post from the fields extracted with STOVE_RULES"""
+        require_fields(fields, 'href', 'title', 'time')
+        url = 'https:' + fields['href']
+        # Embed.set_author() takes missing values as the string 'None'
+        author = {'name': fields['author_name']}
+        if fields['author_icon']:
+            author['icon_url'] = 'https:' + fields['author_icon']
+        return cls(
+            forum_name=forum_name,
+            forum_url=forum_url,
+            articleid=url.rsplit('/', 1)[-1],
+            title=fields['title'],
+            url=url,
+            timestamp=parse_time(fields['time']),
+            author=author,
+            image_url=guess_image_url(fields['title']),
+        )
 
 
     def to_embed(self, topic):
@@ -154,10 +124,6 @@ class StovePost(object):
             raise e
 
 
-    def __repr__(self):
-        return f'<StovePost {self.articleid}: {self.title}>'
-
-
 class StoveMixin:
     """Mixin to be used with discord.ext.command.Cog"""
     @property
@@ -179,6 +145,7 @@ class StoveMixin:
         if not channelids:
             log.info('New updates received on topic "%s", but no subscribers '
                      'to be notified.', self.topic)
+            await self.mark_seen(new_posts)
             return
 
         posts = sorted(new_posts, key=lambda p: p.timestamp)
@@ -188,11 +155,12 @@ class StoveMixin:
         s = 's' if len(posts) != 1 else ''
         log.info('%s new posts for topic "%s"', len(posts), topic)
 
-        sendargs = [
-            dict(content=None, embed=post.to_embed(self.topic))
+        messages = [
+            (post.articleid, dict(content=None, embed=post.to_embed(topic)))
             for post in posts
         ]
-        await pscog.push_to_topic(self.topic, sendargs)
+        await pscog.enqueue_to_topic(topic, messages)
+        await self.mark_seen(posts)
 
 
     async def do_work(self) -> Sequence[StovePost]:
@@ -203,19 +171,21 @@ class StoveMixin:
 
         for page in pages:
             try:
-                soup = BeautifulSoup(page, 'html.parser')
+                page_fields, post_fields = parse_items(page, STOVE_RULES)
 
-                forum_elem = soup.find('h3', class_='header-tit')
-                forum_name = forum_elem.contents[0].strip()
+                forum_name = page_fields['forum_name'].strip()
                 forum_url = self.stove_forum_name_urls.get(forum_name)
 
-                container = soup.find('ul', class_='module-list')
-                elems = container.find_all('li', class_='list-item')
-
-                # log.info(f'Forum: {forum_name} - {len(post_divs)} posts')
+                # log.info(f'Forum: {forum_name} - {len(post_fields)} posts')
 
-                for elem in elems:
-                    post = StovePost(elem, forum_name, forum_url)
+                for fields in post_fields:
+                    try:
+                        post = StovePost.from_fields(fields, forum_name,
+                                                     forum_url)
+                    except ValueError as e:
+                        log.warning('Skipped post %s in %s (%s)',
+                                    fields['href'], forum_url, e)
+                        continue
                     posts.append(post)
             except BaseException as e:
                 url = ''
@@ -228,44 +198,20 @@ class StoveMixin:
                           url, cls, e)
 
         if posts:
-            new_posts = self.filtered(posts)
+            new_posts = await self.unseen(posts)
             await self.handle_new_posts(new_posts)
 
         return True
 
 
-    def filtered(self,
-                 posts: Sequence[StovePost],
-                 cutoff_secs: int = TRACKER_UPDATE_INTERVAL_SECS):
-        new_posts = []
-        seen_id = set()
-
-        for post in posts:
-            if post.articleid in seen_id:
-                continue
-            seen_id.add(post.articleid)
-
-            time_delta = post.time_since_posted
-            time_delta_secs = time_delta.total_seconds()
-
-            # If delta is negative, the timestamp is in the future, so assume
-            # that parsing has probably broken and ignore the post
-            if 0 < time_delta_secs < cutoff_secs:
-                log.info('%s', post.title[:30]+'...')
-                new_posts.append(post)
-        return new_posts
-
-
     async def pull_forum_pages(self):
         urls = list(self.stove_forum_name_urls.values())
 
-        resps = []
         start = datetime.datetime.now()
 
-        for url in urls:
-            src = await self.fetch(url, wait=10)
-            resps.append(src)
+        # Pages load in parallel on the driver pool
+        resps = await self.batch_get_urls(self.bot.loop, *urls, wait=10)
 
         elapsed_secs = (datetime.datetime.now() - start).total_seconds()
         # log.info('Pulled %s pages (t=%ss)', len(urls), elapsed_secs)
-        return resps
+        return [page for page in resps if page is not None]
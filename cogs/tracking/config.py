@@ -2,3 +2,45 @@
 TRACKER_UPDATE_INTERVAL_SECS = 60 * 5
 # HTTP GET timeout (in secs), must be smaller than update interval; default=10
 TRACKER_TIMEOUT_SECS = 10
+# Posts older than this (in secs) are never announced, even if unseen
+TRACKER_MAX_POST_AGE_SECS = 60 * 60 * 24
+# Posts timestamped up to this many secs in the future are still announced
+TRACKER_CLOCK_SKEW_SECS = 60 * 5
+# Articleids per topic kept in memory in front of the tracker_seen table
+SEEN_CACHE_SIZE = 1000
+# Days to remember seen articleids for; must be well over the max post age
+SEEN_TTL_DAYS = 30
+# Secs between deletes of expired tracker_seen rows
+SEEN_COMPACT_INTERVAL_SECS = 60 * 60
+# Adaptive polling: the interval is multiplied by SPEEDUP after a poll that
+# found new posts, and by SLOWDOWN after one that found none
+TRACKER_INTERVAL_SPEEDUP = 0.5
+TRACKER_INTERVAL_SLOWDOWN = 1.5
+# Bounds on the adaptive interval, as multiples of update_interval_secs
+TRACKER_MIN_INTERVAL_FACTOR = 0.25
+TRACKER_MAX_INTERVAL_FACTOR = 4
+# Never poll more often than this (in secs), whatever the factors say
+TRACKER_MIN_INTERVAL_SECS = 60
+# Fraction of the interval added or taken away at random on each poll
+TRACKER_INTERVAL_JITTER = 0.1
+# Retries of a cron-scheduled poll that failed, and the secs between them;
+# a retry never runs later than the next scheduled poll
+TRACKER_CRON_RETRIES = 3
+TRACKER_CRON_RETRY_SECS = 60 * 5
+# Max pages one tracker fetches at once in a batch
+TRACKER_BATCH_MAX_CONCURRENT = 4
+# Retries per page after a timeout, connection error, 429 or 5xx
+TRACKER_FETCH_RETRIES = 2
+# Backoff (in secs) before the first retry; doubles on each retry
+TRACKER_RETRY_BASE_SECS = 1
+# Headless browsers kept per Selenium tracker; each loads one page at a time
+SELENIUM_POOL_SIZE = 2
+# Pages a browser loads before it is quit and replaced, to cap memory growth
+SELENIUM_MAX_PAGES_PER_DRIVER = 50
+# Secs to wait for a browser to start
+SELENIUM_START_TIMEOUT_SECS = 60
+# Secs to wait for quick WebDriver calls (page source, health checks, quit)
+SELENIUM_CALL_TIMEOUT_SECS = 10
+# Extra secs past the page load timeout before a load is abandoned from our
+# side, which gives the browser's own timeout the first chance to fire
+SELENIUM_TIMEOUT_GRACE_SECS = 5
@@ -0,0 +1,193 @@
+"""driverpool.py
+
+DriverPool keeps a few Selenium WebDrivers for a SeleniumTrackerCog, so that
+several pages can load at once.
+
+Drivers are leased one fetch at a time:
+
+    async with pool.lease() as driver:
+        await pool.run(driver.get, url)
+
+Drivers are started on demand, up to the pool size. A driver is checked
+before each lease and replaced if it has died, and it is quit and replaced
+after max_pages leases, since long-lived browsers slowly leak memory. A lease
+that exits with an exception also discards its driver, as the browser may be
+left mid-load.
+
+WebDriver calls block, so run() sends them to the pool's own thread
+executor, with a timeout. A call that times out can't be interrupted in its
+thread, so the lease holding it should exit with the TimeoutError: that quits
+the driver, which ends the stuck call and frees the thread. A driver that
+finishes starting only after its start timed out is quit as soon as it is up.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from typing import Callable
+
+from .config import (
+    SELENIUM_CALL_TIMEOUT_SECS,
+    SELENIUM_MAX_PAGES_PER_DRIVER,
+    SELENIUM_POOL_SIZE,
+    SELENIUM_START_TIMEOUT_SECS,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class PooledDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+
+class DriverLease:
+    """Async context manager returned by DriverPool.lease()"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.pooled = None
+
+
+    async def __aenter__(self):
+        self.pooled = await self.pool.acquire()
+        return self.pooled.driver
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.pool.release(self.pooled, broken=exc_type is not None)
+
+
+class DriverPool:
+    def __init__(self,
+                 factory: Callable,
+                 size: int = SELENIUM_POOL_SIZE,
+                 max_pages: int = SELENIUM_MAX_PAGES_PER_DRIVER,
+                 loop=None):
+        """
+        Arguments:
+        factory - blocking function that starts and returns a new WebDriver
+        size - max drivers alive at once
+        max_pages - leases before a driver is recycled
+        """
+        self.factory = factory
+        self.size = size
+        self.max_pages = max_pages
+        self.loop = loop or asyncio.get_event_loop()
+
+        # One thread per driver, plus one so quitting a stuck driver doesn't
+        # wait behind its own blocked call
+        self.executor = ThreadPoolExecutor(max_workers=size + 1,
+                                           thread_name_prefix='selenium')
+
+        self._idle = asyncio.Queue()
+        self._slots = asyncio.Semaphore(size)
+        self.started = 0
+        self.recycled = 0
+        self.failed_checks = 0
+
+
+    async def run(self, func, *args, timeout=SELENIUM_CALL_TIMEOUT_SECS):
+        """Runs a blocking WebDriver call on the pool's executor
+
+        Raises asyncio.TimeoutError if it takes longer than timeout secs.
+        """
+        future = self.loop.run_in_executor(self.executor, func, *args)
+        return await asyncio.wait_for(future, timeout)
+
+
+    def lease(self) -> DriverLease:
+        return DriverLease(self)
+
+
+    async def acquire(self) -> PooledDriver:
+        await self._slots.acquire()
+        try:
+            while not self._idle.empty():
+                pooled = self._idle.get_nowait()
+                if await self.is_healthy(pooled):
+                    return pooled
+                self.failed_checks += 1
+                await self.discard(pooled)
+
+            pooled = PooledDriver(await self.start_driver())
+            self.started += 1
+            return pooled
+
+        except BaseException:
+            self._slots.release()
+            raise
+
+
+    async def start_driver(self):
+        """Runs the factory, waiting up to SELENIUM_START_TIMEOUT_SECS"""
+        future = self.loop.run_in_executor(self.executor, self.factory)
+        try:
+            # Shielded, so the start carries on after a timeout and the
+            # driver it returns can still be quit
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          SELENIUM_START_TIMEOUT_SECS)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            future.add_done_callback(self._quit_late_driver)
+            raise
+
+
+    def _quit_late_driver(self, future):
+        if future.cancelled() or future.exception():
+            return
+        driver = future.result()
+        log.info('Quitting driver that started after its start timed out')
+        try:
+            self.executor.submit(driver.quit)
+        except RuntimeError:
+            # Executor already shut down
+            driver.quit()
+
+
+    async def release(self, pooled: PooledDriver, broken: bool = False):
+        try:
+            pooled.pages += 1
+            if broken or pooled.pages >= self.max_pages:
+                self.recycled += 1
+                await self.discard(pooled)
+            else:
+                self._idle.put_nowait(pooled)
+        finally:
+            self._slots.release()
+
+
+    async def is_healthy(self, pooled: PooledDriver) -> bool:
+        try:
+            # Any round trip to the browser will do
+            await self.run(lambda: pooled.driver.current_url)
+            return True
+        except Exception as e:
+            log.info('Discarding dead driver (%s: %s)',
+                     e.__class__.__name__, e)
+            return False
+
+
+    async def discard(self, pooled: PooledDriver):
+        try:
+            await self.run(pooled.driver.quit)
+        except Exception as e:
+            log.info('Failed to quit driver (%s: %s)',
+                     e.__class__.__name__, e)
+
+
+    def close(self):
+        """Quits idle drivers; blocks, so only call this on shutdown"""
+        while not self._idle.empty():
+            pooled = self._idle.get_nowait()
+            try:
+                pooled.driver.quit()
+            except Exception:
+                pass
+        self.executor.shutdown(wait=False)
+
+
+    def report(self) -> str:
+        return (f'size={self.size} idle={self._idle.qsize()} '
+                f'started={self.started} recycled={self.recycled} '
+                f'failed checks={self.failed_checks}')
@@ -0,0 +1,98 @@
+"""parsebench.py
+
+Times tracker extraction rules on saved pages, once per installed backend.
+
+Run from the repo root, on the pages saved in cogs/tracking/fixtures:
+
+    python -m cogs.tracking.parsebench plug -n 50
+
+or on pages freshly saved from a tracked site:
+
+    curl -o plug1.html 'https://www.plug.game/kingsraid-en/1030449/posts'
+    python -m cogs.tracking.parsebench plug plug1.html -n 50
+
+Every backend must extract the same fields as BeautifulSoup; mismatches are
+reported, since they mean a selector behaves differently across parsers. The
+baseline row is a plain BeautifulSoup(page, 'html.parser') tree build, which
+is what trackers did for every page before the rules existed.
+"""
+
+import argparse
+import glob
+from importlib import import_module
+import os
+import time
+
+from bs4 import BeautifulSoup
+
+from .parsing import BACKENDS, RULES, ItemRules, SoupBackend
+
+
+# Saved pages, named after the rules that parse them, like plug.html
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# Modules that register rules when imported
+RULE_MODULES = (
+    'cogs.plugtracker.plugmixin',
+    'cogs.stovetracker.stovemixin',
+    'cogs.sgxtracker.sgxmixin',
+)
+
+
+def time_per_page_ms(func, pages, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            func(page)
+    return (time.perf_counter() - start) * 1000 / (rounds * len(pages))
+
+
+def bench(rules, pages, rounds: int):
+    """Yields (name, ms per page, matches bs4) rows"""
+    baseline = time_per_page_ms(
+        lambda page: BeautifulSoup(page, 'html.parser'), pages, rounds)
+    yield 'baseline (bs4 tree)', baseline, True
+
+    if not isinstance(rules, ItemRules):
+        # ScriptJson scans raw html, no backend involved
+        yield 'scan', time_per_page_ms(rules.extract, pages, rounds), True
+        return
+
+    expected = [rules.apply(SoupBackend, page) for page in pages]
+    for name, backend in BACKENDS.items():
+        results = [rules.apply(backend, page) for page in pages]
+        ms = time_per_page_ms(lambda page: rules.apply(backend, page),
+                              pages, rounds)
+        yield name, ms, results == expected
+
+
+def main():
+    for module in RULE_MODULES:
+        import_module(module)
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('rules', choices=list(RULES))
+    parser.add_argument('pages', nargs='*',
+                        help='saved html files; defaults to the fixtures')
+    parser.add_argument('-n', '--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    paths = args.pages or sorted(
+        glob.glob(os.path.join(FIXTURES_DIR, f'{args.rules}*.html')))
+    if not paths:
+        parser.error(f'no pages given, and no fixtures for {args.rules}')
+
+    pages = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+
+    rules = RULES[args.rules]
+    print(f'{args.rules}: {len(pages)} pages x {args.rounds} rounds')
+    for name, ms, matches in bench(rules, pages, args.rounds):
+        note = '' if matches else '  (MISMATCH vs bs4)'
+        print(f'  {name:<20} {ms:8.2f} ms/page{note}')
+
+
+if __name__ == '__main__':
+    main()
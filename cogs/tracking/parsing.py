@@ -0,0 +1,278 @@
+"""parsing.py
+
+Declarative extraction of posts from the pages that trackers pull.
+
+A tracker declares what it wants from a page instead of walking a soup:
+
+    PLUG_RULES = register_rules('plug', ItemRules(
+        items='.frame_plug',
+        fields={
+            'articleid': Field(attr='data-articleid'),
+            'title': Field('.tit_feed'),
+        },
+        page_fields={'forum_name': Field('h2.tit_board')},
+    ))
+
+    page, items = parse_items(html, PLUG_RULES)
+    # page == {'forum_name': ...}, items == [{'articleid': ..., ...}, ...]
+
+Pages are parsed by the fastest backend installed: selectolax, then lxml (with
+cssselect), then BeautifulSoup, which is always available. A page that fails
+on a fast backend is parsed again with BeautifulSoup.
+
+JSON stashed in a <script> tag is located with ScriptJson, which scans the raw
+HTML for the script instead of building a tree.
+
+To compare backends on saved pages, see cogs/tracking/parsebench.py.
+"""
+
+from collections import OrderedDict
+from importlib.util import find_spec
+import json
+import logging
+import re
+from typing import Any, List, Mapping, Optional, Sequence, Tuple
+
+from bs4 import BeautifulSoup
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# lxml only imports cssselect once a selector is compiled, so check for it here
+if find_spec('cssselect') is None:
+    lxml = None
+
+
+log = logging.getLogger(__name__)
+
+
+class SoupBackend:
+    name = 'bs4'
+
+    @staticmethod
+    def parse(html: str):
+        return BeautifulSoup(html, 'html.parser')
+
+    @staticmethod
+    def select(node, css: str) -> list:
+        return node.select(css)
+
+    @staticmethod
+    def text(node) -> str:
+        return node.get_text()
+
+    @staticmethod
+    def own_text(node) -> str:
+        return next(iter(node.find_all(string=True, recursive=False)), '')
+
+    @staticmethod
+    def attr(node, name: str) -> Optional[str]:
+        value = node.get(name)
+        # bs4 splits multi-valued attributes like class into lists
+        return ' '.join(value) if isinstance(value, list) else value
+
+
+class LxmlBackend:
+    name = 'lxml'
+
+    @staticmethod
+    def parse(html: str):
+        return lxml.html.fromstring(html)
+
+    @staticmethod
+    def select(node, css: str) -> list:
+        return node.cssselect(css)
+
+    @staticmethod
+    def text(node) -> str:
+        return node.text_content()
+
+    @staticmethod
+    def own_text(node) -> str:
+        return node.text or ''
+
+    @staticmethod
+    def attr(node, name: str) -> Optional[str]:
+        return node.get(name)
+
+
+class SelectolaxBackend:
+    name = 'selectolax'
+
+    @staticmethod
+    def parse(html: str):
+        return HTMLParser(html)
+
+    @staticmethod
+    def select(node, css: str) -> list:
+        return node.css(css)
+
+    @staticmethod
+    def text(node) -> str:
+        return node.text(deep=True)
+
+    @staticmethod
+    def own_text(node) -> str:
+        child = node.child
+        if child and child.tag == '-text':
+            return child.text_content or ''
+        return ''
+
+    @staticmethod
+    def attr(node, name: str) -> Optional[str]:
+        return node.attributes.get(name)
+
+
+# Backend name -> backend, fastest first
+BACKENDS = OrderedDict()
+
+# Rules name -> ItemRules or ScriptJson, for parsebench
+RULES = OrderedDict()
+
+
+def register_backend(backend, available: bool = True):
+    if available:
+        BACKENDS[backend.name] = backend
+
+
+register_backend(SelectolaxBackend, available=HTMLParser is not None)
+register_backend(LxmlBackend, available=lxml is not None)
+register_backend(SoupBackend)
+
+
+def get_backend(name: str = None):
+    """The named backend, or the fastest one installed"""
+    if name:
+        return BACKENDS[name]
+    return next(iter(BACKENDS.values()))
+
+
+def register_rules(name: str, rules):
+    """Names rules for parsebench, returning them unchanged"""
+    RULES[name] = rules
+    return rules
+
+
+class Field:
+    """One value to extract from a node
+
+    Arguments:
+    selector - CSS selector relative to the node, or None for the node itself
+    attr - attribute to read; if None, the text is read instead
+    index - which of the selector's matches to read
+    own_text - read only the node's first text child, not its descendants'
+    collapse - collapse runs of whitespace in the text to single spaces
+
+    Text is stripped. Fields that match nothing are None.
+    """
+    __slots__ = ('selector', 'attr', 'index', 'own_text', 'collapse')
+
+    def __init__(self,
+                 selector: str = None,
+                 attr: str = None,
+                 index: int = 0,
+                 own_text: bool = False,
+                 collapse: bool = False):
+        self.selector = selector
+        self.attr = attr
+        self.index = index
+        self.own_text = own_text
+        self.collapse = collapse
+
+
+    def extract(self, backend, node) -> Optional[str]:
+        if self.selector:
+            matches = backend.select(node, self.selector)
+            if len(matches) <= self.index:
+                return None
+            node = matches[self.index]
+
+        if self.attr:
+            return backend.attr(node, self.attr)
+
+        text = backend.own_text(node) if self.own_text else backend.text(node)
+        if self.collapse:
+            return ' '.join(text.split())
+        return text.strip()
+
+
+class ItemRules:
+    """Fields to extract from every node matching items, and from the page"""
+    def __init__(self,
+                 items: str,
+                 fields: Mapping[str, Field],
+                 page_fields: Mapping[str, Field] = None):
+        self.items = items
+        self.fields = fields
+        self.page_fields = page_fields or {}
+
+
+    def apply(self, backend, html: str) -> Tuple[dict, List[dict]]:
+        root = backend.parse(html)
+        page = {name: field.extract(backend, root)
+                for name, field in self.page_fields.items()}
+        items = [
+            {name: field.extract(backend, node)
+             for name, field in self.fields.items()}
+            for node in backend.select(root, self.items)
+        ]
+        return page, items
+
+
+def parse_items(html: str,
+                rules: ItemRules,
+                backend: str = None) -> Tuple[dict, List[dict]]:
+    """Applies rules to a page, returning (page fields, item fields)"""
+    parser = get_backend(backend)
+    try:
+        return rules.apply(parser, html)
+    except Exception as e:
+        if parser is SoupBackend:
+            raise
+        log.info('%s failed to parse page (%s: %s), retrying with bs4',
+                 parser.name, e.__class__.__name__, e)
+        return rules.apply(SoupBackend, html)
+
+
+SCRIPT_PATTERN = re.compile(r'<script[^>]*>(.*?)</script>', re.S | re.I)
+
+
+class ScriptJson:
+    """Locates a JSON object assigned in an inline <script>
+
+    The first script containing every marker is used. Its text must be a
+    JSON value, optionally wrapped as `prefix <json>;`.
+    """
+    def __init__(self, markers: Sequence[str], prefix: str = ''):
+        self.markers = tuple(markers)
+        self.prefix = prefix
+
+
+    def find_script(self, html: str) -> Optional[str]:
+        for match in SCRIPT_PATTERN.finditer(html):
+            script = match.group(1)
+            if all(marker in script for marker in self.markers):
+                return script.strip()
+        return None
+
+
+    def extract_text(self, html: str) -> Optional[str]:
+        """The raw JSON text, or None if no script matched"""
+        script = self.find_script(html)
+        if script is None:
+            return None
+        if self.prefix and script.startswith(self.prefix):
+            script = script[len(self.prefix):]
+        return script.rstrip().rstrip(';')
+
+
+    def extract(self, html: str) -> Any:
+        text = self.extract_text(html)
+        return json.loads(text) if text is not None else None
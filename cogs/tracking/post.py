@@ -0,0 +1,72 @@
+"""post.py
+
+TrackerPost is the record that trackers build for each post on a page.
+
+Every value is extracted when the page is parsed, so a post holds plain
+strings and datetimes instead of a reference into the parsed tree, and the
+tree is freed as soon as parsing ends. Posts use __slots__ since a tick may
+build hundreds of them that are mostly thrown away as already seen.
+
+Subclasses add their own slots and a constructor that does the extraction:
+
+    class PlugPost(TrackerPost):
+        __slots__ = ('forum_name', 'forum_url')
+
+        @classmethod
+        def from_fields(cls, fields, forum_name, forum_url):
+            require_fields(fields, 'articleid', 'title')
+            ...
+
+A page can change under a tracker's selectors, so constructors raise
+MissingFieldError for fields they can't do without. Trackers skip and log
+such posts rather than failing the whole tick.
+"""
+
+import datetime
+from typing import Mapping, Optional
+
+
+class MissingFieldError(ValueError):
+    pass
+
+
+def require_fields(fields: Mapping[str, Optional[str]], *names: str):
+    """Raises MissingFieldError if any of the named fields is empty"""
+    missing = [name for name in names if not fields.get(name)]
+    if missing:
+        raise MissingFieldError(f'missing {", ".join(missing)}')
+
+
+class TrackerPost:
+    __slots__ = ('articleid', 'title', 'url', 'timestamp', 'author',
+                 'image_url')
+
+    def __init__(self,
+                 articleid: str,
+                 title: str,
+                 url: Optional[str],
+                 timestamp: datetime.datetime,
+                 author: Mapping[str, Optional[str]],
+                 image_url: Optional[str] = None):
+        """
+        Arguments:
+        articleid - identifies the post within its topic, see unseen()
+        timestamp - when the post was made; naive datetimes are local time
+        author - keyword arguments to Embed.set_author()
+        """
+        self.articleid = articleid
+        self.title = title
+        self.url = url
+        self.timestamp = timestamp
+        self.author = author
+        self.image_url = image_url
+
+
+    @property
+    def time_since_posted(self) -> datetime.timedelta:
+        utc = datetime.timezone.utc
+        return datetime.datetime.now(utc) - self.timestamp.astimezone(utc)
+
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.articleid}: {self.title}>'
@@ -0,0 +1,276 @@
+"""scheduler.py
+
+PollScheduler runs the do_work() polls of every TrackerCog from one task,
+instead of each cog running its own fixed tasks.loop().
+
+Each registered PollJob is either adaptive or anchored to a CronSchedule.
+Adaptive jobs start at the cog's update_interval_secs; the interval shrinks
+after a poll that found new posts and grows after a quiet one, within the
+job's bounds. Every delay gets some random jitter, so trackers that started
+together drift apart instead of hitting upstream in lockstep.
+
+A job is never run again while its previous poll is still going, and a job
+whose poll returns False is dropped, matching the old tasks.loop() contract.
+A cron job whose poll raises is retried every TRACKER_CRON_RETRY_SECS, up to
+TRACKER_CRON_RETRIES times, rather than waiting for its next scheduled time.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+import heapq
+from itertools import count
+import logging
+from random import uniform
+import time
+from typing import Callable, Optional, Set
+
+from .config import (
+    TRACKER_CRON_RETRIES,
+    TRACKER_CRON_RETRY_SECS,
+    TRACKER_INTERVAL_JITTER,
+    TRACKER_INTERVAL_SLOWDOWN,
+    TRACKER_INTERVAL_SPEEDUP,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_cron_field(field: str, lo: int, hi: int) -> Set[int]:
+    """Parses one cron field ('*', '5', '1-5', '*/15', '0,30') into values"""
+    values = set()
+    for part in field.split(','):
+        rng, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if rng == '*':
+            start, end = lo, hi
+        elif '-' in rng:
+            start, end = map(int, rng.split('-'))
+        else:
+            start = end = int(rng)
+        if not lo <= start <= end <= hi or step < 1:
+            raise ValueError(f'invalid cron field: "{field}"')
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """A 'minute hour day-of-month month day-of-week' cron expression
+
+    Day-of-week runs from 0 (Sunday) to 6, and 7 is Sunday too. As in cron,
+    when both day-of-month and day-of-week are restricted (neither starts
+    with '*'), a day matches if either field does; otherwise it must match
+    both. Times are matched in the timezone given by utcoffset, so schedules
+    can follow the source's local time.
+
+    Example, 20:05 on weekdays in Singapore:
+        CronSchedule('5 20 * * 1-5', utcoffset=timedelta(hours=8))
+    """
+    def __init__(self, expr: str, utcoffset: timedelta = timedelta(0)):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f'cron expression needs 5 fields: "{expr}"')
+        self.expr = expr
+        self.tz = timezone(utcoffset)
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7
+                         for day in parse_cron_field(fields[4], 0, 7)}
+        self.either_day = not (fields[2].startswith('*')
+                               or fields[4].startswith('*'))
+
+
+    def day_matches(self, dt: datetime) -> bool:
+        in_days = dt.day in self.days
+        in_weekdays = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.either_day:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+
+    def matches(self, dt: datetime) -> bool:
+        return (dt.minute in self.minutes
+                and dt.hour in self.hours
+                and dt.month in self.months
+                and self.day_matches(dt))
+
+
+    def next_after(self, now: datetime) -> datetime:
+        """The first matching minute after now (an aware datetime)"""
+        dt = now.astimezone(self.tz).replace(second=0, microsecond=0)
+        dt += timedelta(minutes=1)
+        # Skip whole hours and days that can't match, so this stays cheap
+        for _ in range(366 * 24 * 60):
+            if dt.month not in self.months or not self.day_matches(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+            elif dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise ValueError(f'cron expression never matches: "{self.expr}"')
+
+
+    def __repr__(self):
+        return f'<CronSchedule "{self.expr}" {self.tz}>'
+
+
+class PollJob:
+    def __init__(self,
+                 name: str,
+                 corofunc: Callable,
+                 interval_secs: float,
+                 min_interval_secs: float = None,
+                 max_interval_secs: float = None,
+                 cron: Optional[CronSchedule] = None):
+        self.name = name
+        self.corofunc = corofunc
+        self.cron = cron
+        self.interval_secs = interval_secs
+        self.min_interval_secs = min_interval_secs or interval_secs
+        self.max_interval_secs = max_interval_secs or interval_secs
+
+        self.running = False
+        self.cancelled = False
+        self.runs = 0
+        # Retries of a failed cron poll so far
+        self.retries = 0
+        self.last_found = 0
+        self.next_run = None
+
+
+    def observe(self, found: int):
+        """Records how many new posts the last poll found"""
+        self.last_found = found
+
+
+    def next_delay_secs(self,
+                        first: bool = False,
+                        failed: bool = False) -> float:
+        if self.cron:
+            now = datetime.now(timezone.utc)
+            delay = (self.cron.next_after(now) - now).total_seconds()
+            if failed and self.retries < TRACKER_CRON_RETRIES:
+                self.retries += 1
+                return min(delay, TRACKER_CRON_RETRY_SECS)
+            self.retries = 0
+            return delay
+
+        if not first:
+            if self.last_found:
+                factor = TRACKER_INTERVAL_SPEEDUP
+            else:
+                factor = TRACKER_INTERVAL_SLOWDOWN
+            self.interval_secs = min(
+                self.max_interval_secs,
+                max(self.min_interval_secs, self.interval_secs * factor))
+        self.last_found = 0
+
+        jitter = self.interval_secs * TRACKER_INTERVAL_JITTER
+        if first:
+            # Spread out the first polls of trackers loaded together
+            return uniform(0, jitter)
+        return self.interval_secs + uniform(-jitter, jitter)
+
+
+    def describe(self) -> str:
+        when = 'running' if self.running else (
+            f'in {max(0, self.next_run - time.monotonic()):.0f}s'
+            if self.next_run else 'unscheduled')
+        every = self.cron or f'every {self.interval_secs:.0f}s'
+        return f'{self.name}: {every}, runs={self.runs}, next {when}'
+
+
+class PollScheduler:
+    def __init__(self):
+        self.jobs = {}
+        # (due, seq, job), earliest first; seq breaks ties between equal dues
+        self._heap = []
+        self._seq = count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+
+    def register(self, job: PollJob, loop=None):
+        if job.name in self.jobs:
+            self.unregister(job.name)
+        self.jobs[job.name] = job
+        self._push(job, job.next_delay_secs(first=True))
+        log.info('Scheduled %s', job.describe())
+
+        if not self._task or self._task.done():
+            loop = loop or asyncio.get_event_loop()
+            self._task = loop.create_task(self.run())
+
+
+    def unregister(self, name: str):
+        job = self.jobs.pop(name, None)
+        if job:
+            # Stale heap entries are skipped when they come due
+            job.cancelled = True
+
+
+    def _push(self, job: PollJob, delay_secs: float):
+        job.next_run = time.monotonic() + delay_secs
+        heapq.heappush(self._heap, (job.next_run, next(self._seq), job))
+        self._wakeup.set()
+
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            due, _, job = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                try:
+                    # Woken early if a job with an earlier due is pushed
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            if job.cancelled or job.running or job.next_run != due:
+                continue
+            asyncio.ensure_future(self._run_job(job))
+
+
+    async def _run_job(self, job: PollJob):
+        job.running = True
+        proceed = None
+        failed = False
+        try:
+            proceed = await job.corofunc()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failed = True
+            log.error('[%s] poll failed (%s: %s)',
+                      job.name, e.__class__.__name__, e)
+        finally:
+            job.running = False
+            job.runs += 1
+
+        if proceed is False:
+            log.info('Stopping work on %s', job.name)
+            self.unregister(job.name)
+            return
+        if not job.cancelled:
+            self._push(job, job.next_delay_secs(failed=failed))
+
+
+    def report(self) -> str:
+        if not self.jobs:
+            return 'No trackers scheduled.'
+        return '\n'.join(job.describe()
+                         for _, job in sorted(self.jobs.items()))
+
+
+SCHEDULER = PollScheduler()
@@ -0,0 +1,149 @@
+"""seen.py
+
+SeenStore remembers which articleids a tracker topic has already announced,
+in the tracker_seen table (see database/schema_tracking.sql).
+
+Finding new posts and recording them are separate steps. filter_unseen()
+only reads, so a post is not recorded until mark_seen() is called once it has
+been enqueued. If anything fails in between, the post is found again on the
+next tick. Enqueueing is idempotent per (topic, articleid, channel), so a
+crash after enqueueing but before mark_seen() can't announce a post twice.
+
+The most recently seen ids are kept in an in-memory LRU, so posts that stay
+on a page across many ticks are skipped without a query. Rows older than
+SEEN_TTL_DAYS are deleted every SEEN_COMPACT_INTERVAL_SECS.
+
+The first time a topic is tracked, every post on the page would look new.
+That first batch is recorded without being reported as unseen, and the topic
+is then marked as seeded in tracker_topics. The marker is kept even after
+compaction empties the topic's rows, so a quiet topic is never seeded again.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import logging
+from typing import Iterable, Set
+
+from database import acquire
+from cogs.mixins import fetch_all, timed_execute
+from .config import (
+    SEEN_CACHE_SIZE,
+    SEEN_COMPACT_INTERVAL_SECS,
+    SEEN_TTL_DAYS,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+async def execute(query, params=None):
+    async with acquire() as conn:
+        async with conn.cursor() as cur:
+            await timed_execute(cur, query, params)
+            return await fetch_all(cur)
+
+
+class SeenStore:
+    def __init__(self, topic: str, capacity: int = SEEN_CACHE_SIZE):
+        self.topic = topic
+        self.capacity = capacity
+        # articleid -> None, least recently seen first
+        self.recent = OrderedDict()
+        self.loaded = False
+        self.seeding = False
+        self._last_compact = None
+
+
+    async def load(self):
+        """Warms the LRU with the most recently seen ids for the topic"""
+        query = """SELECT articleid FROM tracker_seen
+                   WHERE topic = %s
+                   ORDER BY tstamp DESC
+                   LIMIT %s;"""
+        rows = await execute(query, [self.topic, self.capacity])
+        for (articleid,) in reversed(rows):
+            self.remember(articleid)
+
+        seeded = await execute('SELECT 1 FROM tracker_topics '
+                               'WHERE topic = %s;', [self.topic])
+        if rows and not seeded:
+            # Tracked before the marker existed
+            await self.mark_seeded()
+        self.seeding = not (rows or seeded)
+        self.loaded = True
+        if self.seeding:
+            log.info('Topic "%s" has not been seeded yet, the first batch '
+                     'will be recorded without being announced', self.topic)
+
+
+    def remember(self, articleid: str):
+        self.recent[articleid] = None
+        self.recent.move_to_end(articleid)
+        while len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+
+    async def filter_unseen(self, articleids: Iterable) -> Set[str]:
+        """Returns the articleids not seen before, without marking them"""
+        if not self.loaded:
+            await self.load()
+
+        unknown = []
+        for articleid in dict.fromkeys(str(a) for a in articleids):
+            if articleid in self.recent:
+                self.recent.move_to_end(articleid)
+            else:
+                unknown.append(articleid)
+
+        if not unknown:
+            return set()
+
+        if self.seeding:
+            await self.mark_seen(unknown)
+            await self.mark_seeded()
+            self.seeding = False
+            return set()
+
+        query = """SELECT articleid FROM tracker_seen
+                   WHERE topic = %s AND articleid = ANY(%s);"""
+        rows = await execute(query, [self.topic, unknown])
+        seen = {articleid for (articleid,) in rows}
+        for articleid in seen:
+            self.remember(articleid)
+        return set(unknown) - seen
+
+
+    async def mark_seen(self, articleids: Iterable):
+        """Records articleids as announced"""
+        articleids = list(dict.fromkeys(str(a) for a in articleids))
+        if not articleids:
+            return
+
+        query = """INSERT INTO tracker_seen (topic, articleid, tstamp)
+                   SELECT %s, a, %s FROM unnest(%s::text[]) AS a
+                   ON CONFLICT (topic, articleid) DO NOTHING;"""
+        await execute(query, [self.topic, datetime.utcnow(), articleids])
+        for articleid in articleids:
+            self.remember(articleid)
+
+        await self.compact_if_due()
+
+
+    async def mark_seeded(self):
+        await execute('INSERT INTO tracker_topics (topic, tstamp) '
+                      'VALUES (%s, %s) ON CONFLICT (topic) DO NOTHING;',
+                      [self.topic, datetime.utcnow()])
+
+
+    async def compact_if_due(self):
+        now = datetime.utcnow()
+        if (self._last_compact
+                and (now - self._last_compact).total_seconds()
+                    < SEEN_COMPACT_INTERVAL_SECS):
+            return
+        self._last_compact = now
+
+        cutoff = now - timedelta(days=SEEN_TTL_DAYS)
+        await execute('DELETE FROM tracker_seen '
+                      'WHERE topic = %s AND tstamp < %s;',
+                      [self.topic, cutoff])
@@ -1,11 +1,14 @@
 import asyncio
+from collections import Counter
+import hashlib
 import logging
-from typing import Sequence
+from random import uniform
+from typing import Callable, Optional, Sequence
 
 import aiohttp
-from discord.ext import commands, tasks
+from discord.ext import commands
 from selenium import webdriver
-from selenium.common.exceptions import WebDriverException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
@@ -13,16 +16,44 @@ from selenium.webdriver.support import expected_conditions as EC
 
 
 import appconfig
+from utils.httpclient import HTTP
 from . import config
+from .driverpool import DriverPool
+from .scheduler import SCHEDULER, CronSchedule, PollJob
+from .seen import SeenStore
 
 UPDATE_INTERVAL_SECS = config.TRACKER_UPDATE_INTERVAL_SECS
 TIMEOUT_SECS = config.TRACKER_TIMEOUT_SECS
+MAX_POST_AGE_SECS = config.TRACKER_MAX_POST_AGE_SECS
+CLOCK_SKEW_SECS = config.TRACKER_CLOCK_SKEW_SECS
+MIN_INTERVAL_SECS = config.TRACKER_MIN_INTERVAL_SECS
+MIN_INTERVAL_FACTOR = config.TRACKER_MIN_INTERVAL_FACTOR
+MAX_INTERVAL_FACTOR = config.TRACKER_MAX_INTERVAL_FACTOR
+BATCH_MAX_CONCURRENT = config.TRACKER_BATCH_MAX_CONCURRENT
+FETCH_RETRIES = config.TRACKER_FETCH_RETRIES
+RETRY_BASE_SECS = config.TRACKER_RETRY_BASE_SECS
+SELENIUM_TIMEOUT_GRACE_SECS = config.SELENIUM_TIMEOUT_GRACE_SECS
 
 CHROME_BINARY_PATH = appconfig.from_env('GOOGLE_CHROME_BIN')
 
 log = logging.getLogger(__name__)
 
 
+class ChangedPage:
+    """A page returned by TrackerCog.fetch_if_changed()
+
+    key identifies the request; validators and digest are saved for it by
+    TrackerCog.commit_pages().
+    """
+    __slots__ = ('key', 'text', 'validators', 'digest')
+
+    def __init__(self, key, text, validators, digest):
+        self.key = key
+        self.text = text
+        self.validators = validators
+        self.digest = digest
+
+
 class TrackerCog(commands.Cog):
     """Abstract Tracker class that implements the update checking loop
 
@@ -31,7 +62,9 @@ class TrackerCog(commands.Cog):
     repeated.
 
     You may override update_interval_secs() to change the interval at which
-    do_work() is repeated.
+    do_work() is repeated. Polls are run by the shared PollScheduler, which
+    adapts the interval to how often unseen() finds new posts, or you may
+    override cron_schedule() to poll at fixed times instead.
 
     For detailed explanation, see the README.
     """
@@ -40,18 +73,32 @@ class TrackerCog(commands.Cog):
 
         self.timeout_secs = TIMEOUT_SECS
 
+        # Per (url, params), for fetch_if_changed():
+        #   validators: (ETag, Last-Modified) from the last 200 response
+        #   body_hashes: digest of the last 200 response body
+        self._validators = {}
+        self._body_hashes = {}
+        self.fetch_stats = Counter()
+        # Bounds the pages this cog fetches at once with fetch_body()
+        self.batch_sem = asyncio.Semaphore(BATCH_MAX_CONCURRENT)
+
         interval = self.update_interval_secs
-        log.info('[%s] Starting update check loop, interval: %s sec',
-                 self._derived_name, interval)
-        self._task = tasks.loop(seconds=interval)(self.task)
-        self._task.start()
+        self.poll_job = PollJob(
+            self._derived_name,
+            self.task,
+            interval,
+            min_interval_secs=min(interval, max(
+                MIN_INTERVAL_SECS, interval * MIN_INTERVAL_FACTOR)),
+            max_interval_secs=interval * MAX_INTERVAL_FACTOR,
+            cron=self.cron_schedule,
+        )
+        SCHEDULER.register(self.poll_job, loop=bot.loop)
 
 
     @property
     def aiohttp_session(self):
-        if not hasattr(self, '_aiohttp_session'):
-            self._aiohttp_session = aiohttp.ClientSession()
-        return self._aiohttp_session
+        """The process-wide session from utils.httpclient"""
+        return HTTP.session
 
 
     @property
@@ -61,6 +108,59 @@ class TrackerCog(commands.Cog):
         return None
 
 
+    @property
+    def seen(self) -> SeenStore:
+        """Articleids already announced on this cog's topic"""
+        if not hasattr(self, '_seen'):
+            self._seen = SeenStore(self.topic)
+        return self._seen
+
+
+    async def unseen(self,
+                     posts: Sequence,
+                     key: Callable = lambda post: post.articleid,
+                     max_age_secs: Optional[int] = MAX_POST_AGE_SECS):
+        """Returns the posts that have not been announced before
+
+        Posts are keyed by articleid, or by key(post) if given. Unless
+        max_age_secs is None, posts older than max_age_secs (or timestamped
+        too far in the future, which usually means the timestamp failed to
+        parse) are dropped first, using post.time_since_posted.
+
+        The posts returned are not marked as seen; call mark_seen() with them
+        once they are enqueued, so a failure before then retries them on the
+        next tick.
+        """
+        if max_age_secs is not None:
+            posts = [
+                post for post in posts
+                if (-CLOCK_SKEW_SECS
+                    < post.time_since_posted.total_seconds()
+                    < max_age_secs)
+            ]
+        if not posts:
+            return []
+
+        fresh = await self.seen.filter_unseen(key(post) for post in posts)
+
+        new_posts = []
+        for post in posts:
+            k = str(key(post))
+            if k in fresh:
+                fresh.discard(k)
+                new_posts.append(post)
+
+        self.poll_job.observe(len(new_posts))
+        return new_posts
+
+
+    async def mark_seen(self,
+                        posts: Sequence,
+                        key: Callable = lambda post: post.articleid):
+        """Records posts returned by unseen() as announced"""
+        await self.seen.mark_seen(key(post) for post in posts)
+
+
     @property
     def update_interval_secs(self) -> int:
         """Override to change time interval between each do_work() call
@@ -71,6 +171,12 @@ class TrackerCog(commands.Cog):
         return UPDATE_INTERVAL_SECS
 
 
+    @property
+    def cron_schedule(self) -> Optional[CronSchedule]:
+        """Override to poll at fixed times instead of adaptive intervals"""
+        return None
+
+
     async def do_work(self) -> bool:
         """This method will be periodically invoked until it returns False
 
@@ -105,19 +211,14 @@ class TrackerCog(commands.Cog):
 
 
     def cog_unload(self):
-        # Frankly no idea if this works, never used it before
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.aiohttp_session.close())
+        # The shared HTTP session outlives any one cog, so it is left open
+        SCHEDULER.unregister(self.poll_job.name)
 
 
     async def task(self):
-        """Coro to serve as argument to discord.ext.tasks.loop()"""
+        """Coro run by the PollScheduler; returning False stops the polls"""
         await self.bot.wait_until_ready()
-        proceed = await self.do_work()
-        if proceed is False:
-            log.info('Stopping work on ' + self._derived_name)
-            self._task.cancel()
-        return
+        return await self.do_work()
 
 
     async def fetch(self,
@@ -142,6 +243,187 @@ class TrackerCog(commands.Cog):
                                  timeout=timeout)
 
 
+    async def fetch_if_changed(self,
+                               url,
+                               session=None,
+                               headers=None,
+                               params=None,
+                               timeout=None) -> Optional['ChangedPage']:
+        """GETs a page, returning it only if it changed since last time
+
+        The ETag and Last-Modified headers of the last response are sent back
+        as If-None-Match and If-Modified-Since, so servers that support them
+        can answer 304 without a body. Servers that don't are caught by
+        comparing a hash of the body with the last one. Returns None when the
+        page is unchanged, or when the response is not a 200.
+
+        The new validators and hash are only saved by commit_pages(), which
+        should be called once the page has been handled. Until then, the page
+        counts as changed on every fetch.
+        """
+        key = (url, repr(params))
+        headers = dict(headers or {})
+        etag, last_modified = self._validators.get(key, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response, text = await self.fetch_body(url,
+                                               session=session,
+                                               headers=headers,
+                                               params=params,
+                                               timeout=timeout)
+        if response.status == 304:
+            self.fetch_stats['not_modified'] += 1
+            return None
+
+        if response.status != 200:
+            self.fetch_stats['failed'] += 1
+            log.warning('[%s] GET %s returned HTTP %s',
+                        self._derived_name, url, response.status)
+            return None
+
+        validators = (response.headers.get('ETag'),
+                      response.headers.get('Last-Modified'))
+
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        if self._body_hashes.get(key) == digest:
+            self.fetch_stats['unchanged'] += 1
+            self._validators[key] = validators
+            return None
+
+        self.fetch_stats['changed'] += 1
+        return ChangedPage(key, text, validators, digest)
+
+
+    def commit_pages(self, pages: Sequence[Optional['ChangedPage']]):
+        """Saves the validators and hashes of pages that have been handled"""
+        for page in pages:
+            if page is None:
+                continue
+            self._validators[page.key] = page.validators
+            self._body_hashes[page.key] = page.digest
+
+
+    async def fetch_body(self,
+                         url,
+                         read='text',
+                         session=None,
+                         headers=None,
+                         params=None,
+                         timeout=None,
+                         retries=FETCH_RETRIES):
+        """GETs a page and reads its body, retrying transient failures
+
+        Returns (response, body). body is response.text(), or response.json()
+        if read='json', and None if the status is not 200. Each attempt,
+        including reading the body, must finish within timeout secs, and
+        holds one of the cog's batch_sem slots while it runs.
+
+        Timeouts, connection errors, 429s and 5xx responses are retried up to
+        `retries` times with jittered backoff; the last error is raised, or
+        the last 429/5xx response returned.
+        """
+        timeout = timeout or self.timeout_secs
+        attempt = 0
+        while True:
+            try:
+                async with self.batch_sem:
+                    response, body = await asyncio.wait_for(
+                        self._get_body(url, read, session, headers, params,
+                                       timeout),
+                        timeout)
+                retryable = response.status == 429 or response.status >= 500
+                if not retryable or attempt >= retries:
+                    return response, body
+                reason = f'HTTP {response.status}'
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= retries:
+                    raise
+                reason = e.__class__.__name__
+
+            attempt += 1
+            self.fetch_stats['retries'] += 1
+            backoff = RETRY_BASE_SECS * 2 ** (attempt - 1)
+            backoff += uniform(0, backoff / 2)
+            log.info('[%s] GET %s failed (%s), retry %s/%s in %.1fs',
+                     self._derived_name, url, reason, attempt, retries,
+                     backoff)
+            await asyncio.sleep(backoff)
+
+
+    async def _get_body(self, url, read, session, headers, params, timeout):
+        response = await self.fetch(url,
+                                    session=session,
+                                    headers=headers,
+                                    params=params,
+                                    timeout=timeout)
+        try:
+            body = None
+            if response.status == 200:
+                if read == 'json':
+                    body = await response.json()
+                else:
+                    body = await response.text()
+            return response, body
+        finally:
+            response.release()
+
+
+    async def batch_fetch(self, *urls, read='text', **kwargs):
+        """fetch_body() on multiple pages, returning bodies in urls order
+
+        At most TRACKER_BATCH_MAX_CONCURRENT pages are fetched at once, and
+        each page fails on its own: pages that could not be loaded after
+        retries, or did not return 200, are None.
+        """
+        results = await asyncio.gather(
+            *[self.fetch_body(url, read=read, **kwargs) for url in urls],
+            return_exceptions=True
+        )
+
+        bodies = []
+        for url, result in zip(urls, results):
+            body = None
+            if isinstance(result, Exception):
+                self.fetch_stats['failed'] += 1
+                log.warning('[%s] GET %s failed (%s: %s)', self._derived_name,
+                            url, result.__class__.__name__, result)
+            else:
+                response, body = result
+                if response.status != 200:
+                    self.fetch_stats['failed'] += 1
+                    log.warning('[%s] GET %s returned HTTP %s',
+                                self._derived_name, url, response.status)
+            bodies.append(body)
+        return bodies
+
+
+    async def batch_get_changed(self, *urls, **kwargs):
+        """fetch_if_changed() on multiple pages, in the same order as urls
+
+        Pages are fetched as in batch_fetch(). Pages that failed to load are
+        None, like unchanged pages. Pass the result to commit_pages() once
+        the pages have been handled.
+        """
+        pages = await asyncio.gather(
+            *[self.fetch_if_changed(url, **kwargs) for url in urls],
+            return_exceptions=True
+        )
+
+        results = []
+        for url, page in zip(urls, pages):
+            if isinstance(page, Exception):
+                self.fetch_stats['failed'] += 1
+                log.warning('[%s] GET %s failed (%s: %s)', self._derived_name,
+                            url, page.__class__.__name__, page)
+                page = None
+            results.append(page)
+        return results
+
+
     async def batch_get_urls(self,
                              loop,
                              *urls,
@@ -149,7 +431,11 @@ class TrackerCog(commands.Cog):
                              headers=None,
                              params=None,
                              return_exceptions=False):
-        """Conveniently abstracts over fetch() to grab multiple pages"""
+        """Conveniently abstracts over fetch() to grab multiple pages
+
+        Requests are unbounded and bodies are left unread; prefer
+        batch_fetch(), which bounds, retries and reads pages concurrently.
+        """
         session = session or self.aiohttp_session
 
         responses = await asyncio.gather(
@@ -175,10 +461,16 @@ class TrackerCog(commands.Cog):
 
 
 class SeleniumTrackerCog(TrackerCog):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    """TrackerCog that loads pages in headless Chrome, for sites that need JS
 
-        self.driver = None
+    Pages are loaded by a DriverPool, so batch_get_urls() loads up to
+    SELENIUM_POOL_SIZE pages at once. Every WebDriver call runs on the pool's
+    executor, so the event loop keeps serving commands while pages load.
+    """
+    def __init__(self, bot, *args, **kwargs):
+        super().__init__(bot, *args, **kwargs)
+
+        self.driver_pool = DriverPool(self.make_driver, loop=bot.loop)
 
 
     @property
@@ -186,14 +478,17 @@ class SeleniumTrackerCog(TrackerCog):
         return None
 
 
-    async def setup_driver(self):
-        if self.driver:
-            return
+    def cog_unload(self):
+        super().cog_unload()
+        self.driver_pool.close()
 
+
+    def make_driver(self):
+        """Starts a headless Chrome WebDriver; blocks while it starts"""
         driveroptions = webdriver.chrome.options.Options()
         driveroptions.add_argument('--headless')
         driveroptions.add_argument('--disable-gpu')
-        driveroptions.add_argument('--no-sandbox')    
+        driveroptions.add_argument('--no-sandbox')
 
         exe_location = CHROME_BINARY_PATH
         if '/app/.apt/' in appconfig.from_env('PATH'):
@@ -204,17 +499,32 @@ class SeleniumTrackerCog(TrackerCog):
 
         log.info('Setting up driver with location: %s', exe_location)
         try:
-            self.driver = webdriver.Chrome(executable_path=exe_location,
-                                           options=driveroptions)
+            driver = webdriver.Chrome(executable_path=exe_location,
+                                      options=driveroptions)
         except WebDriverException as e:
             log.error('Failed to start driver (%s)', e)
             raise
 
+        # Lets the browser abort slow loads itself, freeing the thread
+        driver.set_page_load_timeout(self.timeout_secs)
+        return driver
+
+
+    async def async_get(self, url, driver, timeout=None):
+        """Awaitable wrapper over the synchronous driver.get()
+
+        Raises asyncio.TimeoutError or selenium's TimeoutException if the
+        page takes longer than timeout secs to load.
+        """
+        timeout = (timeout or self.timeout_secs) + SELENIUM_TIMEOUT_GRACE_SECS
+        return await self.driver_pool.run(driver.get, url, timeout=timeout)
 
-    async def async_get(self, url, driver=None):
-        """Awaitable wrapper over the synchronous driver.get()"""
-        driver = driver or self.driver
-        return driver.get(url)
+
+    async def load_page(self, url, driver, timeout=None, wait=0):
+        await self.async_get(url, driver, timeout)
+        if wait:
+            await asyncio.sleep(wait)
+        return await self.driver_pool.run(lambda: driver.page_source)
 
 
     async def fetch(self,
@@ -222,34 +532,53 @@ class SeleniumTrackerCog(TrackerCog):
                     driver=None,
                     timeout=None,
                     wait=0):
-        if not driver:
-            if not self.driver:
-                await self.setup_driver()
-            driver = self.driver
-
-        timeout = timeout or self.timeout_secs
+        """Loads a page, returning its source, or None if it timed out
 
+        Uses a driver leased from the pool, unless one is given. A leased
+        driver that times out is quit rather than returned to the pool, since
+        it may still be stuck on the load.
+        """
         try:
-            task = self.async_get(url, driver)
-            await asyncio.wait_for(task, timeout=timeout)
-            if wait:
-                await asyncio.sleep(wait)
-        except asyncio.TimeoutError:
-            return None
+            if driver:
+                return await self.load_page(url, driver, timeout, wait)
 
-        return self.driver.page_source
+            async with self.driver_pool.lease() as driver:
+                return await self.load_page(url, driver, timeout, wait)
 
+        except (asyncio.TimeoutError, TimeoutException):
+            log.info('[%s] timed out loading %s', self._derived_name, url)
+            return None
 
-    async def refresh(self, wait=0):
-        if not self.driver:
-            return
 
-        self.driver.refresh()
+    async def refresh(self, driver, wait=0):
+        timeout = self.timeout_secs + SELENIUM_TIMEOUT_GRACE_SECS
+        await self.driver_pool.run(driver.refresh, timeout=timeout)
         if wait:
             await asyncio.sleep(wait)
 
-        return self.driver.page_source
+        return await self.driver_pool.run(lambda: driver.page_source)
+
+
+    async def batch_get_urls(self,
+                             loop,
+                             *urls,
+                             timeout=None,
+                             wait=0):
+        """Loads pages on the pool's drivers, returning sources in urls order
 
+        Pages that failed or timed out are None.
+        """
+        results = await asyncio.gather(
+            *[self.fetch(url, timeout=timeout, wait=wait) for url in urls],
+            return_exceptions=True
+        )
 
-    async def batch_get_urls(self, *args, **kwargs):
-        raise NotImplementedError('Not supported on Selenium drivers')
+        pages = []
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                log.warning('[%s] failed to load %s (%s: %s)',
+                            self._derived_name, url,
+                            result.__class__.__name__, result)
+                result = None
+            pages.append(result)
+        return pages
@@ -7,13 +7,13 @@ from typing import List, Mapping
 
 from discord import Embed
 
+from cogs.tracking.scheduler import CronSchedule
+
 log = logging.getLogger(__name__)
 
-# Check every 10 min whether we are near midnight, if yes then trigger update
 TRACKER_UPDATE_INTERVAL_MINS = 10
-WIGGLE_ROOM_MINS = TRACKER_UPDATE_INTERVAL_MINS // 2
-
-CACHED = {}
+# Mins after the close to wait for the day's final prices
+CLOSE_WIGGLE_MINS = TRACKER_UPDATE_INTERVAL_MINS // 2
 
 Unicode = SimpleNamespace(**{
     'ARROW_UP':   '▲',
@@ -235,32 +235,11 @@ class YahooFinanceMixin:
         return TRACKER_UPDATE_INTERVAL_MINS * 60
 
 
-    def is_time_to_update(self, h_hour=20, wiggle_mins=WIGGLE_ROOM_MINS):
-        """If wiggle == 5, returns true between [(hour-1)55, (hour)05] inclusive
-        Hour should be in the range [0, 23] inclusive.
-
-        Generally wiggle_mins should be less than half of update_interval_secs
-        """
-        interval = self.update_interval_secs // 60
-        wiggle = wiggle_mins or interval // 2 # rounds down, thanks Python!
-        sg_now = datetime.utcnow().timestamp() + 8 * 60 * 60  # Time now GMT+8
-        sg_now_dt = datetime.fromtimestamp(sg_now)
-        wkday, hour, minute = map(int, sg_now_dt.strftime('%w %H %M').split())
-
-        h = h_hour % 24
-
-        if wkday in {6: 'Sat', 0: 'Sun'}:
-            return False
-
-        if hour == (h - 1) and minute >= (60 - wiggle):
-            # if H-hour is 2000, check if time is >= (2000 - wiggle)
-            return True
-
-        if hour == h and minute <= wiggle:
-            # If time is <= (2000 + wiggle)
-            return True
-
-        return False
+    @property
+    def cron_schedule(self) -> CronSchedule:
+        """Shortly after the SGX close, on weekdays (Singapore time)"""
+        return CronSchedule(f'{CLOSE_WIGGLE_MINS} 20 * * 1-5',
+                            utcoffset=timedelta(hours=8))
 
 
     async def handle_parsed(self, apidatas: Mapping[str, dict]) -> None:
@@ -278,13 +257,17 @@ class YahooFinanceMixin:
                      'subscribers to be notified.', self.topic)
             return
 
-        updates = {}
-        for symbol, apidata in apidatas.items():
-            name = self.symbols[symbol]
-            ticker = TickerToday(symbol, name, apidata)
-            if ticker.cachekey not in CACHED:
-                updates[ticker.cachekey] = ticker
-                CACHED[ticker.cachekey] = True
+        tickers = [
+            TickerToday(symbol, self.symbols[symbol], apidata)
+            for symbol, apidata in apidatas.items()
+        ]
+        # Market close times are not post times, so there is no age cutoff
+        updates = {
+            ticker.cachekey: ticker
+            for ticker in await self.unseen(tickers,
+                                            key=lambda t: t.cachekey,
+                                            max_age_secs=None)
+        }
 
         if not updates:
             return
@@ -292,17 +275,16 @@ class YahooFinanceMixin:
         log.info('%s new ticker updates for topic "%s"', len(updates), topic)
 
         tickers = updates.values()
-        sendargs = [
-            dict(content=None, embed=self.compose_summary(tickers))
+        # One summary covers all the updated tickers
+        articleid = ','.join(sorted(updates.keys()))
+        messages = [
+            (articleid, dict(content=None, embed=self.compose_summary(tickers)))
         ]
-        await pscog.push_to_topic(self.topic, sendargs)
+        await pscog.enqueue_to_topic(topic, messages)
+        await self.mark_seen(tickers, key=lambda t: t.cachekey)
 
 
     async def do_work(self):
-        # No-op if not midnight yet
-        if not self.is_time_to_update():
-            return True
-
         log.info(f'Checking "{self.topic}" for ticker updates...')
 
         apidatas = await self.pull()
@@ -323,6 +305,14 @@ class YahooFinanceMixin:
         if any(parse_ok):  # any() not needed but nice semantics
             await self.handle_parsed(parse_ok)
 
+        # There is one scheduled poll a day, so have the scheduler retry it
+        # for the tickers that didn't come through; those announced already
+        # are filtered out by unseen() on the retry
+        missing = [symbol for symbol in self.symbols
+                   if symbol not in parse_ok]
+        if missing:
+            raise RuntimeError(f'no prices for {", ".join(missing)}')
+
         return True
 
 
@@ -382,7 +372,6 @@ class YahooFinanceMixin:
 
 
     async def pull(self) -> Mapping[str, dict]:
-        loop = self.bot.loop
         urls = [f'https://query1.finance.yahoo.com/v8/finance/chart/{sym.lower()}'
                 for sym in self.symbols]
         headers = {
@@ -397,15 +386,15 @@ class YahooFinanceMixin:
             '.tsrc': 'finance',
         }
 
-        resps = []
-        # awaitable:
-        a_reqs = self.batch_get_urls(loop, *urls, headers=headers, params=params)
-        for resp in await a_reqs:
-            if resp.status == 200:
-                resps.append(await resp.json())
+        resps = await self.batch_fetch(*urls,
+                                       read='json',
+                                       headers=headers,
+                                       params=params)
 
+        # Symbols that failed to load are left out
         return {symbol: json
-                for symbol, json in zip(self.symbols, resps)}
+                for symbol, json in zip(self.symbols, resps)
+                if json is not None}
 
 
     def compose_summary(self, tickers):
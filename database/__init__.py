@@ -1,10 +1,13 @@
 import asyncio
+from datetime import datetime
 import logging
 from threading import Lock as ThreadingLock
+import time
 
 import aiopg
 
 import appconfig
+from .metrics import PoolMetrics
 
 
 log = logging.getLogger(__name__)
@@ -12,12 +15,29 @@ log = logging.getLogger(__name__)
 
 URL = appconfig.fetch('DATABASE', 'URL')
 
+POOL_MIN_SIZE = int(appconfig.fetch('DATABASE', 'POOL_MIN_SIZE'))
+POOL_MAX_SIZE = int(appconfig.fetch('DATABASE', 'POOL_MAX_SIZE'))
+ACQUIRE_TIMEOUT_SECS = appconfig.fetch('DATABASE', 'ACQUIRE_TIMEOUT_SECS')
+RECYCLE_SECS = appconfig.fetch('DATABASE', 'RECYCLE_SECS')
+HEALTH_CHECK_SECS = appconfig.fetch('DATABASE', 'HEALTH_CHECK_SECS')
+
 DEFAULT_POOL_ARGS = {
     'dsn': URL,
+    'minsize': POOL_MIN_SIZE,
+    'maxsize': POOL_MAX_SIZE,
+    # Connections older than this are closed and replaced on acquire
+    'pool_recycle': RECYCLE_SECS,
 }
 
 POOL = None
 CLOSING = False
+CLOSE_TASK = None
+HEALTH_CHECK_TASK = None
+
+# Coroutine functions awaited before the pool closes, see register_flusher()
+FLUSHERS = []
+
+METRICS = PoolMetrics()
 
 LOCK = asyncio.Lock()
 LOCK_SYNC = ThreadingLock()
@@ -26,8 +46,12 @@ class PoolClosedError(RuntimeError):
     pass
 
 
+class AcquireTimeoutError(RuntimeError):
+    pass
+
+
 async def setup_pool(**kwargs):
-    global CLOSING, LOCK, POOL
+    global CLOSING, HEALTH_CHECK_TASK, LOCK, POOL
 
     async with LOCK:
         try:
@@ -41,7 +65,9 @@ async def setup_pool(**kwargs):
                 kw.update(kwargs)
                 POOL = await aiopg.create_pool(**kw)
                 CLOSING = False
-                log.info('Database connection pool ready.')
+                HEALTH_CHECK_TASK = asyncio.ensure_future(health_check_loop())
+                log.info('Database connection pool ready (size %s-%s).',
+                         POOL.minsize, POOL.maxsize)
 
         except BaseException as e:
             log.error('Failed to setup database connection pool: %s', e)
@@ -68,6 +94,78 @@ async def get_pool():
     return POOL
 
 
+class acquire:
+    """Acquires a pooled connection, recording wait time and usage.
+
+    Use in place of POOL.acquire():
+        async with database.acquire() as conn:
+            ...
+
+    Raises AcquireTimeoutError if no connection frees up within
+    ACQUIRE_TIMEOUT_SECS.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout or ACQUIRE_TIMEOUT_SECS
+        self.pool = None
+        self.conn = None
+
+
+    async def __aenter__(self):
+        self.pool = await get_pool()
+
+        start = time.perf_counter()
+        try:
+            self.conn = await asyncio.wait_for(self.pool.acquire(),
+                                               self.timeout)
+        except asyncio.TimeoutError:
+            METRICS.acquire_timeouts += 1
+            msg = (f'timed out after {self.timeout}s waiting for a '
+                   f'connection (pool size {self.pool.size}, '
+                   f'free {self.pool.freesize})')
+            log.error(msg)
+            raise AcquireTimeoutError(msg)
+
+        METRICS.observe_acquire((time.perf_counter() - start) * 1000)
+        return self.conn
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        METRICS.observe_release()
+        await self.pool.release(self.conn)
+
+
+async def health_check_loop():
+    """Pings the database every HEALTH_CHECK_SECS.
+
+    If a ping fails, idle connections are dropped from the pool so they get
+    replaced by fresh ones, rather than failing the next query that picks
+    them up.
+    """
+    while POOL and not POOL.closed:
+        await asyncio.sleep(HEALTH_CHECK_SECS)
+        if not POOL or POOL.closed:
+            break
+
+        METRICS.health_checks += 1
+        METRICS.last_health_check = datetime.utcnow().replace(microsecond=0)
+        try:
+            async with acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('SELECT 1;')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            METRICS.health_failures += 1
+            log.error('Database health check failed (%s: %s), clearing idle '
+                      'connections', e.__class__.__name__, e)
+            await POOL.clear()
+
+
+def report():
+    """Human-readable summary of pool state and metrics"""
+    return METRICS.report(POOL)
+
+
 # def sync_setup_pool(loop=None):
 #     loop = loop or asyncio.get_event_loop()
 #     fut = loop.call_soon(setup_pool)
@@ -79,25 +177,69 @@ async def get_pool():
 #         log.error('Timed out while waiting to set up connection')
 
 
+def register_flusher(flush):
+    """Registers a coroutine function to await before the pool closes.
+
+    Use this to write out rows held in memory, so they aren't lost on
+    shutdown, or run against a pool that is already closed.
+    """
+    if flush not in FLUSHERS:
+        FLUSHERS.append(flush)
+
+
+def unregister_flusher(flush):
+    if flush in FLUSHERS:
+        FLUSHERS.remove(flush)
+
+
+async def shutdown_pool(flushers):
+    """Awaits the flushers, then closes the pool"""
+    global HEALTH_CHECK_TASK
+
+    for flush in flushers:
+        try:
+            await flush()
+        except Exception as e:
+            log.error('Failed to flush %s before closing the pool (%s: %s)',
+                      getattr(flush, '__qualname__', flush),
+                      e.__class__.__name__, e)
+
+    if HEALTH_CHECK_TASK:
+        HEALTH_CHECK_TASK.cancel()
+        HEALTH_CHECK_TASK = None
+
+    # Signal connections to close
+    POOL.close()
+    await POOL.wait_closed()
+    log.info('Database connection pool shut down.')
+
+
 def close_pool(loop=None):
-    global POOL, CLOSING, LOCK_SYNC
+    """Flushes registered flushers, then closes the pool.
+
+    When the loop is already running, such as when cogs are unloaded by
+    bot.close(), this only schedules the shutdown; await wait_closed() to
+    wait for it to finish.
+    """
+    global CLOSE_TASK, CLOSING, LOCK_SYNC
 
     with LOCK_SYNC:
 
-        if CLOSING or POOL.closed:
+        if CLOSING or not POOL or POOL.closed:
             return
 
-        # Signal connections to close
-        POOL.close()
         CLOSING = True
-
         log.info('Closing database connection pool.')
-        coro = POOL.wait_closed()
+
+        coro = shutdown_pool(list(FLUSHERS))
         loop = loop or asyncio.get_event_loop()
-        loop.run_until_complete(coro)
-        log.info('Database connection pool shut down.')
-        # try:
-        #     yield from future
-        # except asyncio.TimeoutError:
-        #     print('Shutdown took too long, returning control without cancel...')
-        # else:
+        if loop.is_running():
+            CLOSE_TASK = loop.create_task(coro)
+        else:
+            loop.run_until_complete(coro)
+
+
+async def wait_closed():
+    """Waits for a shutdown scheduled by close_pool(), if any"""
+    if CLOSE_TASK:
+        await CLOSE_TASK
@@ -0,0 +1,70 @@
+"""metrics.py
+
+Counters and latency histograms for the database connection pool.
+"""
+
+from collections import defaultdict
+
+from utils.histogram import LatencyHistogram
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquire_wait = LatencyHistogram()
+
+        self.queries = 0
+        self.query_errors = 0
+        self.query_latency = LatencyHistogram()
+        # Prepared statement name -> LatencyHistogram
+        self.statement_latency = defaultdict(LatencyHistogram)
+
+        self.health_checks = 0
+        self.health_failures = 0
+        self.last_health_check = None
+
+
+    def observe_acquire(self, wait_ms: float):
+        self.acquires += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        self.acquire_wait.observe(wait_ms)
+
+
+    def observe_release(self):
+        self.in_use -= 1
+
+
+    def observe_query(self, elapsed_ms: float, failed: bool = False):
+        self.queries += 1
+        if failed:
+            self.query_errors += 1
+        self.query_latency.observe(elapsed_ms)
+
+
+    def observe_statement(self, name: str, elapsed_ms: float):
+        self.statement_latency[name].observe(elapsed_ms)
+
+
+    def report(self, pool=None) -> str:
+        lines = []
+        if pool is not None:
+            lines.append(f'pool: size={pool.size} free={pool.freesize} '
+                         f'min={pool.minsize} max={pool.maxsize}')
+        lines.extend([
+            f'in use: {self.in_use} (peak {self.peak_in_use})',
+            f'acquires: {self.acquires} '
+            f'(timeouts {self.acquire_timeouts})',
+            f'acquire wait: {self.acquire_wait.summary()}',
+            f'queries: {self.queries} (errors {self.query_errors})',
+            f'query latency: {self.query_latency.summary()}',
+            f'health checks: {self.health_checks} '
+            f'(failures {self.health_failures}, '
+            f'last {self.last_health_check})',
+        ])
+        for name, hist in sorted(self.statement_latency.items()):
+            lines.append(f'  {name}: {hist.summary()}')
+        return '\n'.join(lines)
@@ -0,0 +1,249 @@
+"""querycheck.py
+
+Runs the bot's hand-written SQL against a real Postgres, to catch statements
+that only fail at runtime.
+
+    python -m database.querycheck
+
+Connects to the configured DATABASE URL, but only works inside a throwaway
+schema: every schema_*.sql file is applied there, the checks run with it as
+the search_path, and it is dropped at the end. Nothing outside it is read or
+written.
+
+Each check drives the real code, e.g. OutboundQueue, and checks the rows it
+leaves behind. Add a function decorated with @check to cover a new query.
+"""
+
+import asyncio
+from datetime import datetime
+import glob
+import os
+import sys
+import traceback
+
+import psycopg2
+
+import database
+from database import unregister_flusher
+
+
+SCHEMA = f'querycheck_{os.getpid()}'
+SCHEMA_FILES = sorted(glob.glob(
+    os.path.join(os.path.dirname(__file__), 'schema_*.sql')))
+
+CHECKS = []
+
+
+def check(func):
+    CHECKS.append(func)
+    return func
+
+
+def expect(actual, expected, what: str):
+    if actual != expected:
+        raise AssertionError(f'{what}: expected {expected!r}, '
+                             f'got {actual!r}')
+
+
+class RecordingChannel:
+    """Stands in for a discord channel, keeping what is sent to it"""
+    def __init__(self, channelid: int):
+        self.id = channelid
+        self.sent = []
+
+    async def send(self, **kwargs):
+        self.sent.append(kwargs)
+
+    def __str__(self):
+        return f'channel-{self.id}'
+
+
+class CheckBot:
+    def __init__(self, channels):
+        self.channels = {channel.id: channel for channel in channels}
+        self.loop = asyncio.get_event_loop()
+
+    def get_channel(self, channelid):
+        return self.channels.get(channelid)
+
+
+def make_db_cog(bot):
+    from cogs.delivery import DeliveryEngine
+    from cogs.mixins import DatabaseCogMixin
+
+    class CheckCog(DatabaseCogMixin):
+        def __init__(self):
+            super().__init__()
+            self.bot = bot
+            self.delivery = DeliveryEngine()
+
+    return CheckCog()
+
+
+@check
+async def outbound_queue():
+    from cogs.outbound import OUTBOUND_MAX_ATTEMPTS, OutboundQueue
+
+    present = RecordingChannel(1)
+    # Channel 2 is subscribed but missing, so its sends fail
+    cog = make_db_cog(CheckBot([present]))
+    queue = OutboundQueue(cog)
+
+    channels = [(1, 'present'), (2, 'missing')]
+    messages = [('b', dict(content='first', embed=None)),
+                ('a', dict(content='second', embed=None))]
+
+    expect(await queue.enqueue('t', channels, messages), 4, 'rows enqueued')
+    expect(await queue.enqueue('t', channels, messages), 0,
+           'rows enqueued again')
+
+    expect(await queue.drain_once(), 4, 'rows claimed')
+    expect([kwargs['content'] for kwargs in present.sent],
+           ['first', 'second'], 'messages sent in order')
+
+    expect(await queue.enqueue('t', channels, messages), 0,
+           'rows enqueued after sending')
+
+    rows = await cog.db_query('SELECT * FROM outbound_messages ORDER BY id;')
+    expect([(r['channelid'], r['attempts']) for r in rows],
+           [(2, 1), (2, 1)], 'failed rows left to retry')
+
+    last_tries = [(dict(row, attempts=OUTBOUND_MAX_ATTEMPTS - 1), 'gone')
+                  for row in rows]
+    await queue.mark_failed(last_tries)
+    expect(await queue.requeue_dead(), 2, 'dead rows requeued')
+
+    await queue.prune_if_due()
+    expect(await queue.report(),
+           'pending: 2 (retrying 0)\ndead-lettered: 0', 'report')
+
+
+@check
+async def seen_store():
+    from cogs.tracking.seen import SeenStore, execute
+
+    seen = SeenStore('t')
+    expect(await seen.filter_unseen(['1', '2']), set(), 'first batch')
+    expect(await seen.filter_unseen(['2', '3']), {'3'}, 'unseen after seeding')
+    expect(await seen.filter_unseen(['3']), {'3'}, 'unseen before marking')
+    await seen.mark_seen(['3'])
+
+    # A fresh process, with an empty LRU
+    seen = SeenStore('t')
+    expect(await seen.filter_unseen(['1', '3', '4']), {'4'},
+           'unseen after restart')
+
+    # Compaction may delete every row of a quiet topic
+    await execute("DELETE FROM tracker_seen WHERE topic = 't';")
+    seen = SeenStore('t')
+    expect(await seen.filter_unseen(['5']), {'5'},
+           'unseen after compaction emptied the topic')
+
+    # Topics tracked before tracker_topics existed are already seeded
+    await execute("INSERT INTO tracker_seen VALUES ('old', '1', now());")
+    seen = SeenStore('old')
+    expect(await seen.filter_unseen(['1', '2']), {'2'},
+           'unseen on a topic without a marker')
+
+
+@check
+async def emojistats_schema():
+    from cogs.emojistats.cog import EmojiTools
+    from cogs.tracking.seen import execute
+
+    # The table as first deployed, before guildid and the rollups
+    await execute("""
+        DROP TABLE emojistats, emojistats_rowcount, emojistats_hourly,
+                   emojistats_daily;
+        CREATE TABLE emojistats (
+            tstamp      TIMESTAMP   NOT NULL,
+            userid      BIGINT      NOT NULL,
+            emojistr    TEXT        NOT NULL,
+            recipientid BIGINT,
+            PRIMARY KEY (tstamp, userid, emojistr)
+        );
+        INSERT INTO emojistats VALUES ('2020-01-01', 1, '<:a:1>', NULL);""")
+    path = os.path.join(os.path.dirname(__file__), 'schema_emojistats.sql')
+    apply_schema_files([path, path])
+
+    cog = EmojiTools(CheckBot([]))
+    try:
+        await cog.get_row_count()
+        expect(cog.rows_count, 1, 'rows kept by the migration')
+
+        row = (datetime(2020, 1, 2), 1, '<:a:1>', None, 5)
+        expect(await cog.insert_usage_rows([row]), 1, 'rows inserted')
+        expect(await cog.insert_usage_rows([row]), 0, 'rows inserted again')
+
+        await cog.get_row_count()
+        expect(cog.rows_count, 2, 'counted rows')
+        rows = await cog.db_query('SELECT guildid, uses FROM emojistats_daily;')
+        expect([tuple(r) for r in rows], [(5, 1)], 'daily rollup')
+    finally:
+        unregister_flusher(cog.usage_buffer.flush)
+
+
+def apply_schema_files(paths):
+    conn = psycopg2.connect(database.URL)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'SET search_path TO {SCHEMA};')
+            for path in paths:
+                with open(path, encoding='utf-8') as f:
+                    cur.execute(f.read())
+    finally:
+        conn.close()
+
+
+def create_schema():
+    conn = psycopg2.connect(database.URL)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'CREATE SCHEMA {SCHEMA};')
+    finally:
+        conn.close()
+    apply_schema_files(SCHEMA_FILES)
+
+
+def drop_schema():
+    conn = psycopg2.connect(database.URL)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;')
+    finally:
+        conn.close()
+
+
+async def run_checks() -> int:
+    await database.setup_pool(options=f'-c search_path={SCHEMA}')
+
+    failures = 0
+    for func in CHECKS:
+        try:
+            await func()
+            print(f'ok    {func.__name__}')
+        except Exception:
+            failures += 1
+            print(f'FAIL  {func.__name__}')
+            traceback.print_exc()
+    return failures
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    try:
+        create_schema()
+        failures = loop.run_until_complete(run_checks())
+    finally:
+        if database.POOL:
+            database.close_pool(loop)
+        drop_schema()
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
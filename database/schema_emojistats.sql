@@ -1,19 +1,118 @@
 -- pgsql
+-- Safe to re-run: creates what is missing and keeps existing rows
 
-DROP TABLE IF EXISTS emojistats;
-CREATE TABLE "emojistats" (
+CREATE TABLE IF NOT EXISTS "emojistats" (
     tstamp      TIMESTAMP   NOT NULL,
     userid      BIGINT      NOT NULL,
     emojistr    TEXT        NOT NULL,
     recipientid BIGINT,
+    guildid     BIGINT,
     PRIMARY KEY (tstamp, userid, emojistr)
 );
+-- Added after the table was first deployed
+ALTER TABLE emojistats ADD COLUMN IF NOT EXISTS guildid BIGINT;
 -- recipientid is used for reacts, indicating the author of the message
 -- receiving the react
+-- guildid is the guild the emoji was used in, NULL for DMs
 
-DROP TABLE IF EXISTS emojistats_archive;
-CREATE TABLE "emojistats_archive" (
+CREATE TABLE IF NOT EXISTS "emojistats_archive" (
     tstamp      TIMESTAMP   PRIMARY KEY,
     emoji_json  JSON        NOT NULL,
     total_count INT         NOT NULL
 );
+
+-- Exact row count of emojistats, maintained by the triggers below so it can
+-- be read without scanning the table
+CREATE TABLE IF NOT EXISTS "emojistats_rowcount" (
+    id          BOOLEAN     PRIMARY KEY DEFAULT TRUE CHECK (id),
+    row_count   BIGINT      NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION emojistats_count_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE emojistats_rowcount
+        SET row_count = row_count + (SELECT count(*) FROM inserted_rows);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION emojistats_count_deleted() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE emojistats_rowcount
+        SET row_count = row_count - (SELECT count(*) FROM deleted_rows);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION emojistats_count_truncated() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE emojistats_rowcount SET row_count = 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement-level so a multi-row insert/delete updates the counter once.
+-- Recreated together with the count below, so no write is missed in between.
+BEGIN;
+LOCK TABLE emojistats IN SHARE ROW EXCLUSIVE MODE;
+
+DROP TRIGGER IF EXISTS emojistats_rowcount_insert ON emojistats;
+CREATE TRIGGER emojistats_rowcount_insert
+    AFTER INSERT ON emojistats
+    REFERENCING NEW TABLE AS inserted_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE emojistats_count_inserted();
+
+DROP TRIGGER IF EXISTS emojistats_rowcount_delete ON emojistats;
+CREATE TRIGGER emojistats_rowcount_delete
+    AFTER DELETE ON emojistats
+    REFERENCING OLD TABLE AS deleted_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE emojistats_count_deleted();
+
+DROP TRIGGER IF EXISTS emojistats_rowcount_truncate ON emojistats;
+CREATE TRIGGER emojistats_rowcount_truncate
+    AFTER TRUNCATE ON emojistats
+    FOR EACH STATEMENT EXECUTE PROCEDURE emojistats_count_truncated();
+
+INSERT INTO emojistats_rowcount (row_count)
+    SELECT count(*) FROM emojistats
+    ON CONFLICT (id) DO UPDATE SET row_count = EXCLUDED.row_count;
+COMMIT;
+
+-- The trim cutoff lookup (ORDER BY tstamp DESC OFFSET n) and the range
+-- deletes that follow it use the primary key, which leads with tstamp
+DROP INDEX IF EXISTS emojistats_tstamp_idx;
+
+-- Usage rollups, bumped for every row inserted into emojistats and kept after
+-- emojistats is trimmed. Leaderboards read these instead of the raw table.
+-- guildid is 0 for DMs so it can be part of the key.
+CREATE TABLE IF NOT EXISTS "emojistats_hourly" (
+    guildid     BIGINT      NOT NULL,
+    bucket      TIMESTAMP   NOT NULL,
+    userid      BIGINT      NOT NULL,
+    emojistr    TEXT        NOT NULL,
+    uses        INT         NOT NULL,
+    PRIMARY KEY (guildid, bucket, userid, emojistr)
+);
+CREATE INDEX IF NOT EXISTS emojistats_hourly_user_idx
+    ON emojistats_hourly (guildid, userid, bucket);
+
+CREATE TABLE IF NOT EXISTS "emojistats_daily" (
+    guildid     BIGINT      NOT NULL,
+    bucket      TIMESTAMP   NOT NULL,
+    userid      BIGINT      NOT NULL,
+    emojistr    TEXT        NOT NULL,
+    uses        INT         NOT NULL,
+    PRIMARY KEY (guildid, bucket, userid, emojistr)
+);
+CREATE INDEX IF NOT EXISTS emojistats_daily_user_idx
+    ON emojistats_daily (guildid, userid, bucket);
+
+-- Per-channel progress of the !scrape command, so interrupted scrapes resume
+-- after the last message whose emoji were ingested
+CREATE TABLE IF NOT EXISTS "emojistats_scrape_progress" (
+    channelid       BIGINT      PRIMARY KEY,
+    guildid         BIGINT      NOT NULL,
+    lastmessageid   BIGINT,
+    isdone          BOOLEAN     NOT NULL DEFAULT FALSE,
+    tstamp          TIMESTAMP   NOT NULL
+);
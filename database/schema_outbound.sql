@@ -0,0 +1,40 @@
+-- Announcements waiting to be sent, one row per message per channel
+DROP TABLE IF EXISTS outbound_messages;
+CREATE TABLE "outbound_messages" (
+    id              BIGSERIAL   PRIMARY KEY,
+    topic           TEXT        NOT NULL,
+    articleid       TEXT        NOT NULL,
+    channelid       BIGINT      NOT NULL,
+    payload         JSON        NOT NULL,  -- {"content": ..., "embed": ...}
+    attempts        INT         NOT NULL DEFAULT 0,
+    next_attempt    TIMESTAMP   NOT NULL,
+    lasterror       TEXT,
+    tstamp          TIMESTAMP   NOT NULL,
+    UNIQUE (topic, articleid, channelid)
+);
+CREATE INDEX outbound_messages_next_attempt_idx
+    ON outbound_messages (next_attempt);
+
+-- Idempotency keys of delivered messages, so they are not enqueued again
+DROP TABLE IF EXISTS outbound_sent;
+CREATE TABLE "outbound_sent" (
+    topic       TEXT        NOT NULL,
+    articleid   TEXT        NOT NULL,
+    channelid   BIGINT      NOT NULL,
+    tstamp      TIMESTAMP   NOT NULL,
+    PRIMARY KEY (topic, articleid, channelid)
+);
+CREATE INDEX outbound_sent_tstamp_idx ON outbound_sent (tstamp);
+
+-- Messages that ran out of attempts
+DROP TABLE IF EXISTS outbound_deadletter;
+CREATE TABLE "outbound_deadletter" (
+    topic       TEXT        NOT NULL,
+    articleid   TEXT        NOT NULL,
+    channelid   BIGINT      NOT NULL,
+    payload     JSON        NOT NULL,
+    attempts    INT         NOT NULL,
+    lasterror   TEXT,
+    tstamp      TIMESTAMP   NOT NULL,
+    PRIMARY KEY (topic, articleid, channelid)
+);
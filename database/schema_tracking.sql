@@ -0,0 +1,16 @@
+-- Safe to apply again: existing tables and rows are kept
+
+-- Articleids that trackers have already announced, per topic
+CREATE TABLE IF NOT EXISTS "tracker_seen" (
+    topic       TEXT        NOT NULL,
+    articleid   TEXT        NOT NULL,
+    tstamp      TIMESTAMP   NOT NULL,
+    PRIMARY KEY (topic, articleid)
+);
+CREATE INDEX IF NOT EXISTS tracker_seen_tstamp_idx ON tracker_seen (tstamp);
+
+-- Topics whose first batch of posts has been recorded without announcing
+CREATE TABLE IF NOT EXISTS "tracker_topics" (
+    topic       TEXT        PRIMARY KEY,
+    tstamp      TIMESTAMP   NOT NULL
+);
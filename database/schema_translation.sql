@@ -0,0 +1,10 @@
+-- Machine translations, keyed by the text sent to the translator
+DROP TABLE IF EXISTS translation_cache;
+CREATE TABLE "translation_cache" (
+    src         TEXT        NOT NULL,
+    dest        TEXT        NOT NULL,
+    source      TEXT        NOT NULL,
+    translated  TEXT        NOT NULL,
+    tstamp      TIMESTAMP   NOT NULL,
+    PRIMARY KEY (src, dest, source)
+);
@@ -10,10 +10,29 @@ from discord.ext import commands
 
 from cogs import ENABLED_COGS
 import appconfig
+import database
+from utils.httpclient import HTTP
 
 DEBUGGING = appconfig.DEBUGGING
 
 
+class Bot(commands.Bot):
+    async def close(self):
+        """Closes the bot, then waits for the cogs' shutdown work.
+
+        Unloading cogs only schedules their shutdown (see
+        database.close_pool()), so it is awaited here, before the loop stops.
+        The shared HTTP session outlives the cogs, so it is closed last.
+        """
+        try:
+            await super().close()
+        finally:
+            try:
+                await database.wait_closed()
+            finally:
+                await HTTP.close()
+
+
 if __name__ == '__main__':
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
@@ -34,7 +53,7 @@ if __name__ == '__main__':
     if DEBUGGING:
         logger.warning('Starting in debug mode.')
 
-    bot = commands.Bot(prefix)
+    bot = Bot(prefix)
 
     num_cogs_loaded = 0
     for cog_cls in ENABLED_COGS:
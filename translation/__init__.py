@@ -1 +1 @@
-from .translation import translate
+from .translation import Glossary, TranslationService, translate
@@ -0,0 +1,41 @@
+"""store.py
+
+DatabaseStore keeps translations in the translation_cache table (see
+database/schema_translation.sql), so they survive restarts.
+"""
+
+from datetime import datetime
+from typing import Dict, List, Mapping
+
+from database import acquire
+
+
+class DatabaseStore:
+    async def load(self,
+                   src: str,
+                   dest: str,
+                   sources: List[str]) -> Dict[str, str]:
+        """Returns the stored translations of sources, by source"""
+        query = """SELECT source, translated FROM translation_cache
+                   WHERE src = %s AND dest = %s AND source = ANY(%s);"""
+        async with acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, [src, dest, sources])
+                rows = await cur.fetchall()
+        return dict(rows)
+
+
+    async def save(self, src: str, dest: str, translated: Mapping[str, str]):
+        query = """INSERT INTO translation_cache
+                       (src, dest, source, translated, tstamp)
+                   SELECT %s, %s, s, t, %s
+                   FROM unnest(%s::text[], %s::text[]) AS x(s, t)
+                   ON CONFLICT (src, dest, source) DO UPDATE
+                   SET translated = EXCLUDED.translated,
+                       tstamp = EXCLUDED.tstamp;"""
+        sources = list(translated)
+        translations = [translated[s] for s in sources]
+        async with acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, [src, dest, datetime.utcnow(),
+                                          sources, translations])
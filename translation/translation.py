@@ -1,16 +1,210 @@
+"""translation.py
+
+Machine translation of short texts, like post titles.
+
+TranslationService translates a batch of texts with one call to the
+translator, which runs on the service's own thread so the event loop is never
+blocked. A batch that fails or takes longer than timeout_secs is returned
+untranslated, and is tried again the next time it is asked for.
+
+Translations are cached in memory, and in a store if one is given (see
+translation/store.py), keyed by the text sent to the translator. A text is
+only translated once, however many ticks it stays on a page.
+
+Glossary terms are substituted before translating, in one pass of a single
+compiled regex.
+
+The translator is anything with the interface of googletrans.Translator, so
+a stub can stand in for it:
+
+    class ShoutingTranslator:
+        def translate(self, texts, src, dest):
+            return [SimpleNamespace(text=text.upper()) for text in texts]
+
+    service = TranslationService(ShoutingTranslator())
+    await service.translate_many(['hello', 'world'])  # ['HELLO', 'WORLD']
 """
-TODO - make async: either wrap in loop.run_in_executor() or fork and use httpx
-"""
 
-from googletrans import Translator
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+
+log = logging.getLogger(__name__)
+
+
+# Translations kept in memory, in front of the store
+TRANSLATION_CACHE_SIZE = 1000
+# Secs to wait for the translator before giving up on a batch
+TRANSLATION_TIMEOUT_SECS = 10
+
+
+class Glossary:
+    """Substitutes terms in one pass
+
+    Where terms overlap, the longest match wins, so '神里绫华' is replaced as a
+    whole rather than as '神里' + '绫华'.
+    """
+    def __init__(self, replacements: Iterable[Tuple[str, str]]):
+        self.replacements = {}
+        for term, replacement in replacements:
+            self.replacements.setdefault(term, replacement)
+
+        terms = sorted(self.replacements, key=len, reverse=True)
+        self.pattern = (re.compile('|'.join(map(re.escape, terms)))
+                        if terms else None)
+
+
+    def apply(self, text: str) -> str:
+        if not self.pattern:
+            return text
+        return self.pattern.sub(lambda m: self.replacements[m.group(0)], text)
+
+
+GlossaryLike = Union[Glossary, Iterable[Tuple[str, str]], None]
+
+
+def as_glossary(glossary: GlossaryLike) -> Optional[Glossary]:
+    if glossary is None or isinstance(glossary, Glossary):
+        return glossary
+    return Glossary(glossary)
 
 
-client = Translator()
+_client = None
+
+
+def default_translator():
+    global _client
+    if _client is None:
+        from googletrans import Translator
+        _client = Translator()
+    return _client
+
 
 def translate(text, src='zh-cn', dest='en', replacements=None):
-    if replacements:
-        for k, v in replacements:
-            text = text.replace(k, v)
+    """Translates one text, blocking; prefer TranslationService in cogs"""
+    glossary = as_glossary(replacements)
+    if glossary:
+        text = glossary.apply(text)
 
-    result = client.translate(text, src=src, dest=dest)
+    result = default_translator().translate(text, src=src, dest=dest)
     return result.text
+
+
+class TranslationService:
+    def __init__(self,
+                 translator=None,
+                 store=None,
+                 capacity: int = TRANSLATION_CACHE_SIZE,
+                 timeout_secs: float = TRANSLATION_TIMEOUT_SECS):
+        """
+        Arguments:
+        translator - googletrans.Translator or a stand-in; defaults to the
+                     shared googletrans client
+        store - persists translations, see translation/store.py
+        capacity - translations kept in memory
+        timeout_secs - how long to wait for the translator per batch
+        """
+        self._translator = translator
+        self.store = store
+        self.capacity = capacity
+        self.timeout_secs = timeout_secs
+        # (src, dest, text) -> translation, least recently used first
+        self.cache = OrderedDict()
+        # One thread, since translator clients aren't thread-safe
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='translate')
+
+
+    @property
+    def translator(self):
+        return self._translator or default_translator()
+
+
+    async def translate(self,
+                        text: str,
+                        src: str = 'zh-cn',
+                        dest: str = 'en',
+                        glossary: GlossaryLike = None) -> str:
+        translated = await self.translate_many([text], src, dest, glossary)
+        return translated[0]
+
+
+    async def translate_many(self,
+                             texts: Sequence[str],
+                             src: str = 'zh-cn',
+                             dest: str = 'en',
+                             glossary: GlossaryLike = None
+                             ) -> List[str]:
+        """Translates texts in order; those that fail are returned as is"""
+        glossary = as_glossary(glossary)
+        sources = [glossary.apply(text) if glossary else text
+                   for text in texts]
+
+        found = {}
+        for source in sources:
+            key = (src, dest, source)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                found[source] = self.cache[key]
+
+        missing = [s for s in dict.fromkeys(sources) if s not in found]
+        if missing and self.store:
+            try:
+                found.update(await self.store.load(src, dest, missing))
+            except Exception as e:
+                log.warning('Failed to load cached translations (%s: %s)',
+                            e.__class__.__name__, e)
+            missing = [s for s in missing if s not in found]
+
+        if missing:
+            translated = await self.translate_batch(missing, src, dest)
+            found.update(translated)
+            if translated and self.store:
+                try:
+                    await self.store.save(src, dest, translated)
+                except Exception as e:
+                    log.warning('Failed to store translations (%s: %s)',
+                                e.__class__.__name__, e)
+
+        for source, translation in found.items():
+            self.remember((src, dest, source), translation)
+
+        return [found.get(source, text)
+                for source, text in zip(sources, texts)]
+
+
+    async def translate_batch(self,
+                              sources: List[str],
+                              src: str,
+                              dest: str) -> Dict[str, str]:
+        def blocking_translate():
+            return self.translator.translate(sources, src=src, dest=dest)
+
+        loop = asyncio.get_event_loop()
+        try:
+            # A call that times out can't be stopped, so the thread stays
+            # busy until it returns; later batches queue behind it
+            results = await asyncio.wait_for(
+                loop.run_in_executor(self.executor, blocking_translate),
+                self.timeout_secs)
+        except asyncio.TimeoutError:
+            log.warning('Timed out translating %s texts after %ss',
+                        len(sources), self.timeout_secs)
+            return {}
+        except Exception as e:
+            log.warning('Failed to translate %s texts (%s: %s)',
+                        len(sources), e.__class__.__name__, e)
+            return {}
+        return {source: result.text
+                for source, result in zip(sources, results)}
+
+
+    def remember(self, key: Tuple[str, str, str], translation: str):
+        self.cache[key] = translation
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
@@ -3,3 +3,4 @@ from .anypartial import anypartial
 from .memoized import memoized
 from .softdict import SoftDict
 from .digestdict import DigestDict
+from .histogram import LatencyHistogram
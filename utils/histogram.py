@@ -0,0 +1,61 @@
+"""histogram.py
+
+LatencyHistogram counts latencies into fixed buckets, which is enough to
+report averages and rough percentiles without keeping every sample.
+
+Example:
+    hist = LatencyHistogram()
+    hist.observe(12.5)
+    hist.observe(340)
+    print(hist.summary())
+    # 'n=2 avg=176.2ms p50<=25ms p95<=500ms max=340.0ms'
+"""
+
+from bisect import bisect_left
+from typing import Sequence
+
+
+# Upper bounds (in millisecs) of the latency histogram buckets; anything
+# slower lands in the overflow bucket
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of latencies in millisecs"""
+    def __init__(self, buckets_ms: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+
+    def observe(self, elapsed_ms: float):
+        self.counts[bisect_left(self.buckets_ms, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+
+    def percentile(self, pct: float) -> float:
+        """Upper bound of the bucket containing the given percentile"""
+        if not self.count:
+            return 0.0
+        threshold = self.count * pct / 100
+        seen = 0
+        for bound, n in zip(self.buckets_ms, self.counts):
+            seen += n
+            if seen >= threshold:
+                return bound
+        return self.max_ms
+
+
+    def summary(self) -> str:
+        return (f'n={self.count} avg={self.avg_ms:.1f}ms '
+                f'p50<={self.percentile(50)}ms p95<={self.percentile(95)}ms '
+                f'max={self.max_ms:.1f}ms')
@@ -0,0 +1,122 @@
+"""httpclient.py
+
+HttpClient holds the one aiohttp.ClientSession that the whole process makes
+outbound HTTP requests with.
+
+Sharing a session shares its TCPConnector, so connections are kept alive and
+reused between requests to the same host, DNS lookups are cached, and the
+number of open connections is capped both overall and per host. Requests,
+errors and latencies are counted per host.
+
+Example:
+    from utils.httpclient import HTTP
+    async with HTTP.session.get(url) as resp:
+        text = await resp.text()
+
+The session is closed by the bot's close() in main.py, so cogs leave it open.
+"""
+
+from collections import defaultdict
+import logging
+import time
+
+import aiohttp
+
+from .histogram import LatencyHistogram
+
+
+log = logging.getLogger(__name__)
+
+
+# Max open connections, across all hosts
+HTTP_LIMIT_TOTAL = 100
+# Max open connections to any one host
+HTTP_LIMIT_PER_HOST = 8
+# Secs to cache DNS lookups for
+HTTP_DNS_CACHE_SECS = 300
+# Secs an idle connection is kept open for reuse
+HTTP_KEEPALIVE_SECS = 30
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.statuses = defaultdict(int)
+        self.latency = LatencyHistogram()
+
+
+    def summary(self) -> str:
+        statuses = ' '.join(f'{status}={n}'
+                            for status, n in sorted(self.statuses.items()))
+        return (f'requests={self.requests} errors={self.errors} '
+                f'[{statuses}] latency: {self.latency.summary()}')
+
+
+class HttpClient:
+    def __init__(self):
+        self._session = None
+        self.stats = defaultdict(HostStats)
+
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, created on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_LIMIT_TOTAL,
+                limit_per_host=HTTP_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_SECS,
+                keepalive_timeout=HTTP_KEEPALIVE_SECS,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                trace_configs=[self.make_trace_config()],
+            )
+        return self._session
+
+
+    def make_trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_request_exception.append(self._on_request_exception)
+        return trace
+
+
+    async def _on_request_start(self, session, ctx, params):
+        ctx.start = time.perf_counter()
+
+
+    async def _on_request_end(self, session, ctx, params):
+        stats = self.stats[params.url.host]
+        stats.requests += 1
+        stats.statuses[params.response.status] += 1
+        stats.latency.observe((time.perf_counter() - ctx.start) * 1000)
+
+
+    async def _on_request_exception(self, session, ctx, params):
+        stats = self.stats[params.url.host]
+        stats.requests += 1
+        stats.errors += 1
+
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+    def report(self) -> str:
+        lines = []
+        if self._session and not self._session.closed:
+            connector = self._session.connector
+            lines.append(f'connections: limit={connector.limit} '
+                         f'per host={connector.limit_per_host}')
+        if not self.stats:
+            lines.append('No requests yet.')
+        for host, stats in sorted(self.stats.items()):
+            lines.append(f'{host}: {stats.summary()}')
+        return '\n'.join(lines)
+
+
+HTTP = HttpClient()
@@ -1,6 +1,6 @@
 """scraping.py
 
-Simple function to pull webpages by bulk.
+Simple function to pull webpages by bulk, over the shared HTTP session.
 """
 
 import asyncio
@@ -8,13 +8,24 @@ from typing import List, Union, Tuple
 
 import aiohttp
 
+from .httpclient import HTTP
 
 FETCH_TIMEOUT_SECS = 10
 """"""
 
 # Type aliases
 Url = str
-Result = Union[aiohttp.ClientResponse, Exception]
+Result = Union[Tuple[int, bytes], Exception]
+
+
+async def fetch(url: Url, **kwargs) -> Tuple[int, bytes]:
+    """GETs a page and reads its body, returning (status, body)
+
+    The body is read before the response is released, so the connection
+    goes back to the shared session's pool whatever the caller does next.
+    """
+    async with HTTP.session.get(url, **kwargs) as resp:
+        return resp.status, await resp.read()
 
 
 async def pull_pages(loop: asyncio.AbstractEventLoop,
@@ -22,18 +33,23 @@ async def pull_pages(loop: asyncio.AbstractEventLoop,
                      **kwargs) -> List[Tuple[Url, Result]]:
     """Pulls the given URLs by bulk. Returns when all complete.
 
+    Each result is a (status, body) tuple, or the exception raised while
+    fetching that URL.
+
     Args:
         loop: the asyncio.Loop to use
         urls: list of URLs to pull
         kwargs: keyword args to pass to aiohttp.ClientSession.get()
     """
-    async with aiohttp.ClientSession() as aiosess:
-        # Results are ordered according to the order in `coros`
-        coros = [aiosess.get(url, **kwargs) for url in urls]
-        results = await asyncio.gather(
-            *coros,
-            loop=loop,
-            return_exceptions=True
-        )
+    kwargs.setdefault('timeout',
+                      aiohttp.ClientTimeout(total=FETCH_TIMEOUT_SECS))
+
+    # Results are ordered according to the order in `coros`
+    coros = [fetch(url, **kwargs) for url in urls]
+    results = await asyncio.gather(
+        *coros,
+        loop=loop,
+        return_exceptions=True
+    )
 
     return zip(urls, results)